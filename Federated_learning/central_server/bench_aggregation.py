@@ -0,0 +1,112 @@
+"""
+Benchmark for federated averaging: time and peak memory versus number of clients.
+
+Writes N random ResNet18 state dicts to a temporary directory and aggregates them
+with the original load-everything implementation and with each of the aggregators
+in central_server.AGGREGATORS. Each measurement runs in a fresh process so peak RSS
+is not polluted by the previous one. Run from this directory:
+
+    python bench_aggregation.py --clients 2 4 8 16
+    python bench_aggregation.py --strategies fedavg median trimmed_mean --skip-legacy
+"""
+import argparse
+import contextlib
+import copy
+import json
+import multiprocessing
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import torch
+
+import central_server
+from central_server import AGGREGATORS, get_model, NUM_CLASSES
+
+
+def legacy_federated_average(weight_files):
+    """federated_average as it was before streaming, kept as the baseline."""
+    client_state_dicts = [torch.load(f) for f in weight_files]
+    num_clients = len(client_state_dicts)
+    avg_state_dict = copy.deepcopy(client_state_dicts[0])
+    for key in avg_state_dict.keys():
+        avg_state_dict[key] = torch.zeros_like(avg_state_dict[key])
+    for state_dict in client_state_dicts:
+        for key in avg_state_dict.keys():
+            avg_state_dict[key] += state_dict[key]
+    for key in avg_state_dict.keys():
+        avg_state_dict[key] = avg_state_dict[key] / num_clients
+    return avg_state_dict
+
+
+def rss_mb():
+    """Peak RSS of this process (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _measure(method, weight_files, dtype_name, queue):
+    central_server.AGGREGATION_DTYPE = getattr(torch, dtype_name)
+    global_state = torch.load(weight_files[0], weights_only=True)
+    num_samples = [100 * (i + 1) for i in range(len(weight_files))]
+    baseline = rss_mb()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(sys.stderr):  # Keep the aggregator's progress out of --json output
+        if method == "legacy":
+            result = legacy_federated_average(weight_files)
+        else:
+            result = AGGREGATORS[method].aggregate(global_state, weight_files, num_samples)
+    elapsed = time.perf_counter() - start
+    checksum = float(sum(v.double().sum() for v in result.values() if v.is_floating_point()))
+    queue.put({"seconds": elapsed, "peak_rss_mb": rss_mb(), "rss_growth_mb": rss_mb() - baseline,
+               "checksum": checksum})
+
+
+def measure(method, weight_files, dtype_name="float32"):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_measure, args=(method, weight_files, dtype_name, queue))
+    proc.start()
+    result = queue.get()
+    proc.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, nargs="+", default=(2, 4, 8, 16))
+    parser.add_argument("--strategies", nargs="+", default=("fedavg",), choices=tuple(AGGREGATORS))
+    parser.add_argument("--dtype", default="float32", choices=("float32", "float64"),
+                        help="Accumulation dtype of the aggregators")
+    parser.add_argument("--skip-legacy", action="store_true", help="Only benchmark the streaming aggregator")
+    parser.add_argument("--json", action="store_true", help="Print a machine-readable report")
+    args = parser.parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="fedavg-bench-") as tmp:
+        files = []
+        for i in range(max(args.clients)):
+            torch.manual_seed(i)
+            path = Path(tmp) / f"clinic_{i}_weights.pth"
+            torch.save(get_model(NUM_CLASSES).state_dict(), path)
+            files.append(path)
+        model_mb = files[0].stat().st_size / 1e6
+
+        for n in args.clients:
+            row = {"clients": n}
+            for method in list(args.strategies) + ([] if args.skip_legacy else ["legacy"]):
+                row[method] = measure(method, files[:n], args.dtype)
+            results.append(row)
+            if not args.json:
+                print(f"clients={n:<3} " + " | ".join(
+                    f"{method} {m['seconds']:6.2f}s +{m['rss_growth_mb']:7.1f} MB"
+                    for method, m in row.items() if method != "clients"))
+
+    if args.json:
+        print(json.dumps({"model_mb": model_mb, "dtype": args.dtype, "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
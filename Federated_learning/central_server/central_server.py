@@ -1,77 +1,515 @@
+import time
+_IMPORT_START = time.perf_counter()  # Startup timings are measured from here
 import os
+import json
+import math
+import shutil
+import tempfile
+import zlib
+import asyncio
+import functools
+import hashlib
+import itertools
+import sys
+import threading
+from abc import ABC, abstractmethod
+from collections import defaultdict, deque
 from pathlib import Path
 import torch
 import torch.nn as nn
-from torchvision import models
+# torchvision (which pulls in torch._dynamo) is imported where a model is built, which
+# aggregation and serving never need
+import requests
+from requests.adapters import HTTPAdapter
 import uvicorn
-from fastapi import FastAPI, UploadFile, File, HTTPException
-from starlette.responses import FileResponse
-import copy
-from typing import List
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
+from starlette.responses import FileResponse, Response
+from typing import List, Optional
+
+_REPO_ROOT = str(Path(__file__).resolve().parents[2])  # For the shared netra_shared package
+if _REPO_ROOT not in sys.path:
+    sys.path.insert(0, _REPO_ROOT)
+from netra_shared.delta_codec import (DELTA_COMPRESSIONS, DELTA_DTYPES, apply_delta, decode_delta, encode_delta,
+                                      state_delta)
+from netra_shared.files import atomic_write
+from netra_shared.instrumentation import REGISTRY, Profiler, instrument_app, observe_stage, stage
 
 # --- Configuration ---
 NUM_CLASSES = 6  # Must match all clients
 MODEL_DIR = Path("./global_model")
 GLOBAL_MODEL_PATH = MODEL_DIR / "global_model.pth"
 UPLOAD_DIR = Path("./uploads")
+VERSION_PATH = MODEL_DIR / "version.json"  # Version number of GLOBAL_MODEL_PATH
+MODEL_HISTORY = 5  # Past global model versions kept so clients can exchange deltas against them
+PARTIAL_DIR = UPLOAD_DIR / "partial"  # Resumable uploads in progress
+CLAIMED_DIR = UPLOAD_DIR / "claimed"  # Uploads being aggregated, so new ones can land meanwhile
+UPLOAD_KINDS = ("weights", "delta")
+STREAM_CHUNK_SIZE = 1024 * 1024  # Bytes read/written at a time when streaming files
+MAX_DELTA_BYTES = 256 * 1024 * 1024  # Delta uploads above this are rejected with 413 (an fp32 ResNet18 delta is ~45 MB)
+
+# Precision of the running sum during aggregation: torch.float32, or torch.float64 when
+# averaging many clients and the rounding of a float32 sum starts to matter
+AGGREGATION_DTYPE = torch.float32
+
+# Aggregation strategy used by /aggregate (see AGGREGATORS): "fedavg" (sample-weighted),
+# "fedavg_unweighted", "fedavgm", "fedadam", "median" or "trimmed_mean"
+AGGREGATION_STRATEGY = "fedavg"
+SERVER_LR = 1.0  # FedAvgM server learning rate
+SERVER_MOMENTUM = 0.9  # FedAvgM server momentum
+FEDADAM_LR = 1e-2
+FEDADAM_BETAS = (0.9, 0.99)
+FEDADAM_TAU = 1e-3  # Adaptivity: larger values make FedAdam behave more like FedAvgM
+TRIMMED_MEAN_RATIO = 0.1  # Fraction of clients trimmed from each end, per coordinate
+ROBUST_CHUNK_SIZE = 1 << 20  # Coordinates sorted at a time by median / trimmed_mean
+
+# How uploads become global models: "sync" waits for a round's quorum and aggregates
+# with AGGREGATION_STRATEGY; "async" merges each upload as soon as it arrives (FedAsync);
+# "buffered" merges every ASYNC_BUFFER_SIZE uploads (FedBuff). The last two weight each
+# update by its staleness, the number of versions published since its base version.
+AGGREGATION_MODE = "sync"
+ASYNC_MIXING = 0.6  # Step size of a single merged update in "async" mode
+ASYNC_BUFFER_SIZE = 3  # Uploads per merge in "buffered" mode
+FEDBUFF_SERVER_LR = 1.0  # Step size of the buffered mean update
+STALENESS_EXPONENT = 0.5  # Update weight is (1 + staleness) ** -STALENESS_EXPONENT
 
 # List of clients expected to report in before aggregation
 EXPECTED_CLIENTS = ["clinic_1", "clinic_2", "clinic_3"]
 
+# Training rounds (see /rounds/start)
+CLINIC_URLS = {"clinic_1": "http://127.0.0.1:8001", "clinic_2": "http://127.0.0.1:8002"}  # Until clinics register
+CLINIC_REGISTRY_PATH = MODEL_DIR / "clinics.json"  # URLs clinics registered with /register
+ROUND_QUORUM = 1.0  # Fraction of the round's clinics whose uploads trigger aggregation
+ROUND_DEADLINE_SECONDS = 4 * 3600  # Aggregate whatever has arrived by then
+ROUND_MIN_CLIENTS = 1  # A round that times out with fewer uploads fails instead of aggregating
+ROUND_HISTORY = 100  # Finished rounds kept for /rounds and /round-metrics
+START_TRAINING_TIMEOUT = (5, 30)  # (connect, read) seconds for /start-training calls to clinics
+STATUS_POLL_TIMEOUT = (2, 5)  # (connect, read) seconds for /training-status polls
+PROFILE_DIR = Path("./profiles")  # Traces captured by POST /admin/profile
+
 # Ensure directories exist
 MODEL_DIR.mkdir(parents=True, exist_ok=True)
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
+PARTIAL_DIR.mkdir(parents=True, exist_ok=True)
+CLAIMED_DIR.mkdir(parents=True, exist_ok=True)
 
 # --- Model Definition (Must be IDENTICAL to client) ---
 def get_model(num_classes):
+    from torchvision import models
     model = models.resnet18(weights=None)
     model.fc = nn.Linear(model.fc.in_features, num_classes)
     return model
 
+# --- File Helpers ---
+def atomic_save(state_dict, path):
+    atomic_write(path, lambda f: torch.save(state_dict, f))
+
+def atomic_write_json(path, data):
+    atomic_write(path, lambda f: f.write(json.dumps(data).encode("utf-8")))
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(STREAM_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@functools.lru_cache(maxsize=16)
+@stage("checksum")
+def _cached_sha256(path, mtime_ns, size):
+    return file_sha256(path)
+
+def checksum(path):
+    """sha256 of a file, recomputed only when its mtime or size changes."""
+    st = path.stat()
+    return _cached_sha256(path, st.st_mtime_ns, st.st_size)
+
+def bytes_response(request, payload, headers):
+    """
+    Serves an in-memory payload with an ETag, a checksum header and support for
+    `Range: bytes=N-` (guarded by If-Range), so an interrupted download can resume.
+    """
+    digest = hashlib.sha256(payload).hexdigest()
+    etag = f'"{digest}"'
+    headers = {**headers, "ETag": etag, "Accept-Ranges": "bytes", "X-Checksum-SHA256": digest}
+    requested = request.headers.get("range", "")
+    if_range = request.headers.get("if-range")
+    if requested.startswith("bytes=") and requested.endswith("-") and (if_range is None or if_range == etag):
+        try:
+            start = int(requested[len("bytes="):-1])
+        except ValueError:
+            start = None
+        if start is not None and start >= len(payload):
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{len(payload)}"})
+        if start is not None:
+            headers["Content-Range"] = f"bytes {start}-{len(payload) - 1}/{len(payload)}"
+            return Response(content=payload[start:], status_code=206, media_type="application/octet-stream",
+                            headers=headers)
+    return Response(content=payload, media_type="application/octet-stream", headers=headers)
+
+# --- Global Model Versions ---
+def history_path(version):
+    return MODEL_DIR / f"global_model_v{version}.pth"
+
+def read_model_version():
+    try:
+        with open(VERSION_PATH) as f:
+            return json.load(f)["version"]
+    except (OSError, ValueError, KeyError):
+        return 0
+
+@stage("publish")
+def publish_global_model(state_dict, version):
+    """Saves `state_dict` as the current global model `version` and keeps the last MODEL_HISTORY versions."""
+    atomic_save(state_dict, history_path(version))
+
+    def copy_from_history(f):
+        with open(history_path(version), "rb") as source:
+            shutil.copyfileobj(source, f, STREAM_CHUNK_SIZE)
+    atomic_write(GLOBAL_MODEL_PATH, copy_from_history)
+    atomic_write_json(VERSION_PATH, {"version": version})
+    for old in MODEL_DIR.glob("global_model_v*.pth"):
+        if int(old.stem.rsplit("_v", 1)[1]) <= version - MODEL_HISTORY:
+            old.unlink(missing_ok=True)
+    # Resumable uploads against versions that are gone can never be completed
+    for session_path in PARTIAL_DIR.glob("*.json"):
+        session = _read_json(session_path)
+        if session is None or session["round"] <= version - MODEL_HISTORY:
+            _drop_upload(session_path.stem)
+    return version
+
+def _load_state(path):
+    return torch.load(path, map_location="cpu", weights_only=True)
+
+def _dense_bytes(state_dict):
+    """Size of the state dict sent as plain tensors, the baseline for the transfer report."""
+    return sum(v.numel() * v.element_size() for v in state_dict.values())
+
+@functools.lru_cache(maxsize=8)
+@stage("encode_download")
+def _encoded_download(since, version, dtype, compression):
+    """
+    The payload /download-delta sends to a client at `since`: a delta when that version
+    is still in the history, otherwise (`since` None) the whole model losslessly. Returns
+    (payload, base version or None, dense bytes). Cached, since every clinic asks for the
+    same thing; callers pass since=None, dtype="fp32" for every full-model fallback (see
+    download_delta), so those share one entry.
+    """
+    current = _load_state(GLOBAL_MODEL_PATH)
+    if since is not None and history_path(since).exists():
+        payload = encode_delta(state_delta(current, _load_state(history_path(since))), dtype, None, compression)
+        return payload, since, _dense_bytes(current)
+    return encode_delta(current, "fp32", None, compression), None, _dense_bytes(current)
+
+# Bytes exchanged per global model version (round): {version: {"downloads": {...}, "uploads": {...}}}
+transfer_stats = {}
+TRANSFER_BYTES = REGISTRY.counter("netra_transfer_bytes_total", "Model bytes exchanged with the clinics", ("direction",))
+
+def _record_transfer(version, direction, clinic_id, sent_bytes, dense_bytes):
+    entry = transfer_stats.setdefault(version, {"downloads": {}, "uploads": {}})
+    entry[direction][clinic_id or "anonymous"] = {"bytes": sent_bytes, "dense_bytes": dense_bytes}
+    TRANSFER_BYTES.inc(sent_bytes, direction=direction)
+
 # --- Federated Averaging Logic (from your notebook) ---
-def federated_average(weight_files: List[Path]):
-    print(f"Starting federated averaging for {len(weight_files)} clients...")
-    
-    client_state_dicts = [torch.load(f) for f in weight_files]
-    num_clients = len(client_state_dicts)
-    
-    if num_clients == 0:
-        print("No client weights found. Aborting aggregation.")
-        return None
+def _load_client_weights(path):
+    """Loads one client's state dict memory-mapped, so only the tensor being read is paged in."""
+    return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
 
-    # Use the first client's state_dict as a template
-    avg_state_dict = copy.deepcopy(client_state_dicts[0])
-    
-    # Zero out all parameters
-    for key in avg_state_dict.keys():
-        avg_state_dict[key] = torch.zeros_like(avg_state_dict[key])
-        
-    # Sum all client weights
-    for state_dict in client_state_dicts:
-        for key in avg_state_dict.keys():
-            avg_state_dict[key] += state_dict[key]
-            
-    # Average the weights
-    for key in avg_state_dict.keys():
-        avg_state_dict[key] = avg_state_dict[key] / num_clients
-        
-    print("Averaging complete.")
-    return avg_state_dict
+_parameter_names = None
+
+def parameter_names():
+    """Names of the trainable parameters (as opposed to BatchNorm buffers) in the state dict."""
+    global _parameter_names
+    if _parameter_names is None:
+        _parameter_names = {name for name, _ in get_model(NUM_CLASSES).named_parameters()}
+    return _parameter_names
+
+class StateLayout:
+    """
+    Maps a state dict onto one flat vector holding all of its floating point tensors,
+    so aggregation is a handful of vectorized ops instead of a Python loop per tensor.
+    Integer buffers (BatchNorm num_batches_tracked) are kept out of the vector.
+    """
+
+    def __init__(self, state_dict):
+        self.keys = list(state_dict.keys())
+        self.float_keys = [k for k in self.keys if state_dict[k].is_floating_point()]
+        self.int_keys = [k for k in self.keys if not state_dict[k].is_floating_point()]
+        self.shapes = {k: state_dict[k].shape for k in self.keys}
+        self.dtypes = {k: state_dict[k].dtype for k in self.keys}
+        self.numels = [state_dict[k].numel() for k in self.float_keys]
+        self.size = sum(self.numels)
+
+    def check(self, state_dict, source):
+        if list(state_dict.keys()) != self.keys or any(state_dict[k].shape != self.shapes[k] for k in self.keys):
+            raise ValueError(f"{source} does not have the same parameters as the global model.")
+
+    def _slices(self, flat):
+        return zip(self.float_keys, torch.split(flat, self.numels))
+
+    def flatten(self, state_dict, out=None):
+        """Copies the float tensors into `out` (or a new AGGREGATION_DTYPE vector) without temporaries."""
+        if out is None:
+            out = torch.empty(self.size, dtype=AGGREGATION_DTYPE)
+        for k, chunk in self._slices(out):
+            chunk.copy_(state_dict[k].reshape(-1))
+        return out
+
+    def add_(self, flat, state_dict, alpha=1.0):
+        """flat += alpha * state_dict, in place."""
+        for k, chunk in self._slices(flat):
+            chunk.add_(state_dict[k].reshape(-1), alpha=alpha)
+        return flat
+
+    def parameter_mask(self):
+        """Boolean mask over the flat vector: True for trainable parameters, False for buffers."""
+        names = parameter_names()
+        return torch.cat([torch.full((n,), k in names, dtype=torch.bool) for k, n in zip(self.float_keys, self.numels)])
+
+    def unflatten(self, flat, int_buffers):
+        tensors = dict(self._slices(flat))
+        tensors.update(int_buffers)
+        return {k: tensors[k].reshape(self.shapes[k]).to(self.dtypes[k], copy=True) for k in self.keys}
+
+class Aggregator(ABC):
+    """
+    Turns the uploaded client models into the next global model. Subclasses implement
+    combine(), which gets the global state dict, an iterator over the client state
+    dicts (memory-mapped and streamed from disk one at a time), their sample counts
+    and the layout used to flatten them. Integer buffers are counters, not weights: the
+    new global model takes their element-wise max over clients rather than an average.
+    """
+    name = None
+
+    def aggregate(self, global_state, weight_files: List[Path], num_samples: List[int] = None):
+        print(f"Starting {self.name} aggregation for {len(weight_files)} clients...")
+        if len(weight_files) == 0:
+            print("No client weights found. Aborting aggregation.")
+            return None
+        if global_state is None:
+            # Use the first client's state_dict as a template
+            global_state = _load_client_weights(weight_files[0])
+        layout = StateLayout(global_state)
+        int_buffers = {}
+
+        def client_states():
+            for f in weight_files:
+                state_dict = _load_client_weights(f)
+                layout.check(state_dict, f)
+                for k in layout.int_keys:
+                    int_buffers[k] = torch.maximum(int_buffers[k], state_dict[k]) if k in int_buffers \
+                        else state_dict[k].clone()
+                yield state_dict
+                del state_dict
+
+        if num_samples is None or any(n is None or n <= 0 for n in num_samples):
+            weights = torch.ones(len(weight_files), dtype=torch.float64)
+        else:
+            weights = torch.tensor(num_samples, dtype=torch.float64)
+        flat = self.combine(global_state, client_states(), weights, layout)
+        print("Aggregation complete.")
+        return layout.unflatten(flat, int_buffers)
+
+    @abstractmethod
+    def combine(self, global_state, client_states, weights, layout):
+        """Returns the new global model as a flat tensor in `layout`."""
+
+class FedAvg(Aggregator):
+    """
+    Sample-count weighted mean (McMahan et al.). Clients are streamed into a single
+    running sum with in-place add_ and divided once, so memory does not grow with the
+    number of clients.
+    """
+    name = "fedavg"
+
+    def combine(self, global_state, client_states, weights, layout):
+        total = torch.zeros(layout.size, dtype=AGGREGATION_DTYPE)
+        for state_dict, weight in zip(client_states, weights.tolist()):
+            layout.add_(total, state_dict, weight)
+        return total.div_(float(weights.sum()))
+
+class UnweightedFedAvg(FedAvg):
+    """Plain mean over clients, ignoring how much data each one trained on."""
+    name = "fedavg_unweighted"
+
+    def combine(self, global_state, client_states, weights, layout):
+        return super().combine(global_state, client_states, torch.ones_like(weights), layout)
+
+class ServerOptimizer(FedAvg):
+    """
+    Adaptive federated optimization (Reddi et al.): the difference between the weighted
+    client mean and the current global model is treated as a pseudo-gradient and fed to
+    a server-side optimizer. Only trainable parameters are stepped; BatchNorm running
+    statistics take the plain weighted mean. Optimizer state lives in memory and
+    restarts from zero when the server does.
+    """
+
+    def __init__(self):
+        self.state = None
+
+    def combine(self, global_state, client_states, weights, layout):
+        mean = super().combine(global_state, client_states, weights, layout)
+        if self.state is not None and self.state["size"] != layout.size:
+            self.state = None
+        if self.state is None:
+            self.state = {"size": layout.size, "mask": layout.parameter_mask()}
+        global_flat = layout.flatten(global_state)
+        update = self.step(mean.sub(global_flat))
+        return torch.where(self.state["mask"], global_flat.add_(update), mean)
+
+    @abstractmethod
+    def step(self, pseudo_grad):
+        """Returns the update to add to the global parameters."""
+
+class FedAvgM(ServerOptimizer):
+    """FedAvg with server momentum; SERVER_MOMENTUM=0 and SERVER_LR=1 reduce it to FedAvg."""
+    name = "fedavgm"
+
+    def step(self, pseudo_grad):
+        momentum = self.state.get("momentum")
+        momentum = pseudo_grad if momentum is None else momentum.mul_(SERVER_MOMENTUM).add_(pseudo_grad)
+        self.state["momentum"] = momentum
+        return momentum * SERVER_LR
+
+class FedAdam(ServerOptimizer):
+    name = "fedadam"
+
+    def step(self, pseudo_grad):
+        if "m" not in self.state:
+            self.state["m"] = torch.zeros_like(pseudo_grad)
+            self.state["v"] = torch.zeros_like(pseudo_grad)
+        m = self.state["m"].mul_(FEDADAM_BETAS[0]).add_(pseudo_grad, alpha=1 - FEDADAM_BETAS[0])
+        v = self.state["v"].mul_(FEDADAM_BETAS[1]).addcmul_(pseudo_grad, pseudo_grad, value=1 - FEDADAM_BETAS[1])
+        return m.div(v.sqrt().add_(FEDADAM_TAU)).mul_(FEDADAM_LR)
+
+class CoordinateStatistic(Aggregator):
+    """
+    Base for the robust, order-statistic aggregators. These need every client's value
+    of a coordinate at once, so clients are stacked into one clients x model-size
+    matrix; the sort is done ROBUST_CHUNK_SIZE coordinates at a time to bound the
+    extra memory it needs.
+    """
+
+    def combine(self, global_state, client_states, weights, layout):
+        stacked = torch.empty(len(weights), layout.size, dtype=AGGREGATION_DTYPE)
+        for i, state_dict in enumerate(client_states):
+            layout.flatten(state_dict, out=stacked[i])
+        out = torch.empty(layout.size, dtype=AGGREGATION_DTYPE)
+        for begin in range(0, layout.size, ROBUST_CHUNK_SIZE):
+            end = begin + ROBUST_CHUNK_SIZE
+            # Sorting rows of a contiguous coordinates x clients block is ~2x faster than sorting columns
+            block = stacked[:, begin:end].t().contiguous()
+            out[begin:end] = self.reduce(block.sort(dim=1).values.t())
+        return out
+
+    @abstractmethod
+    def reduce(self, ordered):
+        """Combines a clients x coordinates block that is sorted along the client axis."""
+
+class CoordinateMedian(CoordinateStatistic):
+    """Coordinate-wise median (Yin et al.), robust to a minority of corrupted or outlying clients."""
+    name = "median"
+
+    def reduce(self, ordered):
+        n = ordered.shape[0]
+        if n % 2:
+            return ordered[n // 2]
+        return (ordered[n // 2 - 1] + ordered[n // 2]) / 2
+
+class TrimmedMean(CoordinateStatistic):
+    """Drops the TRIMMED_MEAN_RATIO largest and smallest values of every coordinate, then averages."""
+    name = "trimmed_mean"
+
+    def reduce(self, ordered):
+        n = ordered.shape[0]
+        trim = min(int(n * TRIMMED_MEAN_RATIO), (n - 1) // 2)
+        return ordered[trim:n - trim].mean(dim=0)
+
+# One instance per strategy, so server optimizer state carries over between rounds
+AGGREGATORS = {cls.name: cls() for cls in (FedAvg, UnweightedFedAvg, FedAvgM, FedAdam, CoordinateMedian, TrimmedMean)}
+
+def federated_average(weight_files: List[Path], num_samples: List[int] = None):
+    """Sample-weighted FedAvg of the client state dicts (unweighted when counts are missing)."""
+    return AGGREGATORS["fedavg"].aggregate(None, weight_files, num_samples)
+
+def staleness_weight(staleness):
+    """Polynomial staleness discount from FedAsync: 1 for a fresh update, smaller the older its base."""
+    return (1.0 + staleness) ** -STALENESS_EXPONENT
+
+class StaleUpdateMerger:
+    """
+    Server update for asynchronous training (FedAsync / FedBuff). Each client's change
+    from the global version it trained on is discounted by staleness_weight, and the
+    sample-weighted mean of those changes is added to the current global model, scaled
+    by `server_lr`. Unlike averaging whole models, a stale client only contributes its
+    own update and cannot pull the global model back towards an old version. The
+    updates are independent: several can come from the same clinic (trained from
+    different base versions), and each counts as its own update.
+    """
+
+    def merge(self, global_state, weight_files, base_versions, current_version, num_samples=None, server_lr=1.0):
+        """Returns the new global state dict and the staleness of each update."""
+        layout = StateLayout(global_state)
+        flat = layout.flatten(global_state)
+        update = torch.zeros_like(flat)
+        int_buffers = {k: global_state[k].clone() for k in layout.int_keys}
+        if num_samples is None or any(n is None or n <= 0 for n in num_samples):
+            num_samples = [1] * len(weight_files)
+        total = float(sum(num_samples))
+        staleness = []
+        for f, base_version, n in zip(weight_files, base_versions, num_samples):
+            client = _load_client_weights(f)
+            layout.check(client, f)
+            base = _load_client_weights(history_path(base_version))
+            staleness.append(current_version - base_version)
+            weight = staleness_weight(staleness[-1]) * n / total
+            layout.add_(update, client, alpha=weight)
+            layout.add_(update, base, alpha=-weight)
+            for k in layout.int_keys:
+                int_buffers[k] = torch.maximum(int_buffers[k], client[k])
+            del client, base
+        flat.add_(update, alpha=server_lr)
+        return layout.unflatten(flat, int_buffers), staleness
 
 # --- FastAPI Application ---
 app = FastAPI()
+profiler = Profiler(PROFILE_DIR)
+instrument_app(app, profiler)  # /metrics, per-route request metrics and /admin/profile
+
+startup_timings = {"imports_s": round(time.perf_counter() - _IMPORT_START, 3)}
 
 @app.on_event("startup")
 def on_startup():
     """Initializes the global model on first-ever startup."""
     if not GLOBAL_MODEL_PATH.exists():
+        from torchvision import models
         print("Initializing new global model with pretrained weights...")
         model = models.resnet18(weights=models.ResNet18_Weights.IMAGENET1K_V1)
         model.fc = nn.Linear(model.fc.in_features, NUM_CLASSES)
-        torch.save(model.state_dict(), GLOBAL_MODEL_PATH)
+        publish_global_model(model.state_dict(), 0)
         print(f"Saved initial global model to {GLOBAL_MODEL_PATH}")
     else:
-        print(f"Found existing global model at {GLOBAL_MODEL_PATH}")
+        version = read_model_version()
+        if not history_path(version).exists():
+            shutil.copyfile(GLOBAL_MODEL_PATH, history_path(version))
+        print(f"Found existing global model at {GLOBAL_MODEL_PATH} (version {version})")
+    _release_uploads(list(CLAIMED_DIR.glob("*_weights.pth")))  # Left over if we stopped mid-aggregation
+    for tmp_path in UPLOAD_DIR.glob(".*.upload"):  # /upload-weights bodies cut off by a crash
+        tmp_path.unlink(missing_ok=True)
+    checksum(GLOBAL_MODEL_PATH)  # Warm the checksum cache, so the first /download-model doesn't hash the file
+    startup_timings["ready_s"] = round(time.perf_counter() - _IMPORT_START, 3)
+    print(f"Ready to serve. Startup timings: {startup_timings}")
+
+@app.get("/healthz")
+def liveness():
+    """Liveness: the process is up and answering."""
+    return {"status": "alive", "uptime_s": time.perf_counter() - _IMPORT_START}
+
+@app.get("/readyz")
+def readiness():
+    """Readiness: startup has finished and there is a global model to serve. Includes the startup timings."""
+    if "ready_s" not in startup_timings or not GLOBAL_MODEL_PATH.exists():
+        raise HTTPException(status_code=503, detail={"status": "starting"})
+    return {"status": "ready", "model_version": read_model_version(), "startup": startup_timings}
 
 @app.get("/")
 def read_root():
@@ -82,58 +520,835 @@ def download_model():
     """Allows clients to download the current global model."""
     if not GLOBAL_MODEL_PATH.exists():
         raise HTTPException(status_code=404, detail="Global model not found.")
-    return FileResponse(GLOBAL_MODEL_PATH, media_type='application/octet-stream', filename=GLOBAL_MODEL_PATH.name)
+    # FileResponse streams the file and honours Range / If-Range, so clients can resume
+    return FileResponse(GLOBAL_MODEL_PATH, media_type='application/octet-stream', filename=GLOBAL_MODEL_PATH.name,
+                        headers={"X-Model-Version": str(read_model_version()),
+                                 "X-Checksum-SHA256": checksum(GLOBAL_MODEL_PATH)})
 
-@app.post("/upload-weights/{clinic_id}")
-async def upload_weights(clinic_id: str, file: UploadFile = File(...)):
-    """Allows clients to upload their trained model weights."""
+@app.get("/model-version")
+def model_version():
+    return {"version": read_model_version()}
+
+@app.get("/download-delta")
+def download_delta(request: Request, since: Optional[int] = None, dtype: str = "fp16", compression: str = "zlib",
+                   clinic_id: Optional[str] = None):
+    """
+    The change from global version `since` (the last one the client has) to the current
+    one, encoded with the delta codec. Answers 204 if the client is up to date, and the
+    whole model (fp32) if `since` is missing or no longer in the history. The
+    X-Model-Version header is the version the client ends up with; X-Delta-Base is the
+    version the payload applies to, or "none" for a whole model. Supports resuming with
+    Range / If-Range like /download-model.
+    """
+    if dtype not in DELTA_DTYPES or compression not in DELTA_COMPRESSIONS:
+        raise HTTPException(status_code=400, detail=f"dtype must be one of {DELTA_DTYPES}, "
+                                                    f"compression one of {tuple(DELTA_COMPRESSIONS)}")
+    version = read_model_version()
+    headers = {"X-Model-Version": str(version)}
+    if since == version:
+        return Response(status_code=204, headers=headers)
+    if since is not None and not history_path(since).exists():
+        # Expired or unknown versions all get the full model: one cache entry, not one ~45 MB payload each
+        since = None
+    if since is None:
+        dtype = "fp32"
+    try:
+        payload, base, dense_bytes = _encoded_download(since, version, dtype, compression)
+    except RuntimeError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    headers["X-Delta-Base"] = "none" if base is None else str(base)
+    response = bytes_response(request, payload, headers)
+    _record_transfer(version, "downloads", clinic_id, len(response.body), dense_bytes)
+    return response
+
+@app.get("/transfer-stats")
+def get_transfer_stats():
+    """Bytes sent each way per global model version, against the size of plain fp32 state dicts."""
+    report = {}
+    for version, entry in sorted(transfer_stats.items()):
+        sent = sum(t["bytes"] for d in entry.values() for t in d.values())
+        dense = sum(t["dense_bytes"] for d in entry.values() for t in d.values())
+        report[version] = {**entry, "total_bytes": sent, "total_dense_bytes": dense,
+                           "compression_ratio": dense / sent if sent else None}
+    return report
+
+_upload_seq = itertools.count(time.time_ns())  # Increases across restarts too, so names sort by arrival
+
+def _upload_path(clinic_id):
+    """
+    Where a clinic's next upload lands. Synchronous rounds keep one slot per clinic, so a
+    re-upload replaces the earlier one. The async and buffered modes keep every arrival
+    ({clinic_id}-{seq}_weights.pth): a fast clinic's updates are all merged, and the
+    buffer fills after ASYNC_BUFFER_SIZE arrivals rather than that many distinct clinics.
+    """
+    if AGGREGATION_MODE == "sync":
+        return UPLOAD_DIR / f"{clinic_id}_weights.pth"
+    return UPLOAD_DIR / f"{clinic_id}-{next(_upload_seq)}_weights.pth"
+
+def _metadata_path(weights_path):
+    return weights_path.with_name(weights_path.name.replace("_weights.pth", "_meta.json"))
+
+def _write_metadata(weights_path, clinic_id, num_samples, base_version):
+    # Written before the weights are moved into place, so a claimed upload always has its own metadata
+    atomic_write_json(_metadata_path(weights_path), {"clinic_id": clinic_id, "num_samples": num_samples,
+                                                     "base_version": base_version})
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _read_num_samples(weights_path):
+    """Sample count the clinic reported with this upload, or None if it did not."""
+    metadata = _read_json(_metadata_path(weights_path))
+    return metadata.get("num_samples") if metadata else None
+
+def _check_upload_params(clinic_id, num_samples, base_version=None):
     if clinic_id not in EXPECTED_CLIENTS:
         raise HTTPException(status_code=400, detail=f"Invalid clinic_id: {clinic_id}")
+    if num_samples is not None and num_samples <= 0:
+        raise HTTPException(status_code=400, detail="num_samples must be positive.")
+    if base_version is not None and not history_path(base_version).exists():
+        raise HTTPException(status_code=409, detail=f"Global version {base_version} is no longer available; "
+                                                    f"download the current model and retrain.")
+
+@app.post("/upload-weights/{clinic_id}")
+async def upload_weights(clinic_id: str, file: UploadFile = File(...), num_samples: Optional[int] = None,
+                         sha256: Optional[str] = None, base_version: Optional[int] = None):
+    """
+    Allows clients to upload their trained model weights. `num_samples` is the size of
+    the clinic's training set, used to weight its update during aggregation, and
+    `base_version` the global version it trained from (default: the current one). If
+    `sha256` is given the upload is rejected unless it matches. For large files over
+    unreliable links use the resumable /uploads API instead.
+    """
+    _check_upload_params(clinic_id, num_samples, base_version)
     
-    save_path = UPLOAD_DIR / f"{clinic_id}_weights.pth"
+    save_path = _upload_path(clinic_id)
+    # A temp file of its own, so concurrent uploads from the same clinic cannot clobber each other's
+    fd, tmp_name = tempfile.mkstemp(dir=UPLOAD_DIR, prefix=f".{clinic_id}_", suffix=".upload")
+    tmp_path = Path(tmp_name)
+    digest, size = hashlib.sha256(), 0
     try:
-        with open(save_path, 'wb') as f:
-            content = await file.read()
-            f.write(content)
+        # Stream to a temp file in chunks instead of holding the whole upload in memory
+        with open(fd, 'wb') as f:
+            while chunk := await file.read(STREAM_CHUNK_SIZE):
+                digest.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+        if sha256 is not None and digest.hexdigest() != sha256:
+            raise HTTPException(status_code=400, detail="Checksum mismatch; upload the file again.")
+        _write_metadata(save_path, clinic_id, num_samples,
+                        base_version if base_version is not None else read_model_version())
+        os.replace(tmp_path, save_path)
+        _record_transfer(read_model_version(), "uploads", clinic_id, size, size)
         print(f"Received weights from {clinic_id}, saved to {save_path}")
+        rounds.on_upload(clinic_id)
         return {"status": "Weights uploaded successfully", "clinic_id": clinic_id, "filename": save_path.name}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to save file: {e}")
+    finally:
+        tmp_path.unlink(missing_ok=True)
 
-@app.post("/aggregate")
-def trigger_aggregation():
+@stage("reconstruct_upload")
+def _reconstruct_upload(payload, base_version, save_path, metadata):
     """
-    (Admin) Triggers the server to average all received weights
-    and create a new global_model.pth.
+    Decodes a client delta, applies it to the global model it was trained from and
+    saves the result, writing its `metadata` (clinic_id, num_samples) just before.
     """
-    print("Aggregation triggered by API call...")
-    
-    # Find all the weight files that have been uploaded
-    uploaded_weights = list(UPLOAD_DIR.glob("*_weights.pth"))
-    
-    # Optional: Check if all expected clients have reported
-    # For this demo, we'll just average whatever we have.
-    if len(uploaded_weights) == 0:
-        raise HTTPException(status_code=400, detail="No client weights available to aggregate.")
+    base = _load_state(history_path(base_version))
+    weights = apply_delta(base, decode_delta(payload))
+    _write_metadata(save_path, base_version=base_version, **metadata)
+    atomic_save(weights, save_path)
+    return _dense_bytes(base)
+
+@app.post("/upload-delta/{clinic_id}")
+async def upload_delta(clinic_id: str, base_version: int, file: UploadFile = File(...),
+                       num_samples: Optional[int] = None, sha256: Optional[str] = None):
+    """
+    Like /upload-weights, but the file is an encode_delta payload holding the change
+    from global version `base_version`. The server rebuilds the full weights, so
+    aggregation does not care how a clinic uploaded. 409 if that version has been
+    dropped from the history, 413 if the delta is larger than MAX_DELTA_BYTES.
+    """
+    _check_upload_params(clinic_id, num_samples, base_version)
+
+    save_path = _upload_path(clinic_id)
+    # Deltas are decoded in memory anyway, but stop reading as soon as one is over the limit
+    digest, chunks, size = hashlib.sha256(), [], 0
+    while chunk := await file.read(STREAM_CHUNK_SIZE):
+        size += len(chunk)
+        if size > MAX_DELTA_BYTES:
+            raise HTTPException(status_code=413, detail=f"Delta exceeds the {MAX_DELTA_BYTES}-byte limit.")
+        digest.update(chunk)
+        chunks.append(chunk)
+    payload = b"".join(chunks)
+    if sha256 is not None and digest.hexdigest() != sha256:
+        raise HTTPException(status_code=400, detail="Checksum mismatch; upload the delta again.")
+    try:
+        dense_bytes = await asyncio.to_thread(_reconstruct_upload, payload, base_version, save_path,
+                                              {"clinic_id": clinic_id, "num_samples": num_samples})
+    except (ValueError, RuntimeError, zlib.error, EOFError) as e:
+        raise HTTPException(status_code=400, detail=f"Could not decode delta from {clinic_id}: {e}")
+    _record_transfer(read_model_version(), "uploads", clinic_id, len(payload), dense_bytes)
+    print(f"Received delta from {clinic_id} ({len(payload)} bytes, base v{base_version}), saved to {save_path}")
+    rounds.on_upload(clinic_id)
+    return {"status": "Delta uploaded successfully", "clinic_id": clinic_id, "filename": save_path.name,
+            "bytes": len(payload), "dense_bytes": dense_bytes}
+
+# --- Resumable Uploads ---
+# A clinic opens (or reopens) an upload for its round with the final size and sha256,
+# PUTs the bytes in chunks at the offset the server reports, and completes it. After a
+# dropped connection it reopens the same upload and continues from the returned offset.
+# Partial data and session state live on disk, so they survive a server restart too.
+
+_upload_locks = defaultdict(asyncio.Lock)
+
+def _part_path(upload_id):
+    return PARTIAL_DIR / f"{upload_id}.part"
+
+def _session_path(upload_id):
+    return PARTIAL_DIR / f"{upload_id}.json"
+
+def _drop_upload(upload_id):
+    _part_path(upload_id).unlink(missing_ok=True)
+    _session_path(upload_id).unlink(missing_ok=True)
+
+def _get_upload(upload_id):
+    session = _read_json(_session_path(upload_id))
+    if session is None or not _part_path(upload_id).exists():
+        raise HTTPException(status_code=404, detail=f"Unknown upload: {upload_id}")
+    return session
+
+def _upload_status(upload_id, session):
+    return {"upload_id": upload_id, "offset": _part_path(upload_id).stat().st_size, "size": session["size"]}
+
+@app.post("/uploads/{clinic_id}")
+def start_upload(clinic_id: str, kind: str, size: int, sha256: str, base_version: Optional[int] = None,
+                 num_samples: Optional[int] = None):
+    """
+    Opens a resumable upload of `kind` "weights" (a full state dict) or "delta" (an
+    encode_delta payload against `base_version`). Uploads are keyed by clinic, round and
+    kind: reopening one with the same size and checksum resumes it at the returned
+    offset, anything else starts over.
+    """
+    if kind not in UPLOAD_KINDS:
+        raise HTTPException(status_code=400, detail=f"kind must be one of {UPLOAD_KINDS}")
+    if kind == "delta" and base_version is None:
+        raise HTTPException(status_code=400, detail="Delta uploads need base_version.")
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="size must be positive.")
+    if kind == "delta" and size > MAX_DELTA_BYTES:
+        raise HTTPException(status_code=413, detail=f"Delta exceeds the {MAX_DELTA_BYTES}-byte limit.")
+    _check_upload_params(clinic_id, num_samples, base_version)
+
+    round_version = base_version if base_version is not None else read_model_version()
+    upload_id = f"{clinic_id}-r{round_version}-{kind}"
+    session = _read_json(_session_path(upload_id))
+    if session is None or session["size"] != size or session["sha256"] != sha256 \
+            or not _part_path(upload_id).exists():
+        session = {"clinic_id": clinic_id, "kind": kind, "round": round_version, "size": size, "sha256": sha256,
+                   "base_version": base_version, "num_samples": num_samples}
+        _part_path(upload_id).write_bytes(b"")
+        atomic_write_json(_session_path(upload_id), session)
+    elif num_samples is not None and num_samples != session["num_samples"]:
+        session["num_samples"] = num_samples
+        atomic_write_json(_session_path(upload_id), session)
+    return _upload_status(upload_id, session)
+
+@app.get("/uploads/{upload_id}")
+def get_upload(upload_id: str):
+    """How many bytes of the upload the server has, i.e. the offset to continue from."""
+    return _upload_status(upload_id, _get_upload(upload_id))
+
+@app.put("/uploads/{upload_id}")
+async def upload_chunk(upload_id: str, offset: int, request: Request):
+    """
+    Appends the request body at `offset`, streaming it to disk. 409 (with the server's
+    offset in the Upload-Offset header) if `offset` is not where the upload currently ends.
+    """
+    async with _upload_locks[upload_id]:
+        session = _get_upload(upload_id)
+        part = _part_path(upload_id)
+        current = part.stat().st_size
+        if offset != current:
+            raise HTTPException(status_code=409, detail=f"Upload is at offset {current}, not {offset}.",
+                                headers={"Upload-Offset": str(current)})
+        with open(part, "ab") as f:
+            async for chunk in request.stream():
+                if current + len(chunk) > session["size"]:
+                    f.truncate(current)
+                    raise HTTPException(status_code=413, detail="Upload is larger than its declared size.")
+                f.write(chunk)
+                current += len(chunk)
+        return {"upload_id": upload_id, "offset": current, "size": session["size"]}
+
+@app.post("/uploads/{upload_id}/complete")
+async def complete_upload(upload_id: str):
+    """
+    Verifies the size and sha256 of a finished upload and atomically moves it into place
+    as the clinic's weights (rebuilding them first for a delta). A checksum mismatch
+    discards the upload.
+    """
+    async with _upload_locks[upload_id]:
+        session = _get_upload(upload_id)
+        part = _part_path(upload_id)
+        received = part.stat().st_size
+        if received != session["size"]:
+            raise HTTPException(status_code=409, detail=f"Upload has {received} of {session['size']} bytes.",
+                                headers={"Upload-Offset": str(received)})
+        if await asyncio.to_thread(file_sha256, part) != session["sha256"]:
+            _drop_upload(upload_id)
+            raise HTTPException(status_code=400, detail="Checksum mismatch; the upload was discarded, start again.")
+
+        clinic_id = session["clinic_id"]
+        save_path = _upload_path(clinic_id)
+        metadata = {"clinic_id": clinic_id, "num_samples": session["num_samples"]}
+        if session["kind"] == "weights":
+            _write_metadata(save_path, base_version=session["round"], **metadata)
+            os.replace(part, save_path)
+            dense_bytes = received
+        else:
+            try:
+                dense_bytes = await asyncio.to_thread(_reconstruct_upload, part.read_bytes(),
+                                                      session["base_version"], save_path, metadata)
+            except (ValueError, RuntimeError, zlib.error, EOFError) as e:
+                _drop_upload(upload_id)
+                raise HTTPException(status_code=400, detail=f"Could not decode delta from {clinic_id}: {e}")
+        _record_transfer(session["round"], "uploads", clinic_id, received, dense_bytes)
+        _drop_upload(upload_id)
+    _upload_locks.pop(upload_id, None)
+    print(f"Completed {session['kind']} upload from {clinic_id} ({received} bytes), saved to {save_path}")
+    rounds.on_upload(clinic_id)
+    return {"status": "Upload complete", "clinic_id": clinic_id, "filename": save_path.name, "bytes": received,
+            "dense_bytes": dense_bytes}
+
+_aggregation_lock = threading.Lock()  # Only one aggregation or merge at a time
+
+def _claim_uploads():
+    """
+    Moves the received uploads (and their metadata) into CLAIMED_DIR for aggregation,
+    so a clinic uploading meanwhile starts a new file instead of changing one being read.
+    """
+    claimed = []
+    for f in sorted(UPLOAD_DIR.glob("*_weights.pth"), key=lambda f: f.stat().st_mtime):
+        target = CLAIMED_DIR / f.name
+        if _metadata_path(f).exists():
+            os.replace(_metadata_path(f), _metadata_path(target))
+        os.replace(f, target)
+        claimed.append(target)
+    return claimed
+
+def _release_uploads(claimed):
+    """Puts claimed uploads back after a failed aggregation, unless the clinic has uploaded again since."""
+    for f in claimed:
+        if (UPLOAD_DIR / f.name).exists():
+            _discard_upload(f)
+            continue
+        if _metadata_path(f).exists():
+            os.replace(_metadata_path(f), _metadata_path(UPLOAD_DIR / f.name))
+        os.replace(f, UPLOAD_DIR / f.name)
+
+def _discard_upload(f):
+    f.unlink(missing_ok=True)
+    _metadata_path(f).unlink(missing_ok=True)
+
+def _clinic_of(weights_path):
+    stem = weights_path.name[:-len("_weights.pth")]
+    clinic_id, sep, seq = stem.rpartition("-")  # Arrival-keyed uploads are {clinic_id}-{seq}
+    return clinic_id if sep and seq.isdigit() else stem
+
+def aggregate_uploads(strategy=None):
+    """
+    Averages all received weights with `strategy` (default AGGREGATION_STRATEGY),
+    publishes the result as the next global model version and removes the uploads.
+    """
+    strategy = strategy or AGGREGATION_STRATEGY
+    if strategy not in AGGREGATORS:
+        raise HTTPException(status_code=400, detail=f"strategy must be one of {list(AGGREGATORS)}")
+    with _aggregation_lock:
+        print(f"Aggregation ({strategy}) started...")
+
+        # Claim all the weight files that have been uploaded
+        uploaded_weights = _claim_uploads()
+        if len(uploaded_weights) == 0:
+            raise HTTPException(status_code=400, detail="No client weights available to aggregate.")
+
+        # 1. Aggregate the weights
+        num_samples = [_read_num_samples(f) for f in uploaded_weights]
+        global_state = torch.load(GLOBAL_MODEL_PATH, map_location="cpu", weights_only=True)
+        try:
+            with stage("aggregate"):
+                new_global_weights = AGGREGATORS[strategy].aggregate(global_state, uploaded_weights, num_samples)
+        except ValueError as e:
+            _release_uploads(uploaded_weights)
+            raise HTTPException(status_code=400, detail=str(e))
+        if not new_global_weights:
+            _release_uploads(uploaded_weights)
+            raise HTTPException(status_code=500, detail="Aggregation failed.")
 
-    # 1. Aggregate the weights
-    new_global_weights = federated_average(uploaded_weights)
-    
-    if new_global_weights:
         # 2. Load into a model and save as the new global model
         model = get_model(NUM_CLASSES)
         model.load_state_dict(new_global_weights)
-        torch.save(model.state_dict(), GLOBAL_MODEL_PATH)
-        print(f"Saved new aggregated global model to {GLOBAL_MODEL_PATH}")
-        
+        version = publish_global_model(model.state_dict(), read_model_version() + 1)
+        print(f"Saved new aggregated global model to {GLOBAL_MODEL_PATH} (version {version})")
+
         # 3. Clean up old client weights
         for f in uploaded_weights:
-            os.remove(f)
+            _discard_upload(f)
         print(f"Cleaned up {len(uploaded_weights)} client weight files.")
-        
-        return {"status": f"Aggregation successful. New global model saved. Averaged {len(uploaded_weights)} clients."}
-    else:
-        raise HTTPException(status_code=500, detail="Aggregation failed.")
+
+    return {"status": f"Aggregation successful. New global model saved. Averaged {len(uploaded_weights)} clients.",
+            "strategy": strategy, "clinics": [_clinic_of(f) for f in uploaded_weights], "num_samples": num_samples,
+            "version": version}
+
+def merge_uploads(min_uploads=1, server_lr=1.0):
+    """
+    Async / buffered aggregation: once at least `min_uploads` uploads are waiting,
+    merges them into the current global model with StaleUpdateMerger and publishes the
+    next version. Uploads whose base version has left the history are dropped. Returns
+    None if nothing was merged.
+    """
+    with _aggregation_lock:
+        if len(list(UPLOAD_DIR.glob("*_weights.pth"))) < min_uploads:
+            return None
+        current = read_model_version()
+        files, base_versions, num_samples = [], [], []
+        for f in _claim_uploads():
+            metadata = _read_json(_metadata_path(f)) or {}
+            base_version = metadata.get("base_version", current)
+            if base_version > current or not history_path(base_version).exists():
+                print(f"Dropping {f.name}: its base version {base_version} is no longer available")
+                _discard_upload(f)
+                continue
+            files.append(f)
+            base_versions.append(base_version)
+            num_samples.append(metadata.get("num_samples"))
+        if not files:
+            return None
+
+        try:
+            with stage("merge"):
+                state, staleness = StaleUpdateMerger().merge(_load_state(GLOBAL_MODEL_PATH), files, base_versions,
+                                                             current, num_samples, server_lr)
+        except ValueError as e:
+            print(f"Merge failed, dropping {len(files)} uploads: {e}")
+            for f in files:
+                _discard_upload(f)
+            return None
+        version = publish_global_model(state, current + 1)
+        for f in files:
+            _discard_upload(f)
+    clinics = [_clinic_of(f) for f in files]
+    print(f"Merged {clinics} (staleness {staleness}) into global model version {version}")
+    return {"version": version, "clinics": clinics, "staleness": staleness, "num_samples": num_samples}
+
+@app.post("/aggregate")
+def trigger_aggregation(strategy: Optional[str] = None):
+    """
+    (Admin) Triggers the server to average all received weights
+    and create a new global_model.pth. `strategy` overrides AGGREGATION_STRATEGY.
+    """
+    print("Aggregation triggered by API call...")
+    return aggregate_uploads(strategy)
+
+# --- Training Rounds ---
+# A round asks every registered clinic in EXPECTED_CLIENTS to train (concurrently),
+# then waits until a quorum of them have uploaded or the deadline passes, aggregates
+# and publishes the next global model version. Clinics that had not uploaded by then
+# are recorded as stragglers; their late uploads are picked up by the next round.
+# In the "async" and "buffered" AGGREGATION_MODEs there are no rounds to wait for:
+# uploads are merged as they arrive and each clinic is asked to train again as soon as
+# its upload has been handled, so fast clinics never wait for slow ones. Every arrival is
+# kept until it is merged (see _upload_path), so while the buffer fills a clinic's next
+# update joins its earlier one instead of replacing it.
+
+def _load_registry():
+    registry = dict(CLINIC_URLS)
+    registry.update(_read_json(CLINIC_REGISTRY_PATH) or {})
+    return registry
+
+clinic_registry = _load_registry()
+
+def _make_session():
+    """Pooled HTTP session for calls to the clinics, with one connection per clinic."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=len(EXPECTED_CLIENTS), pool_maxsize=len(EXPECTED_CLIENTS))
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+http = _make_session()
+
+ROUNDS = REGISTRY.counter("netra_rounds_total", "Training rounds and async sessions finished", ("status",))
+CLINIC_LATENCY = REGISTRY.histogram("netra_clinic_round_latency_seconds",
+                                    "Time from asking a clinic to train to receiving its upload", ("clinic",))
+
+class TrainingRound:
+    """State of one round. Times are time.time() seconds; latencies are from the /start-training call."""
+
+    def __init__(self, round_id, clinics, quorum, deadline_seconds, strategy):
+        self.round_id = round_id
+        self.base_version = read_model_version()
+        self.strategy = strategy or AGGREGATION_STRATEGY
+        self.quorum_fraction = quorum
+        self.quorum = max(1, math.ceil(quorum * len(clinics)))
+        self.deadline_seconds = deadline_seconds
+        self.status = "starting"  # -> running -> aggregating -> done | failed
+        self.error = None
+        self.version = None  # Global model version the round produced
+        self.started_at = time.time()
+        self.quorum_at = None
+        self.finished_at = None
+        self.clinics = {cid: {"status": "pending", "requested_at": None, "reported_at": None, "latency_s": None,
+                              "error": None, "job_id": None} for cid in clinics}
+        self.quorum_reached = asyncio.Event()
+
+    def reported(self):
+        return [cid for cid, c in self.clinics.items() if c["status"] == "reported"]
+
+    def to_dict(self):
+        now = self.finished_at or time.time()
+        latencies = [c["latency_s"] for c in self.clinics.values() if c["latency_s"] is not None]
+        fastest = min(latencies) if latencies else None
+        clinics = {cid: {**c, "lag_s": None if c["latency_s"] is None else c["latency_s"] - fastest}
+                   for cid, c in self.clinics.items()}
+        return {"round_id": self.round_id, "status": self.status, "error": self.error, "strategy": self.strategy,
+                "base_version": self.base_version, "version": self.version, "quorum": self.quorum,
+                "reported": len(self.reported()), "deadline_seconds": self.deadline_seconds,
+                "started_at": self.started_at, "finished_at": self.finished_at,
+                "wall_clock_s": now - self.started_at,
+                "time_to_quorum_s": None if self.quorum_at is None else self.quorum_at - self.started_at,
+                "clinics": clinics}
+
+class AsyncSession:
+    """An async / buffered run: clinics train continuously until `target_updates` versions are published."""
+
+    def __init__(self, round_id, clinics, target_updates, deadline_seconds, mode):
+        self.round_id = round_id
+        self.mode = mode
+        self.base_version = read_model_version()
+        self.target_updates = target_updates
+        self.deadline_seconds = deadline_seconds
+        self.status = "starting"  # -> running -> done | failed
+        self.error = None
+        self.versions = []  # Global model versions published during the session
+        self.started_at = time.time()
+        self.finished_at = None
+        self.clinics = {cid: {"status": "pending", "requested_at": None, "reported_at": None, "error": None,
+                              "job_id": None, "updates": 0, "latencies": [], "staleness": []} for cid in clinics}
+        self.finished = asyncio.Event()
+
+    def to_dict(self):
+        now = self.finished_at or time.time()
+        clinics = {}
+        for cid, c in self.clinics.items():
+            latencies, staleness = c["latencies"], c["staleness"]
+            clinics[cid] = {"status": c["status"], "error": c["error"], "job_id": c["job_id"], "updates": c["updates"],
+                            "mean_latency_s": sum(latencies) / len(latencies) if latencies else None,
+                            "mean_staleness": sum(staleness) / len(staleness) if staleness else None,
+                            "max_staleness": max(staleness) if staleness else None}
+        return {"round_id": self.round_id, "mode": self.mode, "status": self.status, "error": self.error,
+                "base_version": self.base_version, "versions": self.versions, "target_updates": self.target_updates,
+                "deadline_seconds": self.deadline_seconds, "started_at": self.started_at,
+                "finished_at": self.finished_at, "wall_clock_s": now - self.started_at, "clinics": clinics}
+
+class RoundScheduler:
+    """Runs training rounds (or async sessions) one at a time in the server's event loop."""
+
+    def __init__(self):
+        self.current = None
+        self.history = deque(maxlen=ROUND_HISTORY)
+        self.next_id = 1
+        self.task = None
+        self._merges = set()  # Pending merge tasks, referenced so they are not garbage collected
+
+    def busy(self):
+        return self.task is not None and not self.task.done()
+
+    def start(self, num_rounds, quorum, deadline_seconds, strategy):
+        clinics = [cid for cid in EXPECTED_CLIENTS if cid in clinic_registry]
+        if not clinics:
+            raise HTTPException(status_code=400, detail="No registered clinics to train.")
+        self.task = asyncio.create_task(self._run(num_rounds, clinics, quorum, deadline_seconds, strategy))
+        return self.next_id
+
+    async def _run(self, num_rounds, clinics, quorum, deadline_seconds, strategy):
+        if AGGREGATION_MODE != "sync":
+            await self._run_async(num_rounds, clinics, deadline_seconds)
+            return
+        for _ in range(num_rounds):
+            rnd = TrainingRound(self.next_id, clinics, quorum, deadline_seconds, strategy)
+            self.next_id += 1
+            self.current = rnd
+            try:
+                await self._run_round(rnd)
+            except Exception as e:  # Never leave a round hanging in "running"
+                rnd.status, rnd.error = "failed", f"{type(e).__name__}: {e}"
+            rnd.finished_at = time.time()
+            for c in rnd.clinics.values():
+                if c["status"] == "training":
+                    c["status"] = "straggler"
+            self.history.append(rnd)
+            self.current = None
+            ROUNDS.inc(status=rnd.status)
+            observe_stage("round", rnd.finished_at - rnd.started_at)
+            if rnd.quorum_at is not None:
+                observe_stage("round_to_quorum", rnd.quorum_at - rnd.started_at)
+            print(f"Round {rnd.round_id} {rnd.status} in {rnd.finished_at - rnd.started_at:.1f}s "
+                  f"({len(rnd.reported())}/{len(rnd.clinics)} clinics reported)")
+            if rnd.status != "done":
+                break
+
+    async def _run_round(self, rnd):
+        print(f"Round {rnd.round_id}: starting training on {list(rnd.clinics)} from global v{rnd.base_version}")
+        rnd.status = "running"
+        await asyncio.gather(*(self._start_clinic(rnd, cid) for cid in rnd.clinics))
+        # Clinics that never got the job cannot report, so do not wait on them
+        accepted = sum(c["status"] in ("training", "reported") for c in rnd.clinics.values())
+        if accepted < rnd.quorum:
+            rnd.quorum = max(1, accepted)
+        self._check_quorum(rnd)
+
+        remaining = rnd.deadline_seconds - (time.time() - rnd.started_at)
+        if accepted:
+            try:
+                await asyncio.wait_for(rnd.quorum_reached.wait(), timeout=max(0.0, remaining))
+            except asyncio.TimeoutError:
+                print(f"Round {rnd.round_id}: deadline passed with {len(rnd.reported())}/{rnd.quorum} uploads")
+
+        if len(rnd.reported()) < ROUND_MIN_CLIENTS:
+            rnd.status = "failed"
+            rnd.error = f"{len(rnd.reported())} of {len(rnd.clinics)} clinics reported before the deadline."
+            return
+        rnd.status = "aggregating"
+        try:
+            result = await asyncio.to_thread(aggregate_uploads, rnd.strategy)
+        except HTTPException as e:
+            rnd.status, rnd.error = "failed", e.detail
+            return
+        rnd.version = result["version"]
+        rnd.status = "done"
+
+    async def _run_async(self, target_updates, clinics, deadline_seconds):
+        session = AsyncSession(self.next_id, clinics, target_updates, deadline_seconds, AGGREGATION_MODE)
+        self.next_id += 1
+        self.current = session
+        print(f"Session {session.round_id} ({session.mode}): training {list(clinics)} "
+              f"until {target_updates} new global versions")
+        session.status = "running"
+        try:
+            await asyncio.gather(*(self._start_clinic(session, cid) for cid in clinics))
+            if any(c["status"] == "training" for c in session.clinics.values()):
+                await asyncio.wait_for(session.finished.wait(), timeout=deadline_seconds)
+        except asyncio.TimeoutError:
+            print(f"Session {session.round_id}: deadline passed after {len(session.versions)} versions")
+        except Exception as e:
+            session.error = f"{type(e).__name__}: {e}"
+        session.status = "done" if session.versions else "failed"
+        if not session.versions and session.error is None:
+            session.error = "No uploads were merged before the deadline."
+        session.finished_at = time.time()
+        for c in session.clinics.values():
+            if c["status"] == "training":
+                c["status"] = "straggler"
+        self.history.append(session)
+        self.current = None
+        ROUNDS.inc(status=session.status)
+        observe_stage("async_session", session.finished_at - session.started_at)
+        print(f"Session {session.round_id} {session.status}: published {session.versions} "
+              f"in {session.finished_at - session.started_at:.1f}s")
+
+    async def _merge_async(self, clinic_id):
+        """Merges what has arrived, then (during a session) asks the clinic to train on the newest model."""
+        session = self.current if isinstance(self.current, AsyncSession) else None
+        entry = session.clinics.get(clinic_id) if session is not None and session.status == "running" else None
+        if entry is not None:
+            entry["status"], entry["reported_at"] = "reported", time.time()
+            entry["latencies"].append(entry["reported_at"] - (entry["requested_at"] or session.started_at))
+            CLINIC_LATENCY.observe(entry["latencies"][-1], clinic=clinic_id)
+
+        if AGGREGATION_MODE == "async":
+            min_uploads, server_lr = 1, ASYNC_MIXING
+        else:
+            min_uploads, server_lr = ASYNC_BUFFER_SIZE, FEDBUFF_SERVER_LR
+        try:
+            result = await asyncio.to_thread(merge_uploads, min_uploads, server_lr)
+        except Exception as e:
+            print(f"Merging uploads failed: {type(e).__name__}: {e}")
+            result = None
+
+        if session is None or session.status != "running":
+            return
+        if result is not None:
+            session.versions.append(result["version"])
+            for cid, staleness in zip(result["clinics"], result["staleness"]):
+                if cid in session.clinics:
+                    session.clinics[cid]["updates"] += 1
+                    session.clinics[cid]["staleness"].append(staleness)
+            if len(session.versions) >= session.target_updates:
+                session.finished.set()
+                return
+        if entry is not None:
+            entry["status"] = "pending"
+            await self._start_clinic(session, clinic_id)
+
+    async def _start_clinic(self, rnd, clinic_id):
+        entry = rnd.clinics[clinic_id]
+        entry["requested_at"] = time.time()
+        try:
+            response = await asyncio.to_thread(http.post, f"{clinic_registry[clinic_id]}/start-training",
+                                               params={"round_id": rnd.round_id}, timeout=START_TRAINING_TIMEOUT)
+            response.raise_for_status()
+            job = response.json().get("job") or {}
+        except (requests.RequestException, ValueError) as e:
+            print(f"Round {rnd.round_id}: could not start training on {clinic_id}: {e}")
+            if entry["status"] == "pending":
+                entry["status"], entry["error"] = "unreachable", str(e)
+            return
+        entry["job_id"] = job.get("id")
+        if entry["status"] == "pending":
+            entry["status"] = "training"
+
+    async def clinic_status(self, clinic_id):
+        """The clinic's /training-status (job phase, epoch, batch, loss, images/s), or why it could not be read."""
+        try:
+            response = await asyncio.to_thread(http.get, f"{clinic_registry[clinic_id]}/training-status",
+                                               timeout=STATUS_POLL_TIMEOUT)
+            response.raise_for_status()
+            return response.json()
+        except (requests.RequestException, ValueError) as e:
+            return {"state": "unreachable", "error": str(e)}
+
+    def on_upload(self, clinic_id):
+        """Called when a clinic's weights are in place; may complete the current round's quorum."""
+        if AGGREGATION_MODE != "sync":
+            task = asyncio.create_task(self._merge_async(clinic_id))
+            self._merges.add(task)
+            task.add_done_callback(self._merges.discard)
+            return
+        rnd = self.current
+        if not isinstance(rnd, TrainingRound) or rnd.status != "running" or clinic_id not in rnd.clinics:
+            return
+        entry = rnd.clinics[clinic_id]
+        if entry["status"] == "reported":
+            return
+        entry["status"], entry["reported_at"] = "reported", time.time()
+        entry["latency_s"] = entry["reported_at"] - (entry["requested_at"] or rnd.started_at)
+        CLINIC_LATENCY.observe(entry["latency_s"], clinic=clinic_id)
+        print(f"Round {rnd.round_id}: {clinic_id} reported after {entry['latency_s']:.1f}s "
+              f"({len(rnd.reported())}/{rnd.quorum})")
+        self._check_quorum(rnd)
+
+    def _check_quorum(self, rnd):
+        if len(rnd.reported()) >= rnd.quorum and not rnd.quorum_reached.is_set():
+            rnd.quorum_at = time.time()
+            rnd.quorum_reached.set()
+
+    def metrics(self):
+        """Round wall-clock and per-clinic latency over the finished rounds (and async session totals)."""
+        finished = [r.to_dict() for r in self.history if isinstance(r, TrainingRound)]
+        sessions = [s.to_dict() for s in self.history if isinstance(s, AsyncSession)]
+        per_clinic = defaultdict(lambda: {"rounds": 0, "reported": 0, "stragglers": 0, "latencies": [], "lags": []})
+        for r in finished:
+            for cid, c in r["clinics"].items():
+                stats = per_clinic[cid]
+                stats["rounds"] += 1
+                stats["reported"] += c["status"] == "reported"
+                stats["stragglers"] += c["status"] == "straggler"
+                if c["latency_s"] is not None:
+                    stats["latencies"].append(c["latency_s"])
+                    stats["lags"].append(c["lag_s"])
+        clinics = {}
+        for cid, stats in per_clinic.items():
+            latencies, lags = stats.pop("latencies"), stats.pop("lags")
+            clinics[cid] = {**stats,
+                            "mean_latency_s": sum(latencies) / len(latencies) if latencies else None,
+                            "max_latency_s": max(latencies) if latencies else None,
+                            "mean_lag_s": sum(lags) / len(lags) if lags else None}
+        walls = [r["wall_clock_s"] for r in finished]
+        return {"rounds": len(finished), "done": sum(r["status"] == "done" for r in finished),
+                "mean_wall_clock_s": sum(walls) / len(walls) if walls else None,
+                "max_wall_clock_s": max(walls) if walls else None,
+                "last_wall_clock_s": walls[-1] if walls else None,
+                "clinics": clinics,
+                "async_sessions": [{k: s[k] for k in ("round_id", "mode", "status", "versions", "wall_clock_s",
+                                                      "clinics")} for s in sessions]}
+
+rounds = RoundScheduler()
+
+# Read by /metrics at scrape time
+REGISTRY.gauge("netra_global_model_version", "Version of the published global model").set_function(read_model_version)
+REGISTRY.gauge("netra_uploads_waiting", "Client uploads received and not yet aggregated").set_function(
+    lambda: len(list(UPLOAD_DIR.glob("*_weights.pth"))))
+REGISTRY.gauge("netra_uploads_in_progress", "Resumable uploads started and not completed").set_function(
+    lambda: len(list(PARTIAL_DIR.glob("*.json"))))
+REGISTRY.gauge("netra_registered_clinics", "Clinics the server can reach").set_function(lambda: len(clinic_registry))
+REGISTRY.gauge("netra_round_running", "1 while a training round or async session runs").set_function(rounds.busy)
+
+@app.post("/register/{clinic_id}")
+def register_clinic(clinic_id: str, url: str):
+    """Clinics call this on startup with the base URL the server should use to reach them."""
+    if clinic_id not in EXPECTED_CLIENTS:
+        raise HTTPException(status_code=400, detail=f"Invalid clinic_id: {clinic_id}")
+    clinic_registry[clinic_id] = url.rstrip("/")
+    atomic_write_json(CLINIC_REGISTRY_PATH, {cid: u for cid, u in clinic_registry.items() if CLINIC_URLS.get(cid) != u})
+    print(f"Registered {clinic_id} at {clinic_registry[clinic_id]}")
+    return {"clinic_id": clinic_id, "url": clinic_registry[clinic_id]}
+
+@app.get("/clinics")
+def list_clinics():
+    return {"clinics": clinic_registry, "expected": EXPECTED_CLIENTS}
+
+@app.post("/rounds/start")
+async def start_rounds(num_rounds: int = 1, quorum: float = ROUND_QUORUM,
+                       deadline_seconds: float = ROUND_DEADLINE_SECONDS, strategy: Optional[str] = None):
+    """
+    (Admin) Runs `num_rounds` training rounds back to back in the background: each asks
+    all registered clinics to train, aggregates once a `quorum` fraction of them have
+    uploaded (or after `deadline_seconds`) and publishes a new global model version.
+    Stops early if a round fails. 409 while rounds are already running. In the async
+    and buffered AGGREGATION_MODEs this starts one session that keeps the clinics
+    training until `num_rounds` new versions are published or the deadline passes.
+    """
+    if rounds.busy():
+        raise HTTPException(status_code=409, detail=f"Round {rounds.current.round_id} is still running.")
+    if num_rounds < 1 or not 0 < quorum <= 1 or deadline_seconds <= 0:
+        raise HTTPException(status_code=400, detail="Need num_rounds >= 1, 0 < quorum <= 1 and deadline_seconds > 0.")
+    if strategy is not None and strategy not in AGGREGATORS:
+        raise HTTPException(status_code=400, detail=f"strategy must be one of {list(AGGREGATORS)}")
+    first = rounds.start(num_rounds, quorum, deadline_seconds, strategy)
+    return {"status": "Rounds started", "first_round": first, "num_rounds": num_rounds}
+
+@app.get("/rounds")
+def list_rounds():
+    return {"current": rounds.current.to_dict() if rounds.current else None,
+            "history": [r.to_dict() for r in rounds.history]}
+
+def _find_round(round_id):
+    for rnd in [rounds.current, *rounds.history]:
+        if rnd is not None and rnd.round_id == round_id:
+            return rnd
+    raise HTTPException(status_code=404, detail=f"Unknown round: {round_id}")
+
+@app.get("/rounds/{round_id}")
+def get_round(round_id: int):
+    return _find_round(round_id).to_dict()
+
+@app.get("/rounds/{round_id}/progress")
+async def get_round_progress(round_id: int):
+    """Live training progress of the round's clinics, polled from their /training-status concurrently."""
+    rnd = _find_round(round_id)
+    statuses = await asyncio.gather(*(rounds.clinic_status(cid) for cid in rnd.clinics))
+    return {"round_id": round_id, "status": rnd.status, "clinics": dict(zip(rnd.clinics, statuses))}
+
+@app.get("/round-metrics")
+def round_metrics():
+    return rounds.metrics()
 
 if __name__ == "__main__":
     print("Starting central server on port 8000...")
@@ -0,0 +1,190 @@
+"""
+Time-to-accuracy simulation of the sync, async and buffered aggregation modes.
+
+Runs several in-process clinics that train the real model at different speeds and
+feeds their uploads through central_server's own aggregation code: aggregate_uploads
+for synchronous rounds, merge_uploads for the async and buffered modes. The clinics
+train on small synthetic images so the whole run fits on a CPU, and time is
+simulated: a clinic with speed 4 takes four time units per local update where a
+speed-1 clinic takes one. The report is the global model's test accuracy over
+simulated time, and when each mode first reaches --target accuracy. Run from this
+directory:
+
+    python simulate_async.py
+    python simulate_async.py --speeds 1 1 2 8 --time-budget 60 --modes sync buffered --json
+"""
+import argparse
+import contextlib
+import heapq
+import json
+import os
+import sys
+import tempfile
+
+import torch
+import torch.nn as nn
+
+# central_server creates ./uploads and ./global_model on import; create them in a
+# throwaway directory rather than wherever this is run from (simulate() uses its own)
+with tempfile.TemporaryDirectory(prefix="fl-sim-import-") as _import_dir:
+    _cwd = os.getcwd()
+    os.chdir(_import_dir)
+    try:
+        import central_server as cs
+    finally:
+        os.chdir(_cwd)
+
+
+def synthetic_dataset(num_samples, image_size, noise, generator, patterns):
+    """Each class is a fixed low-resolution colour pattern, upsampled and buried in noise."""
+    labels = torch.randint(len(patterns), (num_samples,), generator=generator)
+    images = nn.functional.interpolate(patterns[labels], size=image_size, mode="nearest")
+    return images + noise * torch.randn(images.shape, generator=generator), labels
+
+
+class SimulatedClinic:
+    def __init__(self, clinic_id, speed, data, args):
+        self.clinic_id = clinic_id
+        self.speed = speed
+        self.images, self.labels = data
+        self.args = args
+
+    def train(self, seed):
+        """One local update on the current global model; returns (base version, trained state dict)."""
+        base_version = cs.read_model_version()
+        model = cs.get_model(cs.NUM_CLASSES)
+        model.load_state_dict(torch.load(cs.GLOBAL_MODEL_PATH, map_location="cpu", weights_only=True))
+        model.train()
+        optimizer = torch.optim.SGD(model.parameters(), lr=self.args.lr, momentum=0.9)
+        criterion = nn.CrossEntropyLoss()
+        generator = torch.Generator().manual_seed(seed)
+        for _ in range(self.args.local_epochs):
+            order = torch.randperm(len(self.labels), generator=generator)
+            for batch in order.split(self.args.batch_size):
+                optimizer.zero_grad()
+                criterion(model(self.images[batch]), self.labels[batch]).backward()
+                optimizer.step()
+        return base_version, model.state_dict()
+
+    def upload(self, base_version, state_dict):
+        """What the upload endpoints leave behind: the weights plus their metadata."""
+        path = cs._upload_path(self.clinic_id)
+        cs._write_metadata(path, self.clinic_id, len(self.labels), base_version)
+        cs.atomic_save(state_dict, path)
+
+
+def evaluate(test_set):
+    model = cs.get_model(cs.NUM_CLASSES)
+    model.load_state_dict(torch.load(cs.GLOBAL_MODEL_PATH, map_location="cpu", weights_only=True))
+    model.eval()
+    images, labels = test_set
+    with torch.no_grad():
+        predictions = torch.cat([model(chunk).argmax(dim=1) for chunk in images.split(256)])
+    return float((predictions == labels).float().mean())
+
+
+def run_sync(clinics, test_set, budget):
+    """Synchronous rounds: every round lasts as long as its slowest clinic."""
+    curve, now, seed = [], 0.0, 0
+    round_time = max(c.speed for c in clinics)
+    while now + round_time <= budget:
+        for clinic in clinics:
+            seed += 1
+            clinic.upload(*clinic.train(seed))
+        now += round_time
+        result = cs.aggregate_uploads("fedavg")
+        curve.append({"time": now, "version": result["version"], "accuracy": evaluate(test_set)})
+    return curve
+
+
+def run_async(clinics, test_set, budget, min_uploads, server_lr):
+    """Each clinic starts its next update on the newest global model as soon as its upload is handled."""
+    curve, events, seed = [], [], 0
+    for i, clinic in enumerate(clinics):
+        seed += 1
+        heapq.heappush(events, (clinic.speed, i, *clinic.train(seed)))
+    while events:
+        now, i, base_version, state_dict = heapq.heappop(events)
+        if now > budget:
+            break
+        clinics[i].upload(base_version, state_dict)
+        result = cs.merge_uploads(min_uploads, server_lr)
+        if result is not None:
+            curve.append({"time": now, "version": result["version"], "staleness": result["staleness"],
+                          "accuracy": evaluate(test_set)})
+        seed += 1
+        heapq.heappush(events, (now + clinics[i].speed, i, *clinics[i].train(seed)))
+    return curve
+
+
+def simulate(mode, clinics, test_set, initial_state, args):
+    with tempfile.TemporaryDirectory(prefix=f"fl-sim-{mode}-") as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)  # central_server's directories are relative to the working directory
+        cs.AGGREGATION_MODE = mode  # Decides whether uploads share a slot per clinic or are kept per arrival
+        try:
+            for d in (cs.MODEL_DIR, cs.UPLOAD_DIR, cs.PARTIAL_DIR, cs.CLAIMED_DIR):
+                d.mkdir(parents=True, exist_ok=True)
+            cs.publish_global_model(initial_state, 0)
+            start = [{"time": 0.0, "version": 0, "accuracy": evaluate(test_set)}]
+            with contextlib.redirect_stdout(sys.stderr):  # Keep the server's progress out of the report
+                if mode == "sync":
+                    curve = run_sync(clinics, test_set, args.time_budget)
+                elif mode == "async":
+                    curve = run_async(clinics, test_set, args.time_budget, 1, cs.ASYNC_MIXING)
+                else:
+                    curve = run_async(clinics, test_set, args.time_budget, args.buffer_size, cs.FEDBUFF_SERVER_LR)
+        finally:
+            os.chdir(cwd)
+    curve = start + curve
+    reached = next((p["time"] for p in curve if p["accuracy"] >= args.target), None)
+    return {"mode": mode, "versions": curve[-1]["version"], "final_accuracy": curve[-1]["accuracy"],
+            "best_accuracy": max(p["accuracy"] for p in curve), "time_to_target": reached, "curve": curve}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--modes", nargs="+", default=("sync", "async", "buffered"),
+                        choices=("sync", "async", "buffered"))
+    parser.add_argument("--speeds", type=float, nargs="+", default=(1, 1, 4),
+                        help="Simulated time per local update, one value per clinic")
+    parser.add_argument("--time-budget", type=float, default=16)
+    parser.add_argument("--target", type=float, default=0.9, help="Test accuracy for time-to-accuracy")
+    parser.add_argument("--buffer-size", type=int, default=2, help="Uploads per merge in buffered mode")
+    parser.add_argument("--samples-per-clinic", type=int, default=96)
+    parser.add_argument("--image-size", type=int, default=32)
+    parser.add_argument("--noise", type=float, default=3.0)
+    parser.add_argument("--local-epochs", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--lr", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print a machine-readable report")
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(args.seed)
+    patterns = torch.randn(cs.NUM_CLASSES, 3, 4, 4, generator=generator)
+    clinics = [SimulatedClinic(f"clinic_{i + 1}", speed,
+                               synthetic_dataset(args.samples_per_clinic, args.image_size, args.noise, generator,
+                                                 patterns), args)
+               for i, speed in enumerate(args.speeds)]
+    test_set = synthetic_dataset(512, args.image_size, args.noise, generator, patterns)
+    torch.manual_seed(args.seed)
+    initial_state = cs.get_model(cs.NUM_CLASSES).state_dict()
+
+    results = []
+    for mode in args.modes:
+        torch.manual_seed(args.seed)
+        result = simulate(mode, clinics, test_set, initial_state, args)
+        results.append(result)
+        if not args.json:
+            reached = "never" if result["time_to_target"] is None else f"t={result['time_to_target']:g}"
+            print(f"{mode:<9} versions={result['versions']:<3} final acc={result['final_accuracy']:.3f} "
+                  f"best={result['best_accuracy']:.3f} reached {args.target:.0%} {reached}")
+
+    if args.json:
+        print(json.dumps({"speeds": list(args.speeds), "time_budget": args.time_budget, "target": args.target,
+                          "results": results}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+"""
+Data loading benchmark for clinic training: images/second of the original loader
+(ImageFolder decoding full-resolution JPEGs every epoch, NUM_WORKERS = 16) against
+the memory-mapped image cache with auto-sized, persistent workers. No model is run,
+so this is the most the loader can feed the training loop. Run from this directory:
+
+    python bench_dataloader.py --synthetic 256
+    python bench_dataloader.py --data-dir ./clinic_1_data --epochs 3 --json
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader
+from torchvision import datasets
+
+import clinic_server
+from clinic_server import (BATCH_SIZE, CachedImageDataset, build_image_cache, cached_train_transform,
+                           make_train_loader, num_loader_workers, train_transform)
+
+
+def write_synthetic_images(folder, count, size, num_classes=clinic_server.NUM_CLASSES):
+    """Smooth random colour fields saved as JPEGs, roughly as costly to decode as fundus photos."""
+    rng = np.random.default_rng(0)
+    for i in range(count):
+        class_dir = Path(folder) / f"class_{i % num_classes}"
+        class_dir.mkdir(parents=True, exist_ok=True)
+        small = Image.fromarray(rng.integers(0, 256, (32, 32, 3), dtype=np.uint8))
+        small.resize((size, size), Image.BICUBIC).save(class_dir / f"{i:05d}.jpg", quality=90)
+
+
+def measure(loader, epochs):
+    """Images/second for each pass over `loader`; the first includes worker start-up."""
+    rates = []
+    for _ in range(epochs):
+        start, seen = time.perf_counter(), 0
+        for imgs, _ in loader:
+            seen += imgs.shape[0]
+        rates.append(seen / (time.perf_counter() - start))
+    return rates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--data-dir", help="ImageFolder to read (default: generate --synthetic images)")
+    parser.add_argument("--synthetic", type=int, default=256, help="Number of synthetic images to generate")
+    parser.add_argument("--synthetic-size", type=int, default=2048, help="Side of the synthetic images")
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--legacy-workers", type=int, default=16, help="Workers of the original loader")
+    parser.add_argument("--json", action="store_true", help="Print a machine-readable report")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="clinic-loader-bench-") as tmp:
+        data_dir = args.data_dir
+        if data_dir is None:
+            data_dir = Path(tmp) / "data"
+            write_synthetic_images(data_dir, args.synthetic, args.synthetic_size)
+        folder = datasets.ImageFolder(str(data_dir), transform=train_transform)
+
+        legacy = DataLoader(folder, batch_size=BATCH_SIZE, shuffle=True, num_workers=args.legacy_workers)
+        legacy_rates = measure(legacy, args.epochs)
+        del legacy
+
+        cache_dir = Path(tmp) / "cache"
+        start = time.perf_counter()
+        build_image_cache(folder.samples, folder.classes, cache_dir)
+        build_seconds = time.perf_counter() - start
+        cached_rates = measure(make_train_loader(CachedImageDataset(cache_dir, cached_train_transform)),
+                               args.epochs)
+
+    report = {"images": len(folder), "epochs": args.epochs, "cores": clinic_server.available_cores(),
+              "torch_threads": torch.get_num_threads(),
+              "imagefolder": {"workers": args.legacy_workers, "images_per_second": legacy_rates},
+              "cache": {"workers": num_loader_workers(), "build_seconds": build_seconds,
+                        "images_per_second": cached_rates}}
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{len(folder)} images, {report['cores']} cores")
+    print(f"imagefolder ({args.legacy_workers} workers): " + ", ".join(f"{r:7.1f}" for r in legacy_rates) + " img/s")
+    print(f"cache ({num_loader_workers()} workers):        " + ", ".join(f"{r:7.1f}" for r in cached_rates)
+          + f" img/s  (built in {build_seconds:.1f}s)")
+    speedup = np.mean(cached_rates[1:] or cached_rates) / np.mean(legacy_rates[1:] or legacy_rates)
+    print(f"Steady-state speedup: {speedup:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
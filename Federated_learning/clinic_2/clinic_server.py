@@ -1,36 +1,96 @@
+import time
+_IMPORT_START = time.perf_counter()  # Startup timings are measured from here
 import os
+import json
+import hashlib
+import functools
+import math
+import zlib
 from pathlib import Path
-import time
 import copy
+import contextlib
+import queue
 import random
+import sys
+import threading
+import asyncio
+import multiprocessing
 import requests  # Use requests to communicate with the central server
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import uvicorn
-from fastapi import FastAPI, BackgroundTasks, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import StreamingResponse
+from typing import Optional
 
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
 import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
-from torchvision import transforms, models, datasets
+# torchvision (which pulls in torch._dynamo) is imported where first used: only the
+# training process needs it, not the API process answering the central server
 from tqdm import tqdm
 
+_REPO_ROOT = str(Path(__file__).resolve().parents[2])  # For the shared netra_shared package
+if _REPO_ROOT not in sys.path:
+    sys.path.insert(0, _REPO_ROOT)
+from netra_shared.delta_codec import apply_delta, decode_delta, encode_delta, state_delta
+from netra_shared.files import atomic_write
+from netra_shared.instrumentation import REGISTRY, Profiler, instrument_app, observe_stage, stage
+
 # --- Configuration ---
 CLINIC_ID = "clinic_2"  # IMPORTANT: Each clinic MUST change this
 DATA_DIR = Path("./clinic_2_data")  # Path to this clinic's local data
 CENTRAL_SERVER_URL = "http://127.0.0.1:8000"  # URL of the central server
+CLINIC_PORT = 8002  # Each clinic on the same machine needs its own port
+CLINIC_URL = f"http://127.0.0.1:{CLINIC_PORT}"  # Where the central server can reach this clinic
 
 # Local paths
 MODEL_DIR = Path("./models")
 GLOBAL_MODEL_PATH = MODEL_DIR / "global_model.pth"
 OUTPUT_WEIGHTS_PATH = MODEL_DIR / f"{CLINIC_ID}_weights.pth"
+GLOBAL_VERSION_PATH = MODEL_DIR / "global_version.json"  # Server version of GLOBAL_MODEL_PATH
+RESIDUAL_PATH = MODEL_DIR / f"{CLINIC_ID}_residual.pth"  # Error feedback carried between lossy uploads
+DOWNLOAD_DELTA_PATH = MODEL_DIR / "global_delta.bin"
+UPLOAD_DELTA_PATH = MODEL_DIR / f"{CLINIC_ID}_delta.bin"
+
+# Transfers to/from the central server
+TRANSFER_CHUNK_SIZE = 4 * 1024 * 1024  # Bytes per upload request and per download write
+TRANSFER_RETRIES = 5  # Times an interrupted transfer is resumed before giving up
+REGISTER_ATTEMPTS = 20  # Tries to register at startup, backing off up to 30s apart (about 8 minutes in all)
+HTTP_TIMEOUT = (10, 300)  # (connect, read) seconds
+
+# Model exchange: send weight deltas against the global version instead of whole .pth files
+USE_DELTA_EXCHANGE = True
+DELTA_DTYPE = "fp16"  # Upload quantization: "fp32" (lossless), "fp16" or "int8"
+DELTA_TOPK_RATIO = None  # e.g. 0.01 to upload only the largest 1% of each tensor's changes
+DELTA_COMPRESSION = "zlib"  # "none", "zlib" or "zstd"
+DOWNLOAD_DELTA_DTYPE = "fp16"  # Precision of the global model deltas we download
 
 # Training parameters
 BATCH_SIZE = 32
 EPOCHS = 15  # Train for 1-5 epochs per round in FL
 LR = 1e-4
-NUM_WORKERS = 16
 INPUT_SIZE = 224
+
+# Data loading
+NUM_WORKERS = None  # DataLoader worker processes; None: one per available core, less one for training
+PREFETCH_FACTOR = 4  # Batches each worker prepares ahead
+USE_IMAGE_CACHE = True  # Decode and downscale the images once into a memory-mapped uint8 array
+CACHE_DIR = Path("./image_cache")  # Rebuilt automatically when the files in DATA_DIR change
+CACHE_IMAGE_SIZE = 256  # Side of the cached (center-cropped) square images that augmentation crops from
+
+# Training modes (see the per-epoch throughput in /training-report to pick what fits the machine)
+AUTOCAST_DTYPE = None  # torch.bfloat16 for mixed precision (fast on CPUs with AVX512-BF16 / AMX); None for fp32
+CHANNELS_LAST = False  # NHWC memory layout, often faster for convolutions on CPU
+TRAINABLE_LAYERS = None  # e.g. ("layer4", "fc") to fine-tune only those and freeze the rest; None trains all
+GRAD_ACCUM_STEPS = 1  # Batches per optimizer step, for an effective batch of BATCH_SIZE * GRAD_ACCUM_STEPS
+VAL_FRACTION = 0.0  # Share of the local images held out for early stopping; 0 trains on all of them
+EARLY_STOPPING_PATIENCE = 2  # Epochs without a better validation loss before the round's training stops
+PROGRESS_EVERY = 10  # Batches between progress updates (each one waits for the metrics)
+TRAINING_REPORT_PATH = MODEL_DIR / "training_report.json"  # Per-epoch metrics of the last round
+PROFILE_DIR = Path("./profiles")  # Traces of training batches captured by POST /admin/profile
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 # Ensure model directory exists
@@ -40,132 +100,955 @@ MODEL_DIR.mkdir(parents=True, exist_ok=True)
 NUM_CLASSES = 6  # This should be a fixed, shared config
 
 def get_model(num_classes):
+    from torchvision import models
     model = models.resnet18(weights=models.ResNet18_Weights.IMAGENET1K_V1)
     model.fc = nn.Linear(model.fc.in_features, num_classes)
     return model
 
-train_transform = transforms.Compose([
-    transforms.RandomResizedCrop(INPUT_SIZE),
-    transforms.RandomHorizontalFlip(),
-    transforms.RandomRotation(8),
-    transforms.ToTensor(),
-    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-])
+@functools.lru_cache(maxsize=None)
+def _transforms():
+    from torchvision import transforms
+    return {
+        "train": transforms.Compose([
+            transforms.RandomResizedCrop(INPUT_SIZE),
+            transforms.RandomHorizontalFlip(),
+            transforms.RandomRotation(8),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        ]),
+        "eval": transforms.Compose([
+            transforms.Resize(INPUT_SIZE),
+            transforms.CenterCrop(INPUT_SIZE),
+            transforms.ToTensor(),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        ]),
+        # The same transforms for the CxHxW uint8 tensors from the image cache
+        "cached_train": transforms.Compose([
+            transforms.RandomResizedCrop(INPUT_SIZE, antialias=True),
+            transforms.RandomHorizontalFlip(),
+            transforms.RandomRotation(8),
+            transforms.ConvertImageDtype(torch.float32),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        ]),
+        "cached_eval": transforms.Compose([
+            transforms.Resize(INPUT_SIZE, antialias=True),
+            transforms.CenterCrop(INPUT_SIZE),
+            transforms.ConvertImageDtype(torch.float32),
+            transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+        ]),
+    }
+
+def train_transform(img):
+    return _transforms()["train"](img)
+
+def eval_transform(img):
+    return _transforms()["eval"](img)
+
+def cached_train_transform(img):
+    return _transforms()["cached_train"](img)
+
+def cached_eval_transform(img):
+    return _transforms()["cached_eval"](img)
 
 # --- Helper Functions for Server Communication ---
 
+def _make_session():
+    """One pooled keep-alive session for every call to the central server."""
+    session = requests.Session()
+    # Transparently retry failed connects and gateway errors on idempotent GETs; data
+    # transfers resume themselves below, from the offset the server reports
+    retry = Retry(total=3, connect=3, read=0, backoff_factor=0.5, status_forcelist=(502, 503, 504),
+                  allowed_methods=frozenset({"GET"}))
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+http = _make_session()
+
+# Failures worth resuming a transfer after; HTTP errors from the server are final
+TRANSIENT_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    requests.exceptions.ChunkedEncodingError)
+
+def atomic_save(obj, path):
+    atomic_write(path, lambda f: torch.save(obj, f))
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(TRANSFER_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _backoff(attempt, what, e):
+    delay = min(2 ** attempt, 30)
+    print(f"{what} interrupted ({e}); resuming in {delay}s (attempt {attempt + 1}/{TRANSFER_RETRIES})...")
+    time.sleep(delay)
+
+def download_file(url, dest, params=None):
+    """
+    Streams `url` to `dest` in chunks through a `.part` file. After a dropped connection
+    it resumes with Range / If-Range (so a changed file starts over rather than being
+    spliced), verifies the server's X-Checksum-SHA256 and renames the file into place.
+    Returns the response; nothing is written for a 204.
+    """
+    part = dest.with_name(dest.name + ".part")
+    etag_path = dest.with_name(dest.name + ".part.etag")
+    for attempt in range(TRANSFER_RETRIES):
+        headers = {}
+        if part.exists() and etag_path.exists():
+            headers = {"Range": f"bytes={part.stat().st_size}-", "If-Range": etag_path.read_text()}
+        try:
+            with http.get(url, params=params, headers=headers, stream=True, timeout=HTTP_TIMEOUT) as r:
+                if r.status_code == 416:  # The .part file is already complete (or bogus): start over
+                    part.unlink(missing_ok=True)
+                    etag_path.unlink(missing_ok=True)
+                    continue
+                r.raise_for_status()
+                if r.status_code == 204:
+                    return r
+                if "ETag" in r.headers:
+                    etag_path.write_text(r.headers["ETag"])
+                with open(part, "ab" if r.status_code == 206 else "wb") as f:
+                    for chunk in r.iter_content(TRANSFER_CHUNK_SIZE):
+                        f.write(chunk)
+                    f.flush()
+                    os.fsync(f.fileno())
+            expected = r.headers.get("X-Checksum-SHA256")
+            if expected and file_sha256(part) != expected:
+                part.unlink()
+                etag_path.unlink(missing_ok=True)
+                raise requests.exceptions.ChunkedEncodingError("checksum mismatch")
+            os.replace(part, dest)
+            etag_path.unlink(missing_ok=True)
+            return r
+        except TRANSIENT_ERRORS as e:
+            _backoff(attempt, f"Download of {url}", e)
+    raise requests.exceptions.RetryError(f"Giving up on {url} after {TRANSFER_RETRIES} attempts.")
+
+def upload_file(kind, path, params):
+    """
+    Uploads the file at `path` through the server's resumable /uploads API, in
+    TRANSFER_CHUNK_SIZE pieces. After a dropped connection the upload is reopened and
+    continues from the offset the server already has, instead of from zero.
+    """
+    size, digest = path.stat().st_size, file_sha256(path)
+    start_params = {"kind": kind, "size": size, "sha256": digest, **params}
+    for attempt in range(TRANSFER_RETRIES):
+        try:
+            r = http.post(f"{CENTRAL_SERVER_URL}/uploads/{CLINIC_ID}", params=start_params, timeout=HTTP_TIMEOUT)
+            r.raise_for_status()
+            upload_id, offset = r.json()["upload_id"], r.json()["offset"]
+            with open(path, "rb") as f:
+                while offset < size:
+                    f.seek(offset)
+                    r = http.put(f"{CENTRAL_SERVER_URL}/uploads/{upload_id}", params={"offset": offset},
+                                 data=f.read(TRANSFER_CHUNK_SIZE), timeout=HTTP_TIMEOUT)
+                    if r.status_code == 409:  # Server is elsewhere (e.g. it got a chunk whose reply we lost)
+                        offset = int(r.headers["Upload-Offset"])
+                        continue
+                    r.raise_for_status()
+                    offset = r.json()["offset"]
+            r = http.post(f"{CENTRAL_SERVER_URL}/uploads/{upload_id}/complete", timeout=HTTP_TIMEOUT)
+            r.raise_for_status()
+            return r.json()
+        except TRANSIENT_ERRORS as e:
+            _backoff(attempt, f"Upload of {path.name}", e)
+    raise requests.exceptions.RetryError(f"Giving up on uploading {path.name} after {TRANSFER_RETRIES} attempts.")
+
+def _write_local_version(version):
+    atomic_write(GLOBAL_VERSION_PATH, lambda f: f.write(json.dumps({"version": version}).encode("utf-8")))
+
 def download_global_model():
     """Downloads the latest global model from the central server."""
     try:
         url = f"{CENTRAL_SERVER_URL}/download-model"
-        r = requests.get(url)
-        r.raise_for_status()  # Raise an exception for bad status codes
-        with open(GLOBAL_MODEL_PATH, 'wb') as f:
-            f.write(r.content)
+        r = download_file(url, GLOBAL_MODEL_PATH)
+        if "X-Model-Version" in r.headers:
+            _write_local_version(int(r.headers["X-Model-Version"]))
         print(f"Successfully downloaded global model to {GLOBAL_MODEL_PATH}")
         return True
     except requests.exceptions.RequestException as e:
         print(f"Error downloading global model: {e}")
         return False
 
-def upload_local_weights():
-    """Uploads the locally trained weights to the central server."""
+def _read_local_version():
     try:
-        url = f"{CENTRAL_SERVER_URL}/upload-weights/{CLINIC_ID}"
-        with open(OUTPUT_WEIGHTS_PATH, 'rb') as f:
-            files = {'file': (OUTPUT_WEIGHTS_PATH.name, f, 'application/octet-stream')}
-            r = requests.post(url, files=files)
-            r.raise_for_status()
+        with open(GLOBAL_VERSION_PATH) as f:
+            return json.load(f)["version"]
+    except (OSError, ValueError, KeyError):
+        return None
+
+def sync_global_model():
+    """
+    Brings GLOBAL_MODEL_PATH up to the server's current global version by downloading
+    only the delta from the version we already have (or the whole model the first
+    time). Returns the version we are now at, or None on failure.
+    """
+    try:
+        since = _read_local_version() if GLOBAL_MODEL_PATH.exists() else None
+        params = {"dtype": DOWNLOAD_DELTA_DTYPE, "compression": DELTA_COMPRESSION, "clinic_id": CLINIC_ID}
+        if since is not None:
+            params["since"] = since
+        r = download_file(f"{CENTRAL_SERVER_URL}/download-delta", DOWNLOAD_DELTA_PATH, params)
+        version = int(r.headers["X-Model-Version"])
+        if r.status_code == 204:
+            print(f"Global model already at version {version}")
+            return version
+
+        payload = DOWNLOAD_DELTA_PATH.read_bytes()
+        delta = decode_delta(payload)
+        if r.headers.get("X-Delta-Base") == "none":
+            state = delta
+        else:
+            state = apply_delta(torch.load(GLOBAL_MODEL_PATH, map_location="cpu", weights_only=True), delta)
+        atomic_save(state, GLOBAL_MODEL_PATH)
+        _write_local_version(version)
+        DOWNLOAD_DELTA_PATH.unlink(missing_ok=True)
+        print(f"Updated global model to version {version} ({len(payload)} bytes downloaded)")
+        return version
+    except (requests.exceptions.RequestException, ValueError, RuntimeError, zlib.error) as e:
+        print(f"Error syncing global model: {e}")
+        return None
+
+def upload_local_delta(base_version, num_samples=None):
+    """
+    Uploads the change from the global model we trained from, encoded with the delta
+    codec. What quantization and top-k drop this round is remembered and added to the
+    next round's delta (error feedback), so it is delayed rather than lost.
+    """
+    try:
+        trained = torch.load(OUTPUT_WEIGHTS_PATH, map_location="cpu", weights_only=True)
+        base = torch.load(GLOBAL_MODEL_PATH, map_location="cpu", weights_only=True)
+        delta = state_delta(trained, base)
+        lossy = DELTA_DTYPE != "fp32" or bool(DELTA_TOPK_RATIO)
+        if lossy and RESIDUAL_PATH.exists():
+            residual = torch.load(RESIDUAL_PATH, map_location="cpu", weights_only=True)
+            if residual.keys() <= delta.keys():
+                for k, v in residual.items():
+                    delta[k] += v
+        payload = encode_delta(delta, DELTA_DTYPE, DELTA_TOPK_RATIO, DELTA_COMPRESSION)
+        atomic_write(UPLOAD_DELTA_PATH, lambda f: f.write(payload))
+
+        params = {"base_version": base_version}
+        if num_samples:
+            params["num_samples"] = num_samples
+        upload_file("delta", UPLOAD_DELTA_PATH, params)
+
+        if lossy:
+            sent = decode_delta(payload)
+            atomic_save({k: v - sent[k] for k, v in delta.items() if v.is_floating_point()}, RESIDUAL_PATH)
+        UPLOAD_DELTA_PATH.unlink(missing_ok=True)
+        print(f"Successfully uploaded weight delta against version {base_version} ({len(payload)} bytes)")
+        return True
+    except requests.exceptions.RequestException as e:
+        print(f"Error uploading weight delta: {e}")
+        return False
+
+def upload_local_weights(num_samples=None, base_version=None):
+    """
+    Uploads the locally trained weights to the central server, with the number of
+    training images so the server can weight this clinic's update accordingly, and
+    the global version we trained from so it can tell how stale the update is.
+    """
+    try:
+        params = {"num_samples": num_samples} if num_samples else {}
+        if base_version is not None:
+            params["base_version"] = base_version
+        upload_file("weights", OUTPUT_WEIGHTS_PATH, params)
         print(f"Successfully uploaded local weights: {OUTPUT_WEIGHTS_PATH}")
         return True
     except requests.exceptions.RequestException as e:
         print(f"Error uploading weights: {e}")
         return False
 
+# --- Data Loading ---
+# Decoding full-resolution fundus JPEGs dominates CPU training time, and the default
+# loader does it again every epoch. Instead the images are decoded and downscaled once
+# into CACHE_DIR/images.npy, an N x S x S x 3 uint8 array that the loader workers
+# memory-map, so an epoch only pays for the random crop/flip/rotation of small images.
+
+def available_cores():
+    try:
+        return len(os.sched_getaffinity(0))  # Respects CPU pinning / container limits
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def num_loader_workers():
+    return NUM_WORKERS if NUM_WORKERS is not None else min(8, available_cores() - 1)
+
+def _decode_for_cache(path, size):
+    with Image.open(path) as img:
+        img.draft("RGB", (size, size))  # JPEGs decode straight at a reduced scale
+        return np.asarray(ImageOps.fit(img.convert("RGB"), (size, size), Image.BILINEAR))
+
+class _DecodeForCache(torch.utils.data.Dataset):
+    """Decodes image files for build_image_cache, so a DataLoader can spread the work over cores."""
+
+    def __init__(self, paths, size):
+        self.paths = paths
+        self.size = size
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, i):
+        return i, _decode_for_cache(self.paths[i], self.size)
+
+def _collate_cache_batch(batch):
+    indices, images = zip(*batch)
+    return list(indices), np.stack(images)
+
+def _cache_fingerprint(samples, classes, size):
+    entries = []
+    for path, label in samples:
+        stat = os.stat(path)
+        entries.append([path, label, stat.st_size, stat.st_mtime_ns])
+    return hashlib.sha256(json.dumps([classes, size, entries]).encode("utf-8")).hexdigest()
+
+def build_image_cache(samples, classes, cache_dir=CACHE_DIR, size=CACHE_IMAGE_SIZE):
+    """
+    Writes the (path, label) `samples` of an ImageFolder into `cache_dir` as decoded,
+    center-cropped `size` x `size` uint8 images. Does nothing if the cache already
+    matches the files; returns whether it (re)built the cache.
+    """
+    cache_dir = Path(cache_dir)
+    fingerprint = _cache_fingerprint(samples, classes, size)
+    index_path = cache_dir / "index.json"
+    try:
+        with open(index_path) as f:
+            if json.load(f)["fingerprint"] == fingerprint:
+                return False
+    except (OSError, ValueError, KeyError):
+        pass
+
+    print(f"Building image cache for {len(samples)} images in {cache_dir}...")
+    start = time.time()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    index_path.unlink(missing_ok=True)  # The index is written last and marks the cache as complete
+    images = np.lib.format.open_memmap(cache_dir / "images.npy", mode="w+", dtype=np.uint8,
+                                       shape=(len(samples), size, size, 3))
+    loader = DataLoader(_DecodeForCache([p for p, _ in samples], size), batch_size=64,
+                        num_workers=num_loader_workers(), collate_fn=_collate_cache_batch)
+    for indices, batch in loader:
+        images[indices] = batch
+    images.flush()
+    del images
+    np.save(cache_dir / "labels.npy", np.array([label for _, label in samples], dtype=np.int64))
+    atomic_write(index_path, lambda f: f.write(json.dumps(
+        {"fingerprint": fingerprint, "count": len(samples), "size": size, "classes": classes}).encode("utf-8")))
+    print(f"Image cache built in {time.time() - start:.1f}s "
+          f"({(cache_dir / 'images.npy').stat().st_size / 1e6:.0f} MB)")
+    return True
+
+class CachedImageDataset(torch.utils.data.Dataset):
+    """The images of build_image_cache as CxHxW uint8 tensors passed through `transform`."""
+
+    def __init__(self, cache_dir=CACHE_DIR, transform=None):
+        self.cache_dir = Path(cache_dir)
+        with open(self.cache_dir / "index.json") as f:
+            index = json.load(f)
+        self.classes = index["classes"]
+        self.targets = np.load(self.cache_dir / "labels.npy")
+        self.transform = transform
+        self._images = None
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getstate__(self):
+        # Each worker maps the file itself rather than receiving a pickled copy of the array
+        return {**self.__dict__, "_images": None}
+
+    def __getitem__(self, i):
+        if self._images is None:
+            self._images = np.load(self.cache_dir / "images.npy", mmap_mode="r")
+        img = torch.from_numpy(np.array(self._images[i])).permute(2, 0, 1)
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, int(self.targets[i])
+
+def load_dataset(augment=True):
+    """The local images, read from the image cache (refreshed first) when USE_IMAGE_CACHE is set."""
+    from torchvision import datasets
+    # allow_empty: a clinic may have no images of some class, but every class needs its directory so the
+    # labels line up with the global model's outputs
+    folder = datasets.ImageFolder(str(DATA_DIR), transform=train_transform if augment else eval_transform,
+                                  allow_empty=True)
+    if not USE_IMAGE_CACHE:
+        return folder
+    try:
+        build_image_cache(folder.samples, folder.classes, CACHE_DIR)
+        return CachedImageDataset(CACHE_DIR, cached_train_transform if augment else cached_eval_transform)
+    except (OSError, ValueError) as e:
+        print(f"Image cache unavailable ({e}); decoding the images every epoch instead.")
+        return folder
+
+def load_datasets(val_fraction=None):
+    """
+    The (train, validation) split of the local images; validation is None if
+    `val_fraction` (default VAL_FRACTION) is 0. The split is seeded, so the same images
+    are held out every round.
+    """
+    val_fraction = VAL_FRACTION if val_fraction is None else val_fraction
+    train_set = load_dataset(augment=True)
+    num_val = int(round(len(train_set) * val_fraction))
+    if num_val == 0:
+        return train_set, None
+    order = torch.randperm(len(train_set), generator=torch.Generator().manual_seed(0)).tolist()
+    val_set = torch.utils.data.Subset(load_dataset(augment=False), order[:num_val])
+    return torch.utils.data.Subset(train_set, order[num_val:]), val_set
+
+def make_train_loader(dataset):
+    """A shuffling loader whose workers stay alive across epochs and keep PREFETCH_FACTOR batches ready."""
+    workers = num_loader_workers()
+    return DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=True, num_workers=workers,
+                      pin_memory=DEVICE.type == "cuda", persistent_workers=workers > 0,
+                      prefetch_factor=PREFETCH_FACTOR if workers > 0 else None)
+
+def make_eval_loader(dataset):
+    workers = num_loader_workers()
+    return DataLoader(dataset, batch_size=BATCH_SIZE, shuffle=False, num_workers=workers,
+                      pin_memory=DEVICE.type == "cuda", persistent_workers=workers > 0,
+                      prefetch_factor=PREFETCH_FACTOR if workers > 0 else None)
+
 # --- Training Logic (from your notebook) ---
 
-def train_one_epoch(model, loader, criterion, optimizer, device):
+def configure_model(model):
+    """Applies CHANNELS_LAST and TRAINABLE_LAYERS to `model`; returns the parameters to optimize."""
+    if CHANNELS_LAST:
+        model.to(memory_format=torch.channels_last)
+    if TRAINABLE_LAYERS is not None:
+        for name, param in model.named_parameters():
+            param.requires_grad = name.split(".")[0] in TRAINABLE_LAYERS
+    return [p for p in model.parameters() if p.requires_grad]
+
+def set_train_mode(model):
+    """train() for the layers being trained; frozen layers stay in eval so their BatchNorm statistics stay put."""
     model.train()
-    total_loss = 0.0
-    total_correct = 0
+    if TRAINABLE_LAYERS is not None:
+        for name, module in model.named_children():
+            if name not in TRAINABLE_LAYERS:
+                module.eval()
+
+def _autocast(device):
+    return torch.autocast(device_type=device.type, dtype=AUTOCAST_DTYPE, enabled=AUTOCAST_DTYPE is not None)
+
+def _to_device(imgs, labels, device):
+    imgs = imgs.to(device, non_blocking=True)
+    if CHANNELS_LAST:
+        imgs = imgs.contiguous(memory_format=torch.channels_last)
+    return imgs, labels.to(device, non_blocking=True)
+
+def train_one_epoch(model, loader, criterion, optimizer, device, epoch=None):
+    set_train_mode(model)
+    # Sums stay on the device; reading them back waits for the batch, so only the progress bar does it
+    total_loss = torch.zeros((), device=device)
+    total_correct = torch.zeros((), dtype=torch.long, device=device)
     total = 0
     # Wrap loader in tqdm for progress bar in console
     loop = tqdm(loader, desc=f"Clinic {CLINIC_ID} Training", leave=True)
-    
-    for imgs, labels in loop:
-        imgs, labels = imgs.to(device), labels.to(device)
-        optimizer.zero_grad()
-        outputs = model(imgs)
-        loss = criterion(outputs, labels)
-        loss.backward()
-        optimizer.step()
-        
-        preds = outputs.argmax(dim=1)
+
+    start = time.time()
+    optimizer.zero_grad(set_to_none=True)
+    waiting_since = time.perf_counter()
+    for step, (imgs, labels) in enumerate(loop, 1):
+        record_stage("batch_wait", time.perf_counter() - waiting_since)  # Time the loader kept us waiting
+        _poll_commands()
+        with timed_stage("batch_compute"):
+            imgs, labels = _to_device(imgs, labels, device)
+            with _autocast(device):
+                outputs = model(imgs)
+                loss = criterion(outputs, labels)
+            # Average over the batches in this step's group; the last one is short when
+            # GRAD_ACCUM_STEPS does not divide the number of batches
+            group_start = (step - 1) // GRAD_ACCUM_STEPS * GRAD_ACCUM_STEPS
+            (loss / min(GRAD_ACCUM_STEPS, len(loader) - group_start)).backward()
+            if step % GRAD_ACCUM_STEPS == 0 or step == len(loader):
+                optimizer.step()
+                optimizer.zero_grad(set_to_none=True)
+        captured = profiler.step()
+        if captured is not None:
+            report_progress("profile", capture=captured)
+
         total += imgs.size(0)
-        total_loss += loss.item() * imgs.size(0)
-        total_correct += (preds == labels).sum().item()
-        loop.set_postfix(loss=total_loss/total, acc=total_correct/total)
-    
-    avg_loss = total_loss / total
-    avg_acc = total_correct / total
+        total_loss += loss.detach().float() * imgs.size(0)
+        total_correct += (outputs.argmax(dim=1) == labels).sum()
+        if step % PROGRESS_EVERY == 0 or step == len(loader):
+            loss_so_far, acc_so_far = total_loss.item() / total, total_correct.item() / total
+            loop.set_postfix(loss=loss_so_far, acc=acc_so_far)
+            report_progress("batch", epoch=epoch, batch=step, batches=len(loader), loss=loss_so_far,
+                            acc=acc_so_far, images_per_second=total / (time.time() - start))
+        waiting_since = time.perf_counter()
+
+    avg_loss = total_loss.item() / total
+    avg_acc = total_correct.item() / total
     print(f"Training complete. Loss: {avg_loss:.4f}, Acc: {avg_acc:.4f}")
     return avg_loss, avg_acc
 
+def evaluate(model, loader, criterion, device):
+    model.eval()
+    total_loss = torch.zeros((), device=device)
+    total_correct = torch.zeros((), dtype=torch.long, device=device)
+    total = 0
+    with torch.no_grad(), _autocast(device):
+        for imgs, labels in loader:
+            imgs, labels = _to_device(imgs, labels, device)
+            outputs = model(imgs)
+            total += imgs.size(0)
+            total_loss += criterion(outputs, labels).float() * imgs.size(0)
+            total_correct += (outputs.argmax(dim=1) == labels).sum()
+    return total_loss.item() / total, total_correct.item() / total
+
+def training_settings():
+    return {"autocast_dtype": str(AUTOCAST_DTYPE).replace("torch.", "") if AUTOCAST_DTYPE else "float32",
+            "channels_last": CHANNELS_LAST, "trainable_layers": TRAINABLE_LAYERS, "batch_size": BATCH_SIZE,
+            "grad_accum_steps": GRAD_ACCUM_STEPS, "val_fraction": VAL_FRACTION, "loader_workers": num_loader_workers(),
+            "torch_threads": torch.get_num_threads(), "device": str(DEVICE)}
+
 def run_client_training():
-    """The main federated learning task to be run in the background."""
+    """The main federated learning task, run in the training process. Returns whether it uploaded."""
     print(f"--- Starting background training task for {CLINIC_ID} ---")
     
     # 1. Download latest global model
-    if not download_global_model():
+    report_progress("phase", phase="downloading")
+    with timed_stage("download"):
+        if USE_DELTA_EXCHANGE:
+            base_version = sync_global_model()
+            downloaded = base_version is not None
+        else:
+            downloaded = download_global_model()
+            base_version = _read_local_version()
+    if not downloaded:
         print("Failed to download model. Aborting training task.")
-        return
+        report_progress("error", error="Failed to download the global model.")
+        return False
 
     # 2. Load data
-    train_dataset = datasets.ImageFolder(str(DATA_DIR), transform=train_transform)
-    train_loader = DataLoader(train_dataset, batch_size=BATCH_SIZE, shuffle=True, num_workers=NUM_WORKERS)
-    print(f"Data loaded: {len(train_dataset)} images.")
+    report_progress("phase", phase="loading data", base_version=base_version)
+    with timed_stage("load_data"):
+        train_dataset, val_dataset = load_datasets()
+        train_loader = make_train_loader(train_dataset)
+        val_loader = make_eval_loader(val_dataset) if val_dataset is not None else None
+    print(f"Data loaded: {len(train_dataset)} training images, {len(val_dataset) if val_dataset else 0} "
+          f"validation images ({train_loader.num_workers} loader workers).")
     
     # 3. Initialize model and load global weights
-    model = get_model(NUM_CLASSES)
-    model.load_state_dict(torch.load(GLOBAL_MODEL_PATH, map_location=DEVICE))
-    model = model.to(DEVICE)
+    with timed_stage("model_init"):
+        model = get_model(NUM_CLASSES)
+        model.load_state_dict(torch.load(GLOBAL_MODEL_PATH, map_location=DEVICE))
+        model = model.to(DEVICE)
     
     criterion = nn.CrossEntropyLoss()
-    optimizer = torch.optim.Adam(model.parameters(), lr=LR)
+    optimizer = torch.optim.Adam(configure_model(model), lr=LR)
 
-    # 4. Run training
+    # 4. Run training, stopping early once the validation loss stops improving
+    report = {"clinic_id": CLINIC_ID, "base_version": base_version, "settings": training_settings(),
+              "stopped_early": False, "epochs": []}
+    best_loss, best_state, stale_epochs = math.inf, None, 0
+    report_progress("phase", phase="training", epochs=EPOCHS, images=len(train_dataset))
     for epoch in range(EPOCHS):
         print(f"Starting Epoch {epoch+1}/{EPOCHS}")
-        train_loss, train_acc = train_one_epoch(model, train_loader, criterion, optimizer, DEVICE)
+        start = time.time()
+        with timed_stage("train_epoch"):
+            train_loss, train_acc = train_one_epoch(model, train_loader, criterion, optimizer, DEVICE, epoch + 1)
+        seconds = time.time() - start
+        stats = {"epoch": epoch + 1, "train_loss": train_loss, "train_acc": train_acc, "seconds": seconds,
+                 "images_per_second": len(train_dataset) / seconds}
+        if val_loader is not None:
+            with timed_stage("validate"):
+                stats["val_loss"], stats["val_acc"] = evaluate(model, val_loader, criterion, DEVICE)
+        report["epochs"].append(stats)
+        report_progress("epoch", epochs=EPOCHS, **stats)
+        print(f"Epoch {epoch+1}: {stats['images_per_second']:.1f} images/s" +
+              (f", val loss {stats['val_loss']:.4f}, val acc {stats['val_acc']:.4f}" if val_loader else ""))
+
+        if val_loader is not None:
+            if stats["val_loss"] < best_loss:
+                best_loss, stale_epochs = stats["val_loss"], 0
+                best_state = copy.deepcopy(model.state_dict())
+            else:
+                stale_epochs += 1
+                if stale_epochs >= EARLY_STOPPING_PATIENCE:
+                    print(f"Validation loss has not improved for {stale_epochs} epochs; stopping early.")
+                    report["stopped_early"] = True
+                    break
+    if best_state is not None:
+        model.load_state_dict(best_state)  # Upload the epoch that generalized best
+    atomic_write(TRAINING_REPORT_PATH, lambda f: f.write(json.dumps(report, indent=2).encode("utf-8")))
 
     # 5. Save the updated local weights
     print(f"Saving updated weights to {OUTPUT_WEIGHTS_PATH}")
-    torch.save(model.state_dict(), OUTPUT_WEIGHTS_PATH)
-    
+    model.to(memory_format=torch.contiguous_format)
+    with timed_stage("save_weights"):
+        atomic_save(model.state_dict(), OUTPUT_WEIGHTS_PATH)
+
     # 6. Upload local weights to server
-    upload_local_weights()
+    report_progress("phase", phase="uploading")
+    with timed_stage("upload"):
+        if USE_DELTA_EXCHANGE:
+            uploaded = upload_local_delta(base_version, len(train_dataset))
+        else:
+            uploaded = upload_local_weights(len(train_dataset), base_version)
+    if not uploaded:
+        report_progress("error", error="Failed to upload the trained weights.")
     
     print(f"--- Background training task for {CLINIC_ID} complete ---")
+    return uploaded
+
+# --- Training Jobs ---
+# Training runs in its own (spawned) process, so it neither blocks the API nor shares
+# its threads, and can be cancelled by terminating it. The process sends progress
+# events over a queue; a thread in the server folds them into the job's status and
+# forwards them to /training-events subscribers. Only one job runs at a time: a request
+# for the round that is queued, or running and not yet uploading, joins that job; any
+# other request is queued behind the running job, replacing an earlier queued request.
+# Stage timings ride along with the progress events to the server's /metrics, and a
+# second queue carries profile captures armed with POST /admin/profile the other way.
+
+_progress_queue = None  # Set in the training process
+_command_queue = None
+_stage_samples = []  # (stage, seconds) timed in the training process, not yet sent to the server
+profiler = Profiler(PROFILE_DIR)
+
+def report_progress(kind, **fields):
+    """Sends a progress event to the server process; does nothing outside a training job."""
+    if _progress_queue is not None:
+        event = {"type": kind, "time": time.time(), **fields}
+        if _stage_samples:
+            event["stages"] = _stage_samples[:]
+            _stage_samples.clear()
+        _progress_queue.put(event)
+
+def record_stage(name, seconds):
+    """Records a stage timing in this process's metrics, or for the server's if we are a training job."""
+    if _progress_queue is None:
+        observe_stage(name, seconds)
+    else:
+        _stage_samples.append((name, seconds))
+
+@contextlib.contextmanager
+def timed_stage(name):
+    """stage() for code that runs in the training process (also marks the stage in profile traces)."""
+    start = time.perf_counter()
+    with stage(name):
+        yield
+    if _progress_queue is not None:
+        _stage_samples.append((name, time.perf_counter() - start))
+
+def _poll_commands():
+    """Starts a profile capture the server has sent; checked once per training batch."""
+    if _command_queue is None:
+        return
+    try:
+        capture = _command_queue.get_nowait()
+    except queue.Empty:
+        return
+    profiler.start(capture)
+    report_progress("profile", capture=capture)
+
+def _training_process(events, commands):
+    global _progress_queue, _command_queue
+    _progress_queue, _command_queue = events, commands
+    ok = False
+    try:
+        ok = run_client_training()
+    except Exception as e:
+        print(f"Training task failed: {type(e).__name__}: {e}")
+        report_progress("error", error=f"{type(e).__name__}: {e}")
+    finally:
+        captured = profiler.finish()  # The job ran out of batches before the capture did
+        if captured is not None:
+            report_progress("profile", capture=captured)
+        report_progress("finished", ok=bool(ok))
+
+class TrainingJobManager:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = None
+        self.queued = None
+        self.last = None
+        self.process = None
+        self.next_id = 1
+        self.subscribers = {}  # asyncio.Queue -> its event loop
+        self.commands = None  # Queue to the running training process
+        self.pending_profile = None  # Capture armed while no job was running; sent to the next one
+        self.profiling = None  # Id of the capture handed to the running process
+
+    def _new_job(self, round_id):
+        job = {"id": self.next_id, "round_id": round_id, "state": "queued", "requested_at": time.time(),
+               "started_at": None, "finished_at": None, "phase": None, "base_version": None, "epoch": None,
+               "epochs": None, "batch": None, "batches": None, "loss": None, "acc": None,
+               "images_per_second": None, "last_epoch": None, "error": None, "exit_code": None}
+        self.next_id += 1
+        return job
+
+    def request(self, round_id=None):
+        """Starts, joins or queues a job for `round_id`. Returns (job, action)."""
+        with self.lock:
+            for job in (self.current, self.queued):
+                if job is not None and job["phase"] != "uploading" \
+                        and (round_id is None or job["round_id"] in (None, round_id)):
+                    return job, "joined"
+            job = self._new_job(round_id)
+            if self.current is None:
+                self._start(job)
+                return job, "started"
+            if self.queued is not None:
+                self.queued["state"] = "superseded"
+            self.queued = job
+            self._publish({"type": "job", "job": job})
+            return job, "queued"
+
+    def _start(self, job):
+        ctx = multiprocessing.get_context("spawn")
+        events, self.commands = ctx.Queue(), ctx.Queue()
+        if self.pending_profile is not None:
+            self.commands.put(self.pending_profile)
+            self.profiling, self.pending_profile = self.pending_profile["id"], None
+        self.process = ctx.Process(target=_training_process, args=(events, self.commands),
+                                   name=f"{CLINIC_ID}-training-{job['id']}")
+        self.process.start()
+        job["state"], job["started_at"] = "running", time.time()
+        self.current = job
+        threading.Thread(target=self._follow, args=(job, self.process, events), daemon=True).start()
+        self._publish({"type": "job", "job": job})
+        print(f"Started training job {job['id']} (round {job['round_id']}) in process {self.process.pid}")
+
+    def _follow(self, job, process, events):
+        """Applies the training process's events to `job` until it exits, then starts the queued job."""
+        finished = False
+        while not finished:
+            try:
+                event = events.get(timeout=1.0)
+            except queue.Empty:
+                if not process.is_alive():
+                    break
+                continue
+            for name, seconds in event.pop("stages", ()):
+                observe_stage(name, seconds)
+            with self.lock:
+                finished = self._apply(job, event)
+                self._publish({**event, "job_id": job["id"]})
+        process.join()
+        with self.lock:
+            if self.profiling is not None:  # The process died with a capture running
+                profiler.update({"id": self.profiling, "state": "failed", "finished_at": time.time(),
+                                 "error": f"Training process exited with code {process.exitcode}."})
+                self.profiling = None
+            self.commands = None
+            job["exit_code"], job["finished_at"] = process.exitcode, time.time()
+            if job["state"] == "running":
+                job["state"] = "succeeded" if job.get("ok") else "failed"
+                if job["error"] is None and not finished:
+                    job["error"] = f"Training process exited with code {process.exitcode}."
+            TRAINING_JOBS.inc(state=job["state"])
+            self.last, self.current, self.process = job, None, None
+            self._publish({"type": "job", "job": job})
+            print(f"Training job {job['id']} {job['state']}")
+            if self.queued is not None:
+                job, self.queued = self.queued, None
+                self._start(job)
+
+    def _apply(self, job, event):
+        kind = event["type"]
+        if kind == "phase":
+            job["phase"] = event["phase"]
+            for key in ("base_version", "epochs"):
+                if key in event:
+                    job[key] = event[key]
+        elif kind == "batch":
+            for key in ("epoch", "batch", "batches", "loss", "acc", "images_per_second"):
+                job[key] = event[key]
+        elif kind == "epoch":
+            job["last_epoch"] = {k: v for k, v in event.items() if k not in ("type", "time")}
+        elif kind == "error":
+            job["error"] = event["error"]
+        elif kind == "profile":
+            profiler.update(event["capture"])
+            if event["capture"]["state"] not in ("armed", "capturing"):
+                self.profiling = None
+        elif kind == "finished":
+            job["ok"] = event["ok"]
+            return True
+        return False
+
+    def cancel(self):
+        """Drops the queued job and terminates the running one. Returns the cancelled jobs."""
+        with self.lock:
+            cancelled = []
+            if self.queued is not None:
+                self.queued["state"] = "cancelled"
+                cancelled.append(self.queued)
+                self.queued = None
+            if self.current is not None and self.process is not None:
+                self.current["state"] = "cancelled"
+                self.process.terminate()  # Its DataLoader workers exit when they notice it is gone
+                cancelled.append(self.current)
+            return cancelled
+
+    def profile(self, capture):
+        """Hands a capture armed by POST /admin/profile to the running training process, or the next one."""
+        with self.lock:
+            if self.commands is not None:
+                self.commands.put(capture)
+                self.profiling = capture["id"]
+            else:
+                self.pending_profile = capture
+
+    def status(self):
+        with self.lock:
+            return {"clinic_id": CLINIC_ID, "state": self.current["state"] if self.current else "idle",
+                    "job": self.current, "queued": self.queued, "last": self.last}
+
+    def subscribe(self, loop):
+        events = asyncio.Queue(maxsize=1000)
+        with self.lock:
+            self.subscribers[events] = loop
+        return events
+
+    def unsubscribe(self, events):
+        with self.lock:
+            self.subscribers.pop(events, None)
+
+    def _publish(self, event):
+        """Hands `event` to every subscriber's event loop (called with the lock held, from any thread)."""
+        def put(events, event=json.loads(json.dumps(event))):  # A snapshot, the job keeps changing
+            if not events.full():
+                events.put_nowait(event)
+        for events, loop in self.subscribers.items():
+            loop.call_soon_threadsafe(put, events)
+
+TRAINING_JOBS = REGISTRY.counter("netra_training_jobs_total", "Training jobs finished", ("state",))
+jobs = TrainingJobManager()
 
 # --- FastAPI Application ---
 app = FastAPI()
+# /metrics, per-route request metrics, and /admin/profile capturing the next training batches
+instrument_app(app, profiler, unit="batches", on_arm=jobs.profile)
+
+# Read by /metrics at scrape time
+REGISTRY.gauge("netra_training_running", "1 while a training job runs").set_function(lambda: jobs.current is not None)
+REGISTRY.gauge("netra_training_queued", "1 while a training job waits for the running one").set_function(
+    lambda: jobs.queued is not None)
+REGISTRY.gauge("netra_training_images_per_second", "Training throughput of the running job so far").set_function(
+    lambda: (jobs.current or {}).get("images_per_second") or 0)
 
 @app.get("/")
 def read_root():
     return {"status": "Clinic server is running", "clinic_id": CLINIC_ID}
 
+startup_timings = {"imports_s": round(time.perf_counter() - _IMPORT_START, 3)}
+registered = threading.Event()
+
+def register_with_server():
+    """
+    Tells the central server where to send /start-training for its rounds, retrying with
+    backoff while it is unreachable or failing (the session only retries GETs). If every
+    attempt fails, the server falls back to its CLINIC_URLS entry for this clinic.
+    """
+    for attempt in range(REGISTER_ATTEMPTS):
+        try:
+            response = http.post(f"{CENTRAL_SERVER_URL}/register/{CLINIC_ID}", params={"url": CLINIC_URL},
+                                 timeout=(5, 10))
+            response.raise_for_status()
+            registered.set()
+            print(f"Registered with the central server as {CLINIC_URL}")
+            return
+        except requests.exceptions.RequestException as e:
+            error = e
+            if e.response is not None and e.response.status_code < 500:
+                break  # Rejected, not unavailable: trying again will not help
+            if attempt + 1 < REGISTER_ATTEMPTS:
+                delay = min(2 ** attempt, 30)
+                print(f"Could not register with the central server ({e}); retrying in {delay}s "
+                      f"(attempt {attempt + 1}/{REGISTER_ATTEMPTS})...")
+                time.sleep(delay)
+    print(f"Could not register with the central server ({error}); it will use its configured URL for {CLINIC_ID}.")
+
+@app.on_event("startup")
+def on_startup():
+    # Registration retries against a server that may be down, so it runs beside serving, not before it
+    threading.Thread(target=register_with_server, name="register", daemon=True).start()
+    startup_timings["ready_s"] = round(time.perf_counter() - _IMPORT_START, 3)
+    print(f"Ready to serve. Startup timings: {startup_timings}")
+
+@app.get("/healthz")
+def liveness():
+    """Liveness: the process is up and answering."""
+    return {"status": "alive", "uptime_s": time.perf_counter() - _IMPORT_START}
+
+@app.get("/readyz")
+def readiness():
+    """Readiness: startup has finished, so /start-training can be served. Includes the startup timings."""
+    if "ready_s" not in startup_timings:
+        raise HTTPException(status_code=503, detail={"status": "starting"})
+    return {"status": "ready", "clinic_id": CLINIC_ID, "registered": registered.is_set(), "startup": startup_timings}
+
+@app.get("/training-report")
+def training_report():
+    """Settings and per-epoch loss, accuracy and throughput of the last training round."""
+    if not TRAINING_REPORT_PATH.exists():
+        raise HTTPException(status_code=404, detail="No training round has finished yet.")
+    with open(TRAINING_REPORT_PATH) as f:
+        return json.load(f)
+
+@app.on_event("shutdown")
+def stop_training():
+    jobs.cancel()
+
 @app.post("/start-training")
-def start_training(background_tasks: BackgroundTasks):
+def start_training(round_id: Optional[int] = None):
     """
     Triggers the client to download the global model, train on it,
-    and upload its new weights. Runs in the background.
+    and upload its new weights, in a separate training process. `round_id`
+    is the central server's round, when the server started the training.
+    A request for the round already queued, or running and not yet
+    uploading, joins that job; others are queued behind the running job.
     """
-    print("Received /start-training request. Adding to background tasks.")
-    background_tasks.add_task(run_client_training)
-    return {"status": "Training initiated in background"}
+    print(f"Received /start-training request{f' for round {round_id}' if round_id is not None else ''}.")
+    job, action = jobs.request(round_id)
+    status = {"started": "Training initiated in background", "joined": "Training already in progress",
+              "queued": "Training queued behind the running job"}[action]
+    return {"status": status, "action": action, "job": job}
+
+@app.post("/cancel-training")
+def cancel_training():
+    """Stops the running training job and drops the queued one."""
+    cancelled = jobs.cancel()
+    if not cancelled:
+        raise HTTPException(status_code=409, detail="No training job to cancel.")
+    return {"status": "Cancelled", "jobs": [job["id"] for job in cancelled]}
+
+@app.get("/training-status")
+def training_status():
+    """The running job's phase, epoch, batch, loss, accuracy and images/s, plus the queued and last jobs."""
+    return jobs.status()
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.get("/training-events")
+async def training_events(request: Request):
+    """Server-sent events: the current /training-status, then every progress event as it happens."""
+    events = jobs.subscribe(asyncio.get_running_loop())
+
+    async def stream():
+        try:
+            yield _sse("status", jobs.status())
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(events.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _sse(event["type"], event)
+        finally:
+            jobs.unsubscribe(events)
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 if __name__ == "__main__":
-    print(f"Starting clinic server for {CLINIC_ID} on port 8001...")
+    print(f"Starting clinic server for {CLINIC_ID} on port {CLINIC_PORT}...")
     # Make sure each clinic server runs on a different port if on the same machine
     # e.g., clinic_1 on 8001, clinic_2 on 8002, etc.
-    uvicorn.run(app, host="0.0.0.0", port=8002)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=CLINIC_PORT)
\ No newline at end of file
@@ -0,0 +1,286 @@
+"""
+End-to-end federated training simulator, all in one process.
+
+Loads the central server and N copies of the clinic server, each in its own directory
+under a temporary root, and wires the clinics' pooled `http` session straight into the
+server's ASGI app, so every download, upload and /aggregate goes through the real
+endpoints without sockets or uvicorn. Each round every clinic runs the real
+run_client_training (sync the global model, train_one_epoch, upload the delta) on its
+share of the data, then the server aggregates. The data is either generated (coloured
+class patterns buried in noise) or an existing ImageFolder, split across the clinics
+with Dirichlet label skew: a small --alpha gives each clinic only a few classes, a
+large one approaches an IID split. Reported per round: simulated round time (the
+slowest clinic plus aggregation, as if clinics ran in parallel), per-clinic time,
+aggregation time, bytes transferred each way, peak RSS and test accuracy. Run from
+this directory:
+
+    python simulate_federation.py --clinics 3 --rounds 3
+    python simulate_federation.py --data-dir ./all_fundus --alpha 0.3 --rounds 5 --json
+"""
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import urlsplit
+
+import numpy as np
+import requests
+import torch
+import torch.nn as nn
+from PIL import Image
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+from starlette.testclient import TestClient
+from torch.utils.data import DataLoader
+from torchvision import datasets
+
+HERE = Path(__file__).resolve().parent
+SERVER_SOURCE = HERE / "central_server" / "central_server.py"
+CLINIC_SOURCE = HERE / "clinic_1" / "clinic_server.py"
+
+
+def load_module(name, path):
+    spec = importlib.util.spec_from_file_location(name, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def rss_mb():
+    """Peak RSS of this process (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+class ASGIAdapter(BaseAdapter):
+    """A requests transport adapter that sends requests to an ASGI app through a TestClient, counting bytes."""
+
+    def __init__(self, client):
+        super().__init__()
+        self.client = client
+        self.sent_bytes = 0
+        self.received_bytes = 0
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        body = request.body
+        if hasattr(body, "read"):
+            body = body.read()
+        elif body is not None and not isinstance(body, (bytes, str)):
+            body = b"".join(body)
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        url = urlsplit(request.url)
+        r = self.client.request(request.method, url.path + (f"?{url.query}" if url.query else ""),
+                                content=body, headers=dict(request.headers))
+        self.sent_bytes += len(body or b"")
+        self.received_bytes += len(r.content)
+
+        response = requests.Response()
+        response.status_code = r.status_code
+        response.headers = CaseInsensitiveDict(r.headers)
+        response.raw = io.BytesIO(r.content)
+        response.reason = r.reason_phrase
+        response.url = request.url
+        response.request = request
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+# --- Data ---
+
+def write_synthetic_pool(folder, num_images, num_classes, size, noise, seed):
+    """Each class is a fixed low-resolution colour pattern, upsampled and buried in noise, saved as PNG."""
+    rng = np.random.default_rng(seed)
+    patterns = rng.normal(size=(num_classes, 4, 4, 3))
+    for i in range(num_images):
+        label = i % num_classes
+        pattern = np.kron(patterns[label], np.ones((size // 4, size // 4, 1)))
+        pixels = 128 + 40 * (pattern + noise * rng.normal(size=pattern.shape))
+        class_dir = Path(folder) / f"class_{label}"
+        class_dir.mkdir(parents=True, exist_ok=True)
+        Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8)).save(class_dir / f"{i:05d}.png")
+
+
+def dirichlet_partition(labels, num_clients, alpha, rng):
+    """Splits sample indices over clients, drawing each class's client proportions from Dirichlet(alpha)."""
+    parts = [[] for _ in range(num_clients)]
+    labels = np.asarray(labels)
+    for label in np.unique(labels):
+        indices = rng.permutation(np.flatnonzero(labels == label))
+        cuts = (np.cumsum(rng.dirichlet([alpha] * num_clients))[:-1] * len(indices)).astype(int)
+        for part, chunk in zip(parts, np.split(indices, cuts)):
+            part.extend(chunk.tolist())
+    return parts
+
+
+def link_samples(samples, classes, folder):
+    """An ImageFolder at `folder` holding `samples`, as symlinks; every class gets a directory so labels line up."""
+    for name in classes:
+        (folder / name).mkdir(parents=True, exist_ok=True)
+    for path, label in samples:
+        target = folder / classes[label] / Path(path).name
+        if not target.exists():
+            os.symlink(os.path.abspath(path), target)
+
+
+# --- Federation ---
+
+server_module = None  # The central_server instance, once main() has loaded it
+
+def configure_clinic(clinic, clinic_id, root, data_dir, server_url, args):
+    """Points one clinic module's ids and paths at its own directory and shrinks training to the simulation."""
+    clinic.CLINIC_ID = clinic_id
+    clinic.DATA_DIR = data_dir
+    clinic.MODEL_DIR = root / "models"
+    clinic.MODEL_DIR.mkdir(parents=True, exist_ok=True)
+    clinic.GLOBAL_MODEL_PATH = clinic.MODEL_DIR / "global_model.pth"
+    clinic.OUTPUT_WEIGHTS_PATH = clinic.MODEL_DIR / f"{clinic_id}_weights.pth"
+    clinic.GLOBAL_VERSION_PATH = clinic.MODEL_DIR / "global_version.json"
+    clinic.RESIDUAL_PATH = clinic.MODEL_DIR / f"{clinic_id}_residual.pth"
+    clinic.DOWNLOAD_DELTA_PATH = clinic.MODEL_DIR / "global_delta.bin"
+    clinic.UPLOAD_DELTA_PATH = clinic.MODEL_DIR / f"{clinic_id}_delta.bin"
+    clinic.TRAINING_REPORT_PATH = clinic.MODEL_DIR / "training_report.json"
+    clinic.CACHE_DIR = root / "image_cache"
+    clinic.CENTRAL_SERVER_URL = server_url
+    clinic.EPOCHS = args.local_epochs
+    clinic.BATCH_SIZE = args.batch_size
+    clinic.LR = args.lr
+    clinic.NUM_WORKERS = args.workers
+    clinic.DELTA_DTYPE = args.delta_dtype
+    clinic.PROGRESS_EVERY = 1 << 30  # No progress bars to feed
+    # No pretrained download: start from the server's architecture; the weights come from the global model
+    clinic.get_model = server_module.get_model
+
+
+
+def evaluate_global_model(test_set):
+    model = server_module.get_model(server_module.NUM_CLASSES)
+    model.load_state_dict(torch.load(server_module.GLOBAL_MODEL_PATH, map_location="cpu", weights_only=True))
+    model.eval()
+    criterion = nn.CrossEntropyLoss(reduction="sum")
+    loss, correct, total = 0.0, 0, 0
+    with torch.no_grad():
+        for imgs, labels in DataLoader(test_set, batch_size=64):
+            outputs = model(imgs)
+            loss += float(criterion(outputs, labels))
+            correct += int((outputs.argmax(dim=1) == labels).sum())
+            total += len(labels)
+    return loss / total, correct / total
+
+
+def main():
+    global server_module
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clinics", type=int, default=3)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--data-dir", help="ImageFolder to split across the clinics (default: synthetic data)")
+    parser.add_argument("--images", type=int, default=240, help="Synthetic images in total, before the test split")
+    parser.add_argument("--image-size", type=int, default=64, help="Side of the synthetic images")
+    parser.add_argument("--noise", type=float, default=1.0, help="Noise level of the synthetic images")
+    parser.add_argument("--alpha", type=float, default=1.0, help="Dirichlet label skew; larger is closer to IID")
+    parser.add_argument("--test-fraction", type=float, default=0.2)
+    parser.add_argument("--local-epochs", type=int, default=1)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--lr", type=float, default=1e-3)
+    parser.add_argument("--workers", type=int, default=0, help="DataLoader workers per clinic")
+    parser.add_argument("--strategy", default="fedavg", help="Aggregation strategy for /aggregate")
+    parser.add_argument("--delta-dtype", default="fp16", choices=("fp32", "fp16", "int8"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Print a machine-readable report")
+    args = parser.parse_args()
+    torch.manual_seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+
+    # The services' own progress messages go to stderr, keeping stdout for the report
+    report = sys.stdout
+    with tempfile.TemporaryDirectory(prefix="fl-federation-") as tmp, contextlib.redirect_stdout(sys.stderr):
+        root = Path(tmp)
+        cwd = os.getcwd()
+        try:
+            (root / "server").mkdir()
+            os.chdir(root / "server")  # The server's directories are relative to the working directory
+            server_module = load_module("sim_central_server", SERVER_SOURCE)
+            server = server_module
+            server.EXPECTED_CLIENTS = [f"clinic_{i + 1}" for i in range(args.clinics)]
+            server.publish_global_model(server.get_model(server.NUM_CLASSES).state_dict(), 0)
+
+            # Data: a pool split into a held-out test set and one skewed shard per clinic
+            pool_dir = Path(args.data_dir) if args.data_dir else root / "pool"
+            if args.data_dir is None:
+                write_synthetic_pool(pool_dir, args.images, server.NUM_CLASSES, args.image_size, args.noise, args.seed)
+            pool = datasets.ImageFolder(str(pool_dir))
+            order = rng.permutation(len(pool.samples))
+            num_test = int(len(order) * args.test_fraction)
+            test_samples = [pool.samples[i] for i in order[:num_test]]
+            train_samples = [pool.samples[i] for i in order[num_test:]]
+            shards = dirichlet_partition([label for _, label in train_samples], args.clinics, args.alpha, rng)
+            link_samples(test_samples, pool.classes, root / "test")
+
+            with TestClient(server.app) as client:
+                adapter = ASGIAdapter(client)
+                clinics = []
+                for i, shard in enumerate(shards):
+                    clinic_id = f"clinic_{i + 1}"
+                    clinic = load_module(f"sim_{clinic_id}", CLINIC_SOURCE)
+                    clinic_root = root / clinic_id
+                    data_dir = clinic_root / "data"
+                    link_samples([train_samples[j] for j in shard], pool.classes, data_dir)
+                    configure_clinic(clinic, clinic_id, clinic_root, data_dir, "http://central", args)
+                    clinic.http.mount("http://central", adapter)
+                    counts = np.bincount([train_samples[j][1] for j in shard], minlength=len(pool.classes))
+                    clinics.append((clinic, counts.tolist()))
+                test_set = datasets.ImageFolder(str(root / "test"), transform=clinics[0][0].eval_transform,
+                                                allow_empty=True)
+
+                rounds = []
+                for round_index in range(1, args.rounds + 1):
+                    sent, received = adapter.sent_bytes, adapter.received_bytes
+                    clinic_seconds = {}
+                    for clinic, counts in clinics:
+                        if sum(counts) == 0:
+                            continue  # Skew can leave a clinic without data; it sits the round out
+                        start = time.perf_counter()
+                        with contextlib.redirect_stderr(io.StringIO()):  # Progress bars
+                            ok = clinic.run_client_training()
+                        clinic_seconds[clinic.CLINIC_ID] = time.perf_counter() - start
+                        if not ok:
+                            raise RuntimeError(f"{clinic.CLINIC_ID} failed to train or upload in round {round_index}")
+
+                    start = time.perf_counter()
+                    r = client.post("/aggregate", params={"strategy": args.strategy})
+                    aggregation_seconds = time.perf_counter() - start
+                    r.raise_for_status()
+                    loss, acc = evaluate_global_model(test_set)
+                    row = {"round": round_index, "version": r.json()["version"],
+                           "round_seconds": max(clinic_seconds.values()) + aggregation_seconds,
+                           "aggregation_seconds": aggregation_seconds, "clinic_seconds": clinic_seconds,
+                           "upload_bytes": adapter.sent_bytes - sent, "download_bytes": adapter.received_bytes - received,
+                           "peak_rss_mb": rss_mb(), "test_loss": loss, "test_accuracy": acc}
+                    rounds.append(row)
+                    if not args.json:
+                        print(f"round {round_index}: {row['round_seconds']:6.1f}s (slowest clinic "
+                              f"{max(clinic_seconds.values()):.1f}s, aggregation {aggregation_seconds:.2f}s) "
+                              f"up {row['upload_bytes'] / 1e6:6.1f} MB down {row['download_bytes'] / 1e6:6.1f} MB "
+                              f"peak RSS {row['peak_rss_mb']:.0f} MB  test acc {acc:.3f}", file=report)
+        finally:
+            os.chdir(cwd)
+
+    if args.json:
+        print(json.dumps({"clinics": args.clinics, "alpha": args.alpha, "label_counts": [c for _, c in clinics],
+                          "test_images": num_test, "strategy": args.strategy, "rounds": rounds}, indent=2))
+
+
+if __name__ == "__main__":
+    main()
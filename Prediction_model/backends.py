@@ -0,0 +1,166 @@
+import copy
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+import torch
+import torch.nn as nn
+
+BACKENDS = ("eager", "torchscript", "compile", "onnx", "int8_dynamic", "int8_static")
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff")
+
+
+class InferenceBackend:
+    """
+    A forward-only view of the classifier: takes an NxCxHxW float tensor and returns
+    logits. Explanations keep using the eager fp32 model; this is just the fast path.
+    """
+
+    def __init__(self, name, forward, channels_last=False):
+        self.name = name
+        self._forward = forward
+        self.channels_last = channels_last
+        self.report = {"backend": name, "channels_last": channels_last}
+
+    def __call__(self, inp):
+        if self.channels_last:
+            inp = inp.contiguous(memory_format=torch.channels_last)
+        return self._forward(inp)
+
+
+def load_calibration_batch(folder, transform, max_images=64, input_size=224):
+    """
+    Transformed sample images from `folder` (searched recursively) for int8 calibration
+    and the parity check. Falls back to random tensors if the folder has no images.
+    """
+    paths = []
+    if folder is not None and Path(folder).exists():
+        paths = sorted(p for p in Path(folder).rglob("*") if p.suffix.lower() in IMAGE_SUFFIXES)[:max_images]
+    if not paths:
+        print(f"No calibration images found in {folder}; using random inputs (int8 calibration will be poor).")
+        return torch.randn(min(max_images, 16), 3, input_size, input_size)
+    return torch.stack([transform(Image.open(p).convert("RGB")) for p in paths])
+
+
+def _eager(model, channels_last):
+    # The model itself, not a copy: its (memory-mapped) weights stay shared with the explanation
+    # path and, across pre-forked workers, through the page cache. channels_last converts the
+    # 4-D weights in place, which the explanation path computes with just as well.
+    model = model.eval()
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    return model
+
+
+def _torchscript(model, channels_last, example):
+    model = _eager(model, channels_last)
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+        return torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
+
+
+def _compiled(model, channels_last, example):
+    # Freezing lets inductor constant-fold the (fixed) weights into the graph. torch.compile
+    # is lazy, so the graph is compiled (under the patched config) by the warm-up call;
+    # dynamic=True keeps later batch sizes on that graph.
+    import torch._inductor.config as inductor_config
+    compiled = torch.compile(_eager(model, channels_last), dynamic=True)
+    with inductor_config.patch(freezing=True), torch.no_grad():
+        compiled(example)
+    return compiled
+
+
+def _onnx(model, example, onnx_path, intra_op_threads):
+    try:
+        import onnxruntime as ort
+    except ImportError as e:
+        raise RuntimeError("The onnx backend needs `pip install onnxruntime onnx`.") from e
+    onnx_path = Path(onnx_path)
+    onnx_path.parent.mkdir(parents=True, exist_ok=True)
+    torch.onnx.export(copy.deepcopy(model).eval(), example, str(onnx_path), input_names=["input"],
+                      output_names=["logits"], dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+                      opset_version=17, dynamo=False)
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if intra_op_threads:
+        options.intra_op_num_threads = intra_op_threads
+    session = ort.InferenceSession(str(onnx_path), options, providers=["CPUExecutionProvider"])
+
+    def forward(inp):
+        logits = session.run(["logits"], {"input": inp.detach().cpu().numpy()})[0]
+        return torch.from_numpy(logits)
+    return forward
+
+
+def _int8_dynamic(model):
+    # Dynamic quantization only covers nn.Linear, i.e. ResNet18's final fc layer.
+    from torch.ao.quantization import quantize_dynamic
+    return quantize_dynamic(model.eval(), {nn.Linear}, dtype=torch.qint8)  # Converts a copy (inplace=False)
+
+
+def _int8_static(model, calibration):
+    """Post-training static int8 (FX graph mode): fuse, observe on `calibration`, convert."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    engine = "x86" if "x86" in torch.backends.quantized.supported_engines else "qnnpack"
+    torch.backends.quantized.engine = engine
+    prepared = prepare_fx(copy.deepcopy(model).eval(), get_default_qconfig_mapping(engine),
+                          example_inputs=(calibration[:1],))
+    with torch.no_grad():
+        for chunk in calibration.split(16):
+            prepared(chunk)
+    return convert_fx(prepared)
+
+
+def build_backend(model, name, channels_last=False, calibration=None, onnx_path="./outputs/global_model.onnx",
+                  intra_op_threads=None, input_size=224):
+    """Builds the named backend from the eager fp32 `model`. `calibration` is an NxCxHxW batch."""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown inference backend {name!r}; choose one of {BACKENDS}")
+    example = calibration[:2] if calibration is not None else torch.randn(2, 3, input_size, input_size)
+    if channels_last:
+        example = example.contiguous(memory_format=torch.channels_last)
+
+    if name == "eager":
+        forward = _eager(model, channels_last)
+    elif name == "torchscript":
+        forward = _torchscript(model, channels_last, example)
+    elif name == "compile":
+        forward = _compiled(model, channels_last, example)
+    elif name == "onnx":
+        forward, channels_last = _onnx(model, example.contiguous(), onnx_path, intra_op_threads), False
+    elif name == "int8_dynamic":
+        forward, channels_last = _int8_dynamic(model), False
+    else:
+        if calibration is None:
+            raise ValueError("The int8_static backend needs a calibration batch.")
+        forward, channels_last = _int8_static(model, calibration), False
+    return InferenceBackend(name, forward, channels_last)
+
+
+def check_parity(reference_model, backend, inputs):
+    """Top-1 agreement and max softmax difference of `backend` against the fp32 eager model."""
+    with torch.no_grad():
+        ref = torch.softmax(reference_model(inputs), dim=1)
+        out = torch.softmax(backend(inputs).float(), dim=1)
+    return {
+        "parity_samples": int(inputs.shape[0]),
+        "top1_agreement": float((ref.argmax(dim=1) == out.argmax(dim=1)).float().mean()),
+        "max_prob_diff": float((ref - out).abs().max()),
+    }
+
+
+def measure_throughput(forward, batch_size=16, input_size=224, iterations=5, warmup=2):
+    """Images per second and per-batch latency of `forward` on random batches."""
+    inp = torch.randn(batch_size, 3, input_size, input_size)
+    with torch.no_grad():
+        for _ in range(warmup):
+            forward(inp)
+        timings = []
+        for _ in range(iterations):
+            start = time.perf_counter()
+            forward(inp)
+            timings.append(time.perf_counter() - start)
+    median = float(np.median(timings))
+    return {"batch_size": batch_size, "batch_latency_ms": median * 1000.0, "images_per_second": batch_size / median}
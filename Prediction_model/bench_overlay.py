@@ -0,0 +1,96 @@
+"""
+Micro-benchmark for the heatmap overlay + encoding pipeline.
+
+Compares the original notebook path (matplotlib colormap -> float64 blend -> JPEG ->
+base64) against the LUT/uint8 path in overlay.py, single-image and batched, and the
+cost of each output encoding. Run from this directory:
+
+    python bench_overlay.py --size 224 --batch 16 --repeat 50
+"""
+import argparse
+import base64
+import io
+import json
+import time
+
+import numpy as np
+from PIL import Image
+import matplotlib
+
+from overlay import apply_colormap_on_image, apply_colormap_on_images, encode_image, IMAGE_FORMATS
+
+
+def legacy_apply_colormap_on_image(org_im, activation, colormap_name='jet'):
+    """The overlay helper as it was before the LUT rewrite, kept as the baseline."""
+    colormap = matplotlib.colormaps[colormap_name]
+    heatmap = colormap(activation)[:,:,:3]  # HxWx3
+    heatmap = (heatmap * 255).astype('uint8')
+    heatmap_pil = Image.fromarray(heatmap).resize(org_im.size, resample=Image.BILINEAR)
+    heatmap_np = np.array(heatmap_pil).astype(float)/255.0
+    org_np = np.array(org_im).astype(float)/255.0
+    overlay = 0.6 * org_np + 0.4 * heatmap_np
+    overlay = np.clip(overlay, 0, 1)
+    overlay_img = Image.fromarray((overlay*255).astype('uint8'))
+    return overlay_img
+
+
+def legacy_encode(img):
+    buffered = io.BytesIO()
+    img.save(buffered, format="JPEG")
+    return base64.b64encode(buffered.getvalue()).decode("utf-8")
+
+
+def timed(fn, repeat):
+    """Median wall time of `fn()` in milliseconds."""
+    fn()  # Warm up (LUT build, codec init)
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000.0)
+    return float(np.median(samples))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=224, help="Overlay side length in pixels")
+    parser.add_argument("--batch", type=int, default=16, help="Images per batched overlay")
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--json", action="store_true", help="Print a machine-readable report")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    images = rng.integers(0, 256, size=(args.batch, args.size, args.size, 3), dtype=np.uint8)
+    heatmaps = rng.random((args.batch, args.size, args.size), dtype=np.float32)
+    pil_image = Image.fromarray(images[0])
+
+    max_diff = int(np.abs(np.asarray(legacy_apply_colormap_on_image(pil_image, heatmaps[0]), dtype=np.int16)
+                          - np.asarray(apply_colormap_on_image(pil_image, heatmaps[0]), dtype=np.int16)).max())
+
+    results = {
+        "overlay_legacy_ms": timed(lambda: legacy_apply_colormap_on_image(pil_image, heatmaps[0]), args.repeat),
+        "overlay_lut_ms": timed(lambda: apply_colormap_on_image(pil_image, heatmaps[0]), args.repeat),
+        "overlay_legacy_batch_ms": timed(
+            lambda: [legacy_apply_colormap_on_image(Image.fromarray(im), h) for im, h in zip(images, heatmaps)],
+            max(1, args.repeat // 5)),
+        "overlay_lut_batch_ms": timed(lambda: apply_colormap_on_images(images, heatmaps), max(1, args.repeat // 5)),
+        "encode_legacy_jpeg_base64_ms": timed(lambda: legacy_encode(pil_image), args.repeat),
+    }
+    for image_format in IMAGE_FORMATS:
+        results[f"encode_{image_format}_ms"] = timed(lambda: encode_image(pil_image, image_format), args.repeat)
+        results[f"encode_{image_format}_bytes"] = len(encode_image(pil_image, image_format)[0])
+    results["max_pixel_difference_vs_legacy"] = max_diff
+    results["config"] = {"size": args.size, "batch": args.batch, "repeat": args.repeat}
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for name, value in results.items():
+        if name != "config":
+            print(f"{name:<34} {value:>10.3f}" if isinstance(value, float) else f"{name:<34} {value:>10}")
+    print(f"Single overlay speedup: {results['overlay_legacy_ms'] / results['overlay_lut_ms']:.1f}x, "
+          f"batched: {results['overlay_legacy_batch_ms'] / results['overlay_lut_batch_ms']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,277 @@
+"""
+Benchmark / load-test harness for the prediction service.
+
+Runs main.py's FastAPI app in-process against a randomly initialized ResNet18
+checkpoint and synthetic fundus images, so it needs neither the real
+global_model.pth nor a Gemini key (the LLM is replaced by the stub backend). It
+measures the latency of each stage of a prediction (decode, transform, forward,
+attribution, overlay, encode, LLM), end-to-end throughput and latency at several
+concurrency levels, and peak RSS, and writes a JSON report that can be diffed
+between commits. Run from this directory:
+
+    python bench_service.py --output bench.json
+    python bench_service.py --concurrency 1 8 32 --requests 64 --baseline bench.json
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFilter
+import torch
+import torch.nn as nn
+from torchvision import models
+
+HERE = Path(__file__).resolve().parent
+NUM_CLASSES = 6
+
+
+def synthetic_fundus(size, seed):
+    """A fundus-like JPEG: dark surround, orange retina with vignetting, optic disc and vessels."""
+    rng = np.random.default_rng(seed)
+    w, h = size
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    cx, cy, radius = w / 2, h / 2, min(w, h) * 0.46
+    r = np.sqrt((xx - cx) ** 2 + (yy - cy) ** 2) / radius
+    shade = np.clip(1.0 - 0.55 * r ** 2, 0, 1) * (r <= 1)
+    base = np.array([200, 90, 40], dtype=np.float32) * rng.uniform(0.8, 1.1, 3)
+    img = Image.fromarray((shade[..., None] * base).astype(np.uint8))
+
+    draw = ImageDraw.Draw(img)
+    disc_x = cx + rng.uniform(0.3, 0.5) * radius * rng.choice([-1, 1])
+    disc_y = cy + rng.uniform(-0.1, 0.1) * radius
+    disc_r = radius * 0.12
+    draw.ellipse([disc_x - disc_r, disc_y - disc_r, disc_x + disc_r, disc_y + disc_r], fill=(250, 220, 150))
+    for _ in range(8):
+        points = [(disc_x, disc_y)]
+        angle = rng.uniform(0, 2 * np.pi)
+        for _ in range(6):
+            angle += rng.normal(0, 0.3)
+            step = radius * 0.15
+            points.append((points[-1][0] + step * np.cos(angle), points[-1][1] + step * np.sin(angle)))
+        draw.line(points, fill=(120, 30, 20), width=max(2, int(radius * 0.015)))
+    for _ in range(rng.integers(0, 12)):  # Lesion-like spots
+        x, y = cx + rng.uniform(-0.7, 0.7) * radius, cy + rng.uniform(-0.7, 0.7) * radius
+        s = radius * rng.uniform(0.005, 0.02)
+        draw.ellipse([x - s, y - s, x + s, y + s], fill=(245, 235, 120) if rng.random() < 0.5 else (90, 10, 10))
+    img = img.filter(ImageFilter.GaussianBlur(1))
+
+    noisy = np.asarray(img, dtype=np.int16) + rng.integers(-4, 5, size=(h, w, 3), dtype=np.int16)
+    buffered = io.BytesIO()
+    Image.fromarray(np.clip(noisy, 0, 255).astype(np.uint8)).save(buffered, format="JPEG", quality=90)
+    return buffered.getvalue()
+
+
+def write_random_checkpoint(path, seed=0):
+    """Saves a randomly initialized ResNet18 state dict in the layout main.py loads."""
+    torch.manual_seed(seed)
+    model = models.resnet18(weights=None)
+    model.fc = nn.Linear(model.fc.in_features, NUM_CLASSES)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    torch.save(model.state_dict(), path)
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far (ru_maxrss is KiB on Linux, bytes on macOS)."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def summarize(samples_ms):
+    samples = np.asarray(samples_ms, dtype=np.float64)
+    return {"n": int(samples.size), "mean_ms": float(samples.mean()), "p50_ms": float(np.percentile(samples, 50)),
+            "p90_ms": float(np.percentile(samples, 90)), "p99_ms": float(np.percentile(samples, 99))}
+
+
+def timed(fn, repeat, warmup=1):
+    """Calls fn() `repeat` times after `warmup` calls; returns the per-call latency summary."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000.0)
+    return summarize(samples)
+
+
+def bench_stages(main, images, args):
+    """Latency of each stage of one prediction, called directly rather than over HTTP."""
+    contents = images[0]
+    img = main.decode_image(contents)
+    tensor = main.val_transform(img)
+    batch = tensor.unsqueeze(0)
+    settings = main.AttributionSettings(args.attribution, args.ig_steps)
+    with torch.no_grad():
+        pred_idx = int(main.inference_backend(batch).argmax())
+    heatmap, _ = main.compute_heatmap(tensor, pred_idx, settings)
+    resized = img.resize((main.INPUT_SIZE, main.INPUT_SIZE))
+    overlay_img = main.apply_colormap_on_image(resized, heatmap)
+
+    def forward():
+        with torch.no_grad():
+            main.inference_backend(batch)
+
+    # Distinct heatmaps per call so the LLM client's report cache never answers
+    llm_calls = iter(range(10 ** 9))
+
+    def llm():
+        main.llm_client.report(main.class_names[pred_idx], 0.5, "", overlay_img,
+                               np.roll(heatmap, next(llm_calls), axis=1))
+
+    repeat = args.stage_repeat
+    return {
+        "decode": timed(lambda: main.decode_image(contents), repeat),
+        "transform": timed(lambda: main.val_transform(img), repeat),
+        "forward": timed(forward, repeat),
+        f"attribution_{settings.tag()}": timed(lambda: main.compute_heatmap(tensor, pred_idx, settings),
+                                               max(1, repeat // 2)),
+        "overlay": timed(lambda: main.apply_colormap_on_image(resized, heatmap), repeat),
+        f"encode_{args.image_format}": timed(lambda: main.encode_image(overlay_img, args.image_format), repeat),
+        "llm_stub": timed(llm, max(1, repeat // 2), warmup=0),
+    }
+
+
+def bench_load(client, images, concurrency, n_requests, params):
+    """Fires n_requests uploads of distinct images with `concurrency` in flight."""
+    def one(i):
+        start = time.perf_counter()
+        r = client.post("/predict/", params=params, files={"file": (f"{i}.jpg", images[i % len(images)], "image/jpeg")})
+        return (time.perf_counter() - start) * 1000.0, r.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as ex:
+        results = list(ex.map(one, range(n_requests)))
+    elapsed = time.perf_counter() - start
+    ok = [ms for ms, status in results if status == 200]
+    level = {"concurrency": concurrency, "requests": n_requests, "ok": len(ok),
+             "rejected_503": sum(status == 503 for _, status in results),
+             "errors": sum(status not in (200, 503) for _, status in results),
+             "throughput_rps": len(ok) / elapsed, "wall_s": elapsed, "peak_rss_mb": peak_rss_mb()}
+    if ok:
+        level["latency"] = summarize(ok)
+    return level
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline):
+    """Prints the relative change of every latency/throughput number present in both reports."""
+    def flatten(d, prefix=""):
+        for k, v in d.items():
+            if isinstance(v, dict):
+                yield from flatten(v, f"{prefix}{k}.")
+            elif isinstance(v, (int, float)) and (k.endswith("_ms") or k.endswith("_rps") or k.endswith("_mb")):
+                yield prefix + k, v
+
+    def keyed(r):
+        out = dict(flatten(r.get("stages", {}), "stages."))
+        for mode, levels in r.get("load", {}).items():
+            for level in levels:
+                out.update(flatten(level, f"load.{mode}.c{level['concurrency']}."))
+        out["peak_rss_mb"] = r.get("peak_rss_mb")
+        return out
+
+    old, new = keyed(baseline), keyed(report)
+    print(f"\nChange vs baseline {baseline.get('git_revision')}:")
+    for name in sorted(set(old) & set(new)):
+        if old[name]:
+            print(f"  {name:<48} {old[name]:>10.2f} -> {new[name]:>10.2f}  ({(new[name] / old[name] - 1) * 100:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image-size", type=int, nargs=2, default=(1024, 768), metavar=("W", "H"),
+                        help="Size of the synthetic fundus images")
+    parser.add_argument("--images", type=int, default=64, help="Distinct synthetic images (avoids cache hits)")
+    parser.add_argument("--stage-repeat", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=(1, 4, 16))
+    parser.add_argument("--requests", type=int, default=32, help="Requests per concurrency level")
+    parser.add_argument("--modes", nargs="+", default=("predict", "explain"), choices=("predict", "explain"),
+                        help="predict = explain=false; explain = attribution + overlay + LLM stub")
+    parser.add_argument("--attribution", default="ig_fast", help="Attribution used by the explain mode and stage")
+    parser.add_argument("--ig-steps", type=int, default=None)
+    parser.add_argument("--image-format", default="jpeg")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Simulated LLM latency in seconds")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="Earlier JSON report to print relative changes against")
+    args = parser.parse_args()
+    output = Path(args.output).resolve() if args.output else None
+    baseline = json.loads(Path(args.baseline).read_text()) if args.baseline else None
+
+    # main.py resolves its paths (checkpoint, result cache) against the working directory
+    workdir = tempfile.TemporaryDirectory(prefix="netra-bench-")
+    write_random_checkpoint(Path(workdir.name) / "outputs" / "global_model.pth", args.seed)
+    os.chdir(workdir.name)
+    sys.path.insert(0, str(HERE))
+    rss_before_import = peak_rss_mb()
+    start = time.perf_counter()
+    import main as service
+    import_s = time.perf_counter() - start
+    service.LLM_BACKEND = "stub"
+    service.LLM_STUB_LATENCY_SECONDS = args.llm_latency
+    service.LLM_STUB_FAILURE_RATE = 0.0
+    start = time.perf_counter()
+    service.model_manager.load_initial()  # What the startup hook does before the service turns ready
+    load_s = time.perf_counter() - start
+
+    images = [synthetic_fundus(tuple(args.image_size), args.seed + i) for i in range(args.images)]
+    report = {
+        "git_revision": git_revision(),
+        "environment": {"python": platform.python_version(), "torch": torch.__version__,
+                        "cpu_count": os.cpu_count(), "torch_threads": torch.get_num_threads(),
+                        "device": str(service.DEVICE), "inference_backend": service.inference_backend.name},
+        "config": {k: (list(v) if isinstance(v, tuple) else v) for k, v in vars(args).items()
+                   if k not in ("output", "baseline")},
+        "startup": {"import_s": import_s, "model_load_s": load_s, "timings": service.startup_timings,
+                    "rss_before_import_mb": rss_before_import, "rss_after_load_mb": peak_rss_mb()},
+        "stages": bench_stages(service, images, args),
+        "load": {},
+    }
+
+    from fastapi.testclient import TestClient
+    mode_params = {
+        "predict": {"explain": "false"},
+        "explain": {"explain": "true", "attribution": args.attribution, "image_format": args.image_format},
+    }
+    if args.ig_steps:
+        mode_params["explain"]["ig_steps"] = str(args.ig_steps)
+    with TestClient(service.app) as client:
+        for mode in args.modes:
+            levels = []
+            for concurrency in args.concurrency:
+                # A fresh cache per level, so every request pays the full cost
+                service.result_cache.set_model(f"bench-{mode}-{concurrency}", service.result_cache.signature)
+                levels.append(bench_load(client, images, concurrency, args.requests, mode_params[mode]))
+                print(f"{mode:<8} c={concurrency:<3} {levels[-1]['throughput_rps']:7.1f} req/s", file=sys.stderr)
+            report["load"][mode] = levels
+        report["batching"] = service.batcher.stats()
+    report["peak_rss_mb"] = peak_rss_mb()
+
+    text = json.dumps(report, indent=2)
+    if output:
+        output.write_text(text)
+    else:
+        print(text)
+    if baseline:
+        compare(report, baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+"""
+Throughput-vs-processes benchmark for the pre-forked prediction service.
+
+For each process count it starts main.serve() in a subprocess against a randomly
+initialized ResNet18 checkpoint (LLM replaced by the stub backend, as in
+bench_service.py), waits for /readyz, then measures end-to-end throughput and latency
+over real HTTP for the predict (explain=false) and explain modes, with the number of
+requests in flight scaled with the process count. It also reports the memory of the
+whole process tree: the sum of RSS counts the shared model weights once per process,
+PSS splits them between the processes sharing them, so the gap between the two is what
+pre-forking saves over running independent servers. With --reload it then replaces the
+checkpoint, waits until every worker has hot-reloaded it and measures memory again, to
+show whether reloaded models stay shared too. Run on a multi-core machine, from this
+directory:
+
+    python bench_workers.py --output workers.json
+    python bench_workers.py --processes 1 2 4 8 --concurrency-per-process 4 --requests 128
+    python bench_workers.py --processes 4 --modes predict --reload
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import requests
+import torch
+
+from bench_service import HERE, synthetic_fundus, write_random_checkpoint, bench_load, git_revision
+
+# Imports main.py without running its __main__ block, so the benchmark settings apply before forking
+LAUNCHER = """
+import sys
+sys.path.insert(0, {here!r})
+import main
+main.LLM_BACKEND = "stub"
+main.LLM_STUB_LATENCY_SECONDS = {llm_latency!r}
+main.LLM_STUB_FAILURE_RATE = 0.0
+main.MODEL_POLL_INTERVAL_SECONDS = {poll_interval!r}
+main.serve({processes}, "127.0.0.1", {port})
+"""
+
+
+class HTTPClient:
+    """The slice of TestClient that bench_load uses, over real HTTP. A new connection per
+    request, as from many clients, so the kernel spreads them over the workers."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+
+    def post(self, path, **kwargs):
+        return requests.post(self.base_url + path, timeout=600, **kwargs)
+
+
+def process_tree(root_pid):
+    """root_pid and all its descendants, from /proc."""
+    parents = {}
+    for entry in Path("/proc").iterdir():
+        if entry.name.isdigit():
+            try:
+                fields = (entry / "stat").read_text().rsplit(")", 1)[1].split()
+            except OSError:
+                continue
+            parents.setdefault(int(fields[1]), []).append(int(entry.name))
+    tree, todo = [], [root_pid]
+    while todo:
+        pid = todo.pop()
+        tree.append(pid)
+        todo.extend(parents.get(pid, []))
+    return tree
+
+
+def memory_mb(root_pid):
+    """RSS, PSS and USS of each process in the tree (Linux /proc/<pid>/smaps_rollup)."""
+    processes = {}
+    for pid in process_tree(root_pid):
+        try:
+            rollup = Path(f"/proc/{pid}/smaps_rollup").read_text().splitlines()
+        except OSError:
+            continue
+        kb = {}
+        for line in rollup[1:]:
+            name, value = line.split(":", 1)
+            kb[name] = int(value.split()[0])
+        processes[pid] = {"rss_mb": kb.get("Rss", 0) / 1024, "pss_mb": kb.get("Pss", 0) / 1024,
+                          "uss_mb": (kb.get("Private_Clean", 0) + kb.get("Private_Dirty", 0)) / 1024}
+    return {"processes": processes,
+            "total_rss_mb": sum(p["rss_mb"] for p in processes.values()),
+            "total_pss_mb": sum(p["pss_mb"] for p in processes.values()),
+            "total_uss_mb": sum(p["uss_mb"] for p in processes.values())}
+
+
+def wait_ready(base_url, server, timeout):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if server.poll() is not None:
+            raise RuntimeError(f"server exited with status {server.returncode}")
+        try:
+            if requests.get(base_url + "/readyz", timeout=5).status_code == 200:
+                return time.perf_counter() - start
+        except requests.exceptions.ConnectionError:
+            pass
+        time.sleep(0.5)
+    raise TimeoutError(f"server not ready after {timeout}s")
+
+
+def reload_checkpoint(workdir, seed, log_path, processes, timeout):
+    """
+    Replaces the checkpoint with a new random one and waits until each of the `processes`
+    workers has logged it going live; returns the seconds that took.
+    """
+    checkpoint = workdir / "outputs" / "global_model.pth"
+    tmp_path = checkpoint.with_name(".reload.pth")
+    write_random_checkpoint(tmp_path, seed)
+    version = hashlib.sha256(tmp_path.read_bytes()).hexdigest()[:16]  # As main.checkpoint_digest()
+    os.replace(tmp_path, checkpoint)  # Atomic, so no worker loads half a file
+    live = f"Model version {version} is live"
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        if log_path.read_text().count(live) >= processes:
+            return time.perf_counter() - start
+        time.sleep(0.5)
+    raise TimeoutError(f"not every worker reloaded version {version} after {timeout}s")
+
+
+def bench_processes(processes, images, mode_params, args, workdir):
+    """Starts the service with `processes` workers and loads it in every mode."""
+    log_path = workdir / f"serve-{processes}.log"
+    write_random_checkpoint(workdir / "outputs" / "global_model.pth", args.seed)
+    launcher = LAUNCHER.format(here=str(HERE), llm_latency=args.llm_latency, processes=processes, port=args.port,
+                               poll_interval=1 if args.reload else 0)
+    with open(log_path, "w") as log:
+        server = subprocess.Popen([sys.executable, "-c", launcher], cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{args.port}"
+    try:
+        result = {"processes": processes, "ready_s": wait_ready(base_url, server, args.ready_timeout)}
+        result["memory_ready"] = memory_mb(server.pid)
+        client = HTTPClient(base_url)
+        concurrency = args.concurrency_per_process * processes
+        result["load"] = {}
+        for run, mode in enumerate(args.modes):
+            # Distinct bytes per request and per run (trailing bytes after the JPEG's end
+            # marker are ignored by the decoder), so neither cache tier ever answers
+            uploads = [images[i % len(images)] + f"{processes}-{run}-{i}".encode() for i in range(args.requests)]
+            bench_load(client, uploads[:concurrency], concurrency, concurrency, mode_params[mode])  # Warm-up
+            level = bench_load(client, uploads, concurrency, args.requests, mode_params[mode])
+            level.pop("peak_rss_mb")  # The client's, not the server's
+            result["load"][mode] = level
+            print(f"processes={processes:<3} {mode:<8} c={concurrency:<4} {level['throughput_rps']:7.1f} req/s",
+                  file=sys.stderr)
+        result["memory_loaded"] = memory_mb(server.pid)
+        if args.reload:
+            result["reload_s"] = reload_checkpoint(workdir, args.seed + 1, log_path, processes, args.ready_timeout)
+            result["memory_reloaded"] = memory_mb(server.pid)
+            print(f"processes={processes:<3} reloaded in {result['reload_s']:.1f}s", file=sys.stderr)
+        return result
+    finally:
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            for pid in reversed(process_tree(server.pid)):
+                os.kill(pid, signal.SIGKILL)
+            server.wait()
+
+
+def print_table(report):
+    modes = list(report["runs"][0]["load"]) if report["runs"] else []
+    header = f"{'procs':>5} " + "".join(f"{mode + ' req/s':>16}{'p50 ms':>9}" for mode in modes)
+    header += f"{'RSS sum MB':>12}{'PSS sum MB':>12}"
+    reloaded = any("memory_reloaded" in run for run in report["runs"])
+    if reloaded:
+        header += f"{'PSS reloaded':>14}"
+    print(header, file=sys.stderr)
+    for run in report["runs"]:
+        row = f"{run['processes']:>5} "
+        for mode in modes:
+            level = run["load"][mode]
+            row += f"{level['throughput_rps']:>16.1f}{level.get('latency', {}).get('p50_ms', float('nan')):>9.0f}"
+        memory = run["memory_loaded"]
+        row += f"{memory['total_rss_mb']:>12.0f}{memory['total_pss_mb']:>12.0f}"
+        if reloaded:
+            row += f"{run.get('memory_reloaded', {}).get('total_pss_mb', float('nan')):>14.0f}"
+        print(row, file=sys.stderr)
+
+
+def main():
+    cores = os.cpu_count() or 1
+    default_processes = sorted({1, cores} | {2 ** i for i in range(1, 8) if 2 ** i < cores})
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, nargs="+", default=default_processes,
+                        help="Process counts to compare (default: powers of two up to the core count)")
+    parser.add_argument("--concurrency-per-process", type=int, default=4, help="Requests in flight per process")
+    parser.add_argument("--requests", type=int, default=64, help="Requests per mode and process count")
+    parser.add_argument("--modes", nargs="+", default=("predict", "explain"), choices=("predict", "explain"),
+                        help="predict = explain=false; explain = attribution + overlay + LLM stub")
+    parser.add_argument("--attribution", default="ig_fast", help="Attribution used by the explain mode")
+    parser.add_argument("--image-size", type=int, nargs=2, default=(1024, 768), metavar=("W", "H"))
+    parser.add_argument("--images", type=int, default=16, help="Distinct synthetic images")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="Simulated LLM latency in seconds")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--ready-timeout", type=float, default=600)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--reload", action="store_true",
+                        help="After the load, hot-reload a new checkpoint and measure memory again")
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    workdir = tempfile.TemporaryDirectory(prefix="netra-bench-workers-")
+    images = [synthetic_fundus(tuple(args.image_size), args.seed + i) for i in range(args.images)]
+    mode_params = {
+        "predict": {"explain": "false"},
+        "explain": {"explain": "true", "attribution": args.attribution},
+    }
+    report = {
+        "git_revision": git_revision(),
+        "environment": {"python": platform.python_version(), "torch": torch.__version__, "cpu_count": cores,
+                        "affinity": len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None},
+        "config": {k: (list(v) if isinstance(v, tuple) else v) for k, v in vars(args).items() if k != "output"},
+        "runs": [bench_processes(n, images, mode_params, args, Path(workdir.name)) for n in args.processes],
+    }
+    print_table(report)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
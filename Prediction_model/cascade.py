@@ -0,0 +1,87 @@
+"""
+Confidence-gated model cascade: a cheap first stage (the same checkpoint on a
+downscaled input, optionally quantized) answers the images it is confident about and
+the rest escalate to the full model. main.py serves it; pick_cascade_threshold.py uses
+the same helpers to choose the thresholds offline.
+"""
+import torch
+import torch.nn.functional as F
+
+
+def downscale(batch, size):
+    """The first stage's input: an NxCxHxW batch resized to `size` (same crop, fewer pixels)."""
+    if batch.shape[-1] == size and batch.shape[-2] == size:
+        return batch
+    return F.interpolate(batch, size=(size, size), mode="bilinear", antialias=True, align_corners=False)
+
+
+def class_thresholds(class_names, default, overrides=None):
+    """
+    Per-class acceptance thresholds as a tensor indexed by class; `overrides` maps class
+    name -> threshold. A threshold of None means never answer (it becomes infinity).
+    """
+    overrides = overrides or {}
+    unknown = set(overrides) - set(class_names)
+    if unknown:
+        raise ValueError(f"Cascade thresholds for unknown classes: {sorted(unknown)}")
+    thresholds = (overrides.get(name, default) for name in class_names)
+    return torch.tensor([float("inf") if t is None else float(t) for t in thresholds], dtype=torch.float64)
+
+
+def evaluate(full_probs, cheap_probs, thresholds):
+    """
+    What the cascade does on a sample, given softmax outputs of both stages and the
+    per-class thresholds: the share of images the first stage answers (hit rate), how
+    often those answers agree with the full model, and the agreement of the cascade's
+    final answers overall (escalated images get the full model's answer).
+    """
+    full_pred = full_probs.argmax(dim=1)
+    conf, pred = cheap_probs.max(dim=1)
+    accepted = conf >= thresholds[pred]
+    agree = pred == full_pred
+    samples, answered = len(conf), int(accepted.sum())
+    return {
+        "samples": samples,
+        "hit_rate": answered / samples if samples else 0.0,
+        "accepted_agreement": float(agree[accepted].float().mean()) if answered else None,
+        "overall_agreement": 1.0 - int((accepted & ~agree).sum()) / samples if samples else None,
+        "first_stage_agreement": float(agree.float().mean()) if samples else None,
+    }
+
+
+def pick_threshold(conf, agree, target):
+    """
+    The lowest threshold at which the images accepted (conf >= threshold) agree with the
+    full model at least `target` of the time, i.e. the one answering the most images;
+    None if no threshold gets there.
+    """
+    if not len(conf):
+        return None
+    conf, order = conf.sort(descending=True)
+    hits = agree[order].float().cumsum(dim=0)
+    accepted = torch.arange(1, len(conf) + 1)
+    # A threshold accepts every image at or above it, so only the last of a run of ties is a valid cut
+    cut = torch.ones(len(conf), dtype=torch.bool)
+    cut[:-1] = conf[1:] < conf[:-1]
+    ok = cut & (hits / accepted >= target)
+    if not ok.any():
+        return None
+    return float(conf[int(ok.nonzero().max())])
+
+
+def pick_thresholds(full_probs, cheap_probs, class_names, target, min_samples=20):
+    """
+    A single threshold for all classes and per-class thresholds meeting `target`
+    agreement. Classes the first stage predicted fewer than `min_samples` times keep the
+    single threshold. Returns (threshold, {class name: threshold}); None means never answer.
+    """
+    full_pred = full_probs.argmax(dim=1)
+    conf, pred = cheap_probs.max(dim=1)
+    agree = pred == full_pred
+    default = pick_threshold(conf, agree, target)
+    per_class = {}
+    for idx, name in enumerate(class_names):
+        mask = pred == idx
+        if int(mask.sum()) >= min_samples:
+            per_class[name] = pick_threshold(conf[mask], agree[mask], target)
+    return default, per_class
@@ -0,0 +1,142 @@
+"""
+Offline threshold picker for the prediction service's model cascade.
+
+Classifies a folder of images with the full model (the checkpoint in fp32 at
+INPUT_SIZE, which the service escalates to) and with the cascade's first stage as
+main.py builds it (CASCADE_INPUT_SIZE, CASCADE_BACKEND), then finds the lowest
+confidence thresholds at which the images the first stage would answer still agree
+with the full model at least `--target` of the time: one threshold for all classes and
+one per predicted class. No labels are needed, only images representative of the
+traffic. It prints the hit rate and agreement over a range of thresholds, the expected
+classification cost per image, and the configuration lines to paste into main.py.
+Run from this directory:
+
+    python pick_cascade_threshold.py --images ./validation_images --target 0.99
+    python pick_cascade_threshold.py --images ./validation_images --input-size 128 --backend int8_static \\
+        --output cascade.json
+"""
+import argparse
+import json
+import math
+import sys
+from pathlib import Path
+
+import torch
+
+from backends import BACKENDS, IMAGE_SUFFIXES, measure_throughput
+from cascade import class_thresholds, downscale, evaluate, pick_thresholds
+
+SWEEP = (0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 0.97, 0.99)
+
+
+def load_images(folder, max_images):
+    """Images under `folder`, decoded and transformed exactly as the service does it."""
+    import main as service
+    paths = sorted(p for p in Path(folder).rglob("*") if p.suffix.lower() in IMAGE_SUFFIXES)[:max_images]
+    if not paths:
+        sys.exit(f"No images found under {folder}.")
+    return torch.stack([service.decode_and_transform(p.read_bytes(), p.name)[1] for p in paths])
+
+
+def softmax_in_chunks(forward, inputs, chunk_size):
+    with torch.no_grad():
+        return torch.cat([torch.softmax(forward(chunk).float(), dim=1) for chunk in inputs.split(chunk_size)])
+
+
+def print_sweep(rows):
+    print(f"{'threshold':>10}{'hit rate':>10}{'accepted agree':>16}{'overall agree':>15}", file=sys.stderr)
+    for threshold, result in rows:
+        accepted = result["accepted_agreement"]
+        print(f"{threshold:>10}{result['hit_rate']:>10.3f}"
+              f"{accepted if accepted is not None else float('nan'):>16.4f}{result['overall_agreement']:>15.4f}",
+              file=sys.stderr)
+
+
+def config_value(threshold):
+    # Rounded down, so the printed threshold still accepts every image the picked one does
+    return "None" if threshold is None else f"{math.floor(threshold * 1e4) / 1e4:.4f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--images", required=True, help="Folder of sample images (searched recursively)")
+    parser.add_argument("--checkpoint", help="Model checkpoint (default: main.MODEL_PATH)")
+    parser.add_argument("--max-images", type=int, default=5000)
+    parser.add_argument("--target", type=float, default=0.99,
+                        help="Minimum agreement with the full model on the images the first stage answers")
+    parser.add_argument("--input-size", type=int, help="First-stage input size (default: main.CASCADE_INPUT_SIZE)")
+    parser.add_argument("--backend", choices=BACKENDS, help="First-stage backend (default: main.CASCADE_BACKEND)")
+    parser.add_argument("--min-samples", type=int, default=20,
+                        help="Fewest first-stage predictions of a class to give it its own threshold")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--output", help="Also write the JSON report here")
+    args = parser.parse_args()
+    if not 0 < args.target <= 1:
+        parser.error("--target must be in (0, 1]")
+
+    import main as service
+    if args.input_size:
+        service.CASCADE_INPUT_SIZE = args.input_size
+    if args.backend:
+        service.CASCADE_BACKEND = args.backend
+    service.CASCADE_CLASS_THRESHOLDS = {}  # Evaluated below; the configured ones may not fit this checkpoint
+
+    checkpoint = Path(args.checkpoint) if args.checkpoint else service.MODEL_PATH
+    state_dict, version, _ = service.read_checkpoint(checkpoint)
+    model, class_names = service.load_model_components(state_dict)
+    first_stage = service.setup_cascade_backend(model, class_names)
+    if first_stage is None:
+        sys.exit("The first stage could not be built; see the warning above.")
+
+    inputs = load_images(args.images, args.max_images)
+    size = service.CASCADE_INPUT_SIZE
+    full_probs = softmax_in_chunks(model, inputs, args.batch_size)
+    cheap_probs = softmax_in_chunks(lambda chunk: first_stage(downscale(chunk, size)), inputs, args.batch_size)
+
+    sweep = [(t, evaluate(full_probs, cheap_probs, class_thresholds(class_names, t))) for t in SWEEP]
+    default, per_class = pick_thresholds(full_probs, cheap_probs, class_names, args.target, args.min_samples)
+    picked = {
+        "single": evaluate(full_probs, cheap_probs, class_thresholds(class_names, default)),
+        "per_class": evaluate(full_probs, cheap_probs, class_thresholds(class_names, default, per_class)),
+    }
+
+    # Classification cost per image: every image pays for the first stage, escalations for the full model too
+    full_cost = 1 / measure_throughput(model, args.batch_size, service.INPUT_SIZE)["images_per_second"]
+    cheap_cost = 1 / measure_throughput(first_stage, args.batch_size, size)["images_per_second"]
+    for result in picked.values():
+        result["relative_classification_cost"] = (cheap_cost + (1 - result["hit_rate"]) * full_cost) / full_cost
+
+    report = {
+        "checkpoint": str(checkpoint), "model_version": version, "images": int(inputs.shape[0]),
+        "first_stage": {"input_size": size, "backend": first_stage.name}, "target": args.target,
+        "first_stage_ms_per_image": cheap_cost * 1000, "full_ms_per_image": full_cost * 1000,
+        "sweep": [{"threshold": t, **result} for t, result in sweep],
+        "threshold": default, "class_thresholds": per_class, "picked": picked,
+    }
+
+    print_sweep(sweep)
+    print(f"\nFirst stage {first_stage.name} at {size}px: {cheap_cost * 1000:.1f} ms/image, "
+          f"full model {full_cost * 1000:.1f} ms/image ({inputs.shape[0]} images).", file=sys.stderr)
+    for name, result in picked.items():
+        accepted = result["accepted_agreement"]
+        print(f"{name:>9}: hit rate {result['hit_rate']:.3f}, accepted agreement "
+              f"{accepted if accepted is not None else float('nan'):.4f}, overall agreement "
+              f"{result['overall_agreement']:.4f}, classification cost x{result['relative_classification_cost']:.2f}",
+              file=sys.stderr)
+    if default is None:
+        print(f"No single threshold reaches {args.target} agreement; the cascade would not help here.", file=sys.stderr)
+    print("\n# Paste into main.py's Cascade Configuration", file=sys.stderr)
+    print(f"CASCADE_INPUT_SIZE = {size}\nCASCADE_BACKEND = {first_stage.name!r}\n"
+          f"CASCADE_THRESHOLD = {config_value(default)}", file=sys.stderr)
+    pasted = ", ".join(f"{name!r}: {config_value(t)}" for name, t in per_class.items())
+    print(f"CASCADE_CLASS_THRESHOLDS = {{{pasted}}}", file=sys.stderr)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
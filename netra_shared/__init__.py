@@ -0,0 +1,4 @@
+"""
+Code shared by the Python services (Prediction_model and the Federated_learning server
+and clinics). Each service puts the repository root on sys.path to import it.
+"""
@@ -0,0 +1,127 @@
+"""
+Model delta codec shared by the central server and the clinics: the wire format of the
+/download-delta and /upload-delta payloads, so both ends always agree on it.
+
+A payload is one tag byte naming the compression, then a torch.save'd
+{"format": 1, "tensors": {name: entry}}. A float entry holds "shape" and "values"
+(fp32, fp16, or int8 plus a per-tensor "scale"), and "indices" when top-k sparsified.
+Integer buffers are not deltas: their entry is {"replace": new_value}.
+"""
+import io
+import math
+import zlib
+
+import torch
+
+try:
+    import zstandard  # Optional: enables zstd-compressed model deltas
+except ImportError:
+    zstandard = None
+
+DELTA_FORMAT = 1
+DELTA_DTYPES = ("fp32", "fp16", "int8")
+DELTA_COMPRESSIONS = {"none": b"\x00", "zlib": b"\x01", "zstd": b"\x02"}
+DELTA_TOPK_MIN_NUMEL = 1024  # Smaller tensors (biases, BatchNorm) are always sent dense
+
+
+def _compress(raw, compression):
+    if compression == "zlib":
+        raw = zlib.compress(raw, 6)
+    elif compression == "zstd":
+        if zstandard is None:
+            raise RuntimeError("zstd compression needs `pip install zstandard`.")
+        raw = zstandard.ZstdCompressor(level=3).compress(raw)
+    elif compression != "none":
+        raise ValueError(f"compression must be one of {tuple(DELTA_COMPRESSIONS)}")
+    return DELTA_COMPRESSIONS[compression] + raw
+
+
+def _decompress(payload):
+    tag, body = payload[:1], payload[1:]
+    if tag == DELTA_COMPRESSIONS["zlib"]:
+        return zlib.decompress(body)
+    if tag == DELTA_COMPRESSIONS["zstd"]:
+        if zstandard is None:
+            raise RuntimeError("zstd compression needs `pip install zstandard`.")
+        return zstandard.ZstdDecompressor().decompress(body)
+    if tag != DELTA_COMPRESSIONS["none"]:
+        raise ValueError("Unknown delta compression tag.")
+    return body
+
+
+def _quantize(values, dtype):
+    if dtype == "fp32":
+        return {"values": values.float()}
+    if dtype == "fp16":
+        return {"values": values.half()}
+    if dtype != "int8":
+        raise ValueError(f"dtype must be one of {DELTA_DTYPES}")
+    # Symmetric per-tensor int8
+    scale = float(values.abs().max()) / 127 or 1.0
+    return {"values": torch.round(values / scale).clamp_(-127, 127).to(torch.int8), "scale": scale}
+
+
+def _dequantize(entry):
+    values = entry["values"].float()
+    return values.mul_(entry["scale"]) if "scale" in entry else values
+
+
+def encode_delta(delta, dtype="fp16", topk_ratio=None, compression="zlib"):
+    """Serializes a {name: tensor} delta, optionally quantized, top-k sparsified and compressed."""
+    tensors = {}
+    for key, value in delta.items():
+        if not value.is_floating_point():
+            tensors[key] = {"replace": value}
+            continue
+        flat = value.reshape(-1).float()
+        entry = {"shape": tuple(value.shape)}
+        if topk_ratio and flat.numel() >= DELTA_TOPK_MIN_NUMEL:
+            k = max(1, int(flat.numel() * topk_ratio))
+            indices = flat.abs().topk(k, sorted=False).indices
+            entry["indices"] = indices.to(torch.int32)
+            flat = flat[indices]
+        entry.update(_quantize(flat, dtype))
+        tensors[key] = entry
+    buffer = io.BytesIO()
+    torch.save({"format": DELTA_FORMAT, "tensors": tensors}, buffer)
+    return _compress(buffer.getvalue(), compression)
+
+
+def decode_delta(payload):
+    """Inverse of encode_delta: returns dense float32 deltas (integer buffers as their new values)."""
+    data = torch.load(io.BytesIO(_decompress(payload)), map_location="cpu", weights_only=True)
+    if data.get("format") != DELTA_FORMAT:
+        raise ValueError(f"Unsupported delta format {data.get('format')}")
+    delta = {}
+    for key, entry in data["tensors"].items():
+        if "replace" in entry:
+            delta[key] = entry["replace"]
+            continue
+        values = _dequantize(entry)
+        if "indices" in entry:
+            dense = torch.zeros(math.prod(entry["shape"]), dtype=torch.float32)
+            dense[entry["indices"].long()] = values
+            values = dense
+        delta[key] = values.reshape(entry["shape"])
+    return delta
+
+
+def state_delta(new_state, base_state):
+    """new - base for float tensors; integer buffers are passed through as their new value."""
+    return {k: (v.float() - base_state[k].float()) if v.is_floating_point() else v.clone()
+            for k, v in new_state.items()}
+
+
+def apply_delta(base_state, delta):
+    """base + delta, in the base model's dtypes. Raises ValueError if the tensors do not line up."""
+    if delta.keys() != base_state.keys():
+        raise ValueError("Delta does not have the same parameters as the base model.")
+    out = {}
+    for k, base in base_state.items():
+        if base.is_floating_point():
+            if delta[k].shape != base.shape:
+                raise ValueError(f"Delta for {k} has shape {tuple(delta[k].shape)}, expected {tuple(base.shape)}.")
+            out[k] = (base.float() + delta[k]).to(base.dtype)
+        else:
+            out[k] = delta[k].to(base.dtype).clone()
+    return out
@@ -0,0 +1,20 @@
+"""
+File helpers shared by the central server and the clinics.
+"""
+import os
+
+
+def atomic_write(path, write):
+    """
+    Calls `write(f)` on a temp file next to `path`, fsyncs it and renames it over `path`,
+    so readers (and a crash) only ever see the old or the complete new file.
+    """
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
@@ -0,0 +1,512 @@
+"""
+Metrics and on-demand profiling shared by the prediction, central and clinic services.
+
+Metrics live in a process-wide registry and are served in the Prometheus text format
+by the /metrics endpoint that instrument_app() adds, together with a latency histogram
+and counter of every HTTP request and gauges of the process's memory, CPU time and
+threads. Code times its own stages with `with stage("forward"):` (or `@stage("llm")`)
+and registers callbacks for queue depths and other state, which are read at scrape time.
+
+The /admin/profile endpoints arm a Profiler for the next N units of work (requests, or
+training batches in the clinics) and serve the finished trace as a file: a
+torch.profiler Chrome trace (open it in Perfetto or chrome://tracing), or with
+kind="stacks" Python stack samples in the folded format flamegraph.pl and speedscope read.
+"""
+import asyncio
+import contextlib
+import math
+import os
+import resource
+import sys
+import threading
+import time
+import uuid
+from collections import Counter as _Tally, OrderedDict
+from pathlib import Path
+
+from fastapi import HTTPException
+from starlette.responses import FileResponse, Response
+
+# Seconds; wide enough for a 5 ms forward pass and a 30 minute training round alike
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+                   120.0, 300.0, 600.0, 1800.0, 3600.0)
+PROFILE_KINDS = ("torch", "stacks")
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# --- Metrics ---
+
+def _format_value(value):
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{n}="{v}"' for n, v in zip(names, escaped)) + "}"
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        self.functions = {}  # label values -> callback read at scrape time
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[n]) for n in self.labelnames)
+
+    def set_function(self, fn, **labels):
+        """Reports fn() for these labels at every scrape instead of a stored value."""
+        self.functions[self._key(labels)] = fn
+
+    def _samples(self):
+        with self.lock:
+            samples = dict(self.values)
+        for key, fn in self.functions.items():
+            try:
+                samples[key] = float(fn())
+            except Exception:  # A broken callback must not take /metrics down with it
+                continue
+        return samples
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for key, value in sorted(self._samples().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = float(value)
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0.0) + amount
+
+    def dec(self, amount=1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class _Timer(contextlib.ContextDecorator):
+    """Observes the time spent in a `with` block or decorated call; marks it in torch traces too."""
+
+    def __init__(self, histogram, labels, annotation=None):
+        self.histogram = histogram
+        self.labels = labels
+        self.annotation = annotation
+
+    def _recreate_cm(self):
+        return _Timer(self.histogram, self.labels, self.annotation)  # A decorated function can run on many threads
+
+    def __enter__(self):
+        self.range = None
+        if self.annotation is not None and _torch_tracing:
+            import torch
+            self.range = torch.profiler.record_function(self.annotation)
+            self.range.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        if self.range is not None:
+            self.range.__exit__(*exc)
+        return False
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                counts = self.values[key] = [0] * len(self.buckets) + [0, 0.0]  # ..., count, sum
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-2] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            values = {key: list(counts) for key, counts in self.values.items()}
+        names = self.labelnames + ("le",)
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(names, key + (_format_value(bound),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(names, key + ('+Inf',))} {counts[-2]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {counts[-2]}")
+        return lines
+
+
+class Registry:
+    """The metrics of one process. Asking twice for the same name returns the same metric."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = OrderedDict()
+
+    def _get(self, cls, name, help, labelnames, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labelnames, **kwargs)
+            elif type(metric) is not cls or metric.labelnames != tuple(labelnames):
+                raise ValueError(f"metric {name} is already registered as a {metric.kind} with labels {metric.labelnames}")
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets=buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(line for metric in metrics for line in metric.render()) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("netra_stage_duration_seconds", "Time spent in each stage of the work", ("stage",))
+HTTP_REQUESTS = REGISTRY.counter("netra_http_requests_total", "HTTP requests answered", ("method", "route", "status"))
+HTTP_SECONDS = REGISTRY.histogram("netra_http_request_duration_seconds",
+                                  "Time from receiving an HTTP request to sending the last byte of its response",
+                                  ("method", "route"))
+HTTP_IN_PROGRESS = REGISTRY.gauge("netra_http_requests_in_progress", "HTTP requests being handled")
+
+
+def stage(name):
+    """Times a stage into netra_stage_duration_seconds{stage=name}; use as `with` or decorator."""
+    return _Timer(STAGE_SECONDS, {"stage": name}, annotation=name)
+
+
+def observe_stage(name, seconds):
+    """Records a stage timed elsewhere, e.g. in a training process."""
+    STAGE_SECONDS.observe(seconds, stage=name)
+
+
+# Process metrics, read at scrape time
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+_START_TIME = time.time()
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024  # KiB on Linux, bytes on macOS
+
+
+def _rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except OSError:
+        return _peak_rss_bytes()
+
+
+REGISTRY.gauge("process_resident_memory_bytes", "Resident memory size in bytes").set_function(_rss_bytes)
+REGISTRY.gauge("process_peak_resident_memory_bytes", "Peak resident memory size in bytes").set_function(_peak_rss_bytes)
+REGISTRY.counter("process_cpu_seconds_total", "User and system CPU time in seconds").set_function(
+    lambda: sum(os.times()[:2]))
+REGISTRY.gauge("process_start_time_seconds", "Start time of the process since the epoch").set_function(
+    lambda: _START_TIME)
+REGISTRY.gauge("process_threads", "Python threads alive").set_function(threading.active_count)
+if os.path.isdir("/proc/self/fd"):
+    REGISTRY.gauge("process_open_fds", "Open file descriptors").set_function(lambda: len(os.listdir("/proc/self/fd")))
+
+
+# --- Profiling ---
+
+_torch_tracing = False  # True while a torch capture runs, so stage() marks its ranges in the trace
+
+
+class _TorchCapture:
+    suffix = ".json"
+
+    def __init__(self):
+        global _torch_tracing
+        import torch
+        from torch.profiler import profile, ProfilerActivity
+        activities = [ProfilerActivity.CPU] + ([ProfilerActivity.CUDA] if torch.cuda.is_available() else [])
+        try:
+            # The work runs on worker and loader threads, not the one that starts the capture
+            config = torch._C._profiler._ExperimentalConfig(profile_all_threads=True)
+            self.profile = profile(activities=activities, record_shapes=True, experimental_config=config)
+        except (AttributeError, TypeError):  # Older torch: only this thread's ops are recorded
+            self.profile = profile(activities=activities, record_shapes=True)
+        self.profile.start()
+        _torch_tracing = True
+
+    def save(self, path):
+        global _torch_tracing
+        _torch_tracing = False
+        self.profile.stop()
+        self.profile.export_chrome_trace(str(path))
+
+
+class _StackSampler:
+    """Samples every thread's Python stack at a fixed interval; saved as `thread;frame;... count` lines."""
+    suffix = ".folded"
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = _Tally()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        me = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                    frame = frame.f_back
+                self.stacks[";".join([names.get(ident, str(ident))] + frames[::-1])] += 1
+
+    def save(self, path):
+        self.stopping.set()
+        self.thread.join()
+        path.write_text("".join(f"{stack} {n}\n" for stack, n in self.stacks.most_common()))
+
+
+class Profiler:
+    """
+    Captures a trace of the next N units of work. One capture runs at a time: arm() it,
+    start() it on the process doing the work, and step() once per unit; it is saved under
+    `directory` after the last one. Finished captures are kept for download, up to `history`.
+    """
+
+    def __init__(self, directory, sample_interval=0.005, history=20):
+        self.directory = Path(directory)
+        self.sample_interval = sample_interval
+        self.history = history
+        self.lock = threading.Lock()
+        self.captures = OrderedDict()
+        self.active = None
+        self.session = None
+
+    def arm(self, units, kind="torch", unit="requests"):
+        if kind not in PROFILE_KINDS:
+            raise ValueError(f"kind must be one of {PROFILE_KINDS}")
+        if units < 1:
+            raise ValueError("count must be positive")
+        with self.lock:
+            if self.active is not None:
+                raise RuntimeError(f"capture {self.active['id']} is still {self.active['state']}")
+            capture = {"id": uuid.uuid4().hex[:12], "kind": kind, "unit": unit, "units": units, "steps": 0,
+                       "state": "armed", "requested_at": time.time(), "started_at": None, "finished_at": None,
+                       "file": None, "error": None}
+            self.captures[capture["id"]] = self.active = capture
+            self._forget_old()
+            return capture
+
+    def _forget_old(self):
+        finished = [c for c in self.captures.values() if c["state"] not in ("armed", "capturing")]
+        for capture in finished[:max(0, len(self.captures) - self.history)]:
+            del self.captures[capture["id"]]
+            if capture["file"]:
+                Path(capture["file"]).unlink(missing_ok=True)
+
+    def start(self, capture=None):
+        """Starts the armed capture, or `capture`, armed by another process (the clinic's server)."""
+        with self.lock:
+            if capture is not None:
+                self.captures[capture["id"]] = self.active = capture
+            capture = self.active
+            if capture is None or capture["state"] != "armed":
+                return
+            try:
+                if capture["kind"] == "torch":
+                    self.session = _TorchCapture()
+                else:
+                    self.session = _StackSampler(self.sample_interval)
+                capture["state"], capture["started_at"] = "capturing", time.time()
+            except Exception as e:
+                capture["state"], capture["error"], capture["finished_at"] = "failed", str(e), time.time()
+                self.active = None
+
+    @property
+    def capturing(self):
+        capture = self.active
+        return capture is not None and capture["state"] == "capturing"
+
+    def step(self):
+        """Counts one unit of work; the capture is saved after its last one. Cheap when idle."""
+        if not self.capturing:
+            return None
+        with self.lock:
+            capture = self.active
+            if capture is None:
+                return None
+            capture["steps"] += 1
+            if capture["steps"] < capture["units"]:
+                return None
+        return self.finish()
+
+    def finish(self):
+        """Stops and saves the running capture (early, if fewer units came). Returns it."""
+        with self.lock:
+            capture, session = self.active, self.session
+            if capture is None:
+                return None
+            self.active = self.session = None
+        if session is None:  # Never started
+            capture["state"] = "cancelled"
+        else:
+            try:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                path = self.directory / f"profile-{capture['id']}{session.suffix}"
+                session.save(path)
+                capture["state"], capture["file"] = "done", str(path)
+            except Exception as e:
+                capture["state"], capture["error"] = "failed", str(e)
+        capture["finished_at"] = time.time()
+        return capture
+
+    def update(self, capture):
+        """Takes over the state of a capture that ran in another process."""
+        with self.lock:
+            if capture["id"] in self.captures:
+                self.captures[capture["id"]].update(capture)
+                if self.active is not None and self.active["id"] == capture["id"] \
+                        and capture["state"] not in ("armed", "capturing"):
+                    self.active = None
+
+    def get(self, capture_id):
+        capture = self.captures.get(capture_id)
+        if capture is None:
+            raise HTTPException(status_code=404, detail=f"Unknown profile capture {capture_id}")
+        return capture
+
+
+# --- FastAPI Wiring ---
+
+class MetricsMiddleware:
+    """ASGI middleware recording every HTTP request, and counting requests for a profile capture."""
+
+    def __init__(self, app, profiler=None, profile_requests=True):
+        self.app = app
+        self.profiler = profiler
+        self.profile_requests = profile_requests
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status = [500]
+
+        async def send_and_record(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        HTTP_IN_PROGRESS.inc()
+        try:
+            await self.app(scope, receive, send_and_record)
+        finally:
+            HTTP_IN_PROGRESS.dec()
+            route = scope.get("route")
+            path = getattr(route, "path", None) or "unmatched"  # The template, so ids don't explode the labels
+            HTTP_SECONDS.observe(time.perf_counter() - start, method=scope["method"], route=path)
+            HTTP_REQUESTS.inc(method=scope["method"], route=path, status=status[0])
+            if self.profile_requests and self.profiler is not None and self.profiler.capturing \
+                    and not path.startswith(("/metrics", "/admin/")):
+                await asyncio.to_thread(self.profiler.step)  # Saving the trace takes a moment
+
+
+def instrument_app(app, profiler, unit="requests", on_arm=None):
+    """
+    Adds the metrics middleware, GET /metrics and the /admin/profile endpoints to `app`.
+    A capture counts `unit`s: HTTP requests by default, or whatever the service steps the
+    profiler on, in which case `on_arm(capture)` hands the armed capture to the work.
+    """
+    app.add_middleware(MetricsMiddleware, profiler=profiler, profile_requests=unit == "requests")
+
+    def metrics():
+        return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+    async def start_profile(count: int = 10, kind: str = "torch"):
+        """Captures a trace of the next `count` units of work; download it from /admin/profile/{id}/download."""
+        try:
+            capture = profiler.arm(count, kind, unit)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        except RuntimeError as e:
+            raise HTTPException(status_code=409, detail=str(e))
+        if on_arm is not None:
+            on_arm(capture)
+        else:
+            profiler.start()
+        return capture
+
+    def list_profiles():
+        return {"active": profiler.active, "captures": list(profiler.captures.values())}
+
+    def get_profile(capture_id: str):
+        return profiler.get(capture_id)
+
+    def download_profile(capture_id: str):
+        capture = profiler.get(capture_id)
+        if capture["state"] != "done":
+            raise HTTPException(status_code=409, detail=f"Capture {capture_id} is {capture['state']}")
+        path = Path(capture["file"])
+        if not path.exists():
+            raise HTTPException(status_code=410, detail=f"Capture {capture_id} has been deleted")
+        return FileResponse(path, filename=path.name, media_type="application/octet-stream")
+
+    app.add_api_route("/metrics", metrics, methods=["GET"], include_in_schema=False)
+    app.add_api_route("/admin/profile", start_profile, methods=["POST"])
+    app.add_api_route("/admin/profile", list_profiles, methods=["GET"])
+    app.add_api_route("/admin/profile/{capture_id}", get_profile, methods=["GET"])
+    app.add_api_route("/admin/profile/{capture_id}/download", download_profile, methods=["GET"])